@@ -0,0 +1,508 @@
+# -*- coding: utf-8 -*-
+#
+# benchmark.py
+#
+
+"""
+Benchmarks of the experiment engine on synthetic radiomics-like data.
+
+Run the benchmarks and store the results as a JSON baseline:
+
+    python -m benchmarks.benchmark run -sizes small -output baseline.json
+
+and compare the results of two commits, the regressions are listed and
+the exit code is 1 if there are any:
+
+    python -m benchmarks.benchmark compare baseline.json current.json
+"""
+
+__author__ = "Ahmed Albuni"
+__email__ = "ahmed.albuni@gmail.com"
+
+
+import argparse
+import datetime
+import json
+import logging
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+
+# The experiment draws its heat-maps without a display.
+os.environ.setdefault("MPLBACKEND", "Agg")
+
+import numpy as np  # noqa: E402
+import pandas as pd  # noqa: E402
+import sklearn  # noqa: E402
+from joblib.externals.loky import get_reusable_executor  # noqa: E402
+from pandas import DataFrame  # noqa: E402
+from sklearn.base import clone  # noqa: E402
+
+from experiment.comparison_schemes import cross_validation  # noqa: E402
+from experiment.experiment import experiment, get_models  # noqa: E402
+from utils.cache import clear_stores  # noqa: E402
+from utils.classifiers import get_classifiers  # noqa: E402
+from utils.features_selectors import get_features_selectors  # noqa: E402
+
+# The (rows, features) matrices of the presets.
+SIZES = {
+    "small": ((100, 1000), (20, 200)),
+    "medium": ((100, 1000, 10000), (20, 200, 1000)),
+    "large": ((100, 1000, 10000, 100000), (20, 200, 1000, 5000)),
+}
+BENCHMARKS = ("selectors", "cross_validation", "experiment")
+# ReliefF stores the distances between all the samples.
+MAX_RELIEFF_SAMPLES = 20000
+# The metrics compared between two runs, the memory of the child
+# processes is only measured on Linux.
+METRICS = ("seconds", "peak_memory_mb", "children_peak_rss_mb")
+
+path_config = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    "config.json",
+)
+
+
+def make_radiomics_data(
+    n_samples: int,
+    n_features: int,
+    block_size: int = 10,
+    correlation: float = 0.9,
+    n_informative_blocks: int = 3,
+    random_state: int = 0,
+):
+    """
+    Generate a binary classification dataset shaped like radiomics data.
+
+    The features come in blocks of strongly correlated features, such as
+    the same texture feature computed with different settings, and have
+    very different scales and offsets. The response depends on the latent
+    factors of a few blocks.
+
+    Args:
+        n_samples: The number of samples.
+        n_features: The number of features.
+        block_size: The number of features in each correlated block.
+        correlation: The correlation between the features of a block.
+        n_informative_blocks: The number of blocks the response depends
+            on.
+        random_state: Seed of the pseudo-random number generator.
+
+    Returns:
+        (tuple): X, y and the columns names.
+
+    """
+    rng = np.random.RandomState(random_state)
+    n_blocks = int(np.ceil(n_features / block_size))
+    factors = rng.standard_normal((n_samples, n_blocks))
+    X = np.empty((n_samples, n_features))
+    for block in range(n_blocks):
+        columns = slice(block * block_size, (block + 1) * block_size)
+        n_columns = X[:, columns].shape[1]
+        X[:, columns] = np.sqrt(correlation) * factors[
+            :, block, None
+        ] + np.sqrt(1 - correlation) * rng.standard_normal(
+            (n_samples, n_columns)
+        )
+    X *= 10 ** rng.uniform(-2, 3, n_features)
+    X += rng.uniform(-100, 100, n_features)
+    informative = rng.choice(
+        n_blocks, min(n_informative_blocks, n_blocks), replace=False
+    )
+    logits = factors[:, informative].sum(axis=1)
+    y = (logits + rng.logistic(size=n_samples) > 0).astype(int)
+    columns_names = [
+        f"block{i // block_size}_feature{i % block_size}"
+        for i in range(n_features)
+    ]
+    return X, y, columns_names
+
+
+def get_config(n_features: int, seed: int = 0):
+    """Returns the sample configurations of the repository, with a small
+    search and the number of selected features fitted to n_features."""
+
+    with open(path_config) as config_file:
+        config = json.load(config_file)
+    config["config"].update(
+        CV=3, MAX_EVALS=5, N_JOBS=1, SEED=seed, DATA_CACHE=False
+    )
+    k_from, k_to = max(1, min(10, n_features // 2)), min(35, n_features)
+    selectors = config["config"]["selectors"]
+    selectors["ReliefF"]["n_features_to_select_from"] = k_from
+    selectors["ReliefF"]["n_features_to_select_to"] = k_to
+    for name in ("mutual_info", "fisher_score"):
+        selectors[name]["param_from"] = k_from
+        selectors[name]["param_to"] = k_to
+    return config
+
+
+def measure(func, repeat: int = 1):
+    """
+    Time a function and measure its peak memory.
+
+    The function is timed repeat times without tracing, and run once more
+    to measure its memory. tracemalloc, which slows down the Python code,
+    gives the peak of the memory allocated in this process only. The
+    workers of the cells and of the searches are other processes, their
+    resident memory is sampled every 0.1 s from /proc on Linux, and the
+    peak of its sum over the child processes is reported. The memory they
+    share, such as the memory maps of the dataset, is counted in each of
+    them. The caches of the fitted transformers are cleared, and the idle
+    workers of the previous runs stopped, before each run.
+
+    Returns:
+        (tuple): The best time in seconds, the peak memory allocated in
+            this process in MB, and the peak resident memory of the child
+            processes in MB, None if it can not be read.
+
+    """
+    seconds = []
+    for _ in range(repeat):
+        clear_stores()
+        start_time = time.perf_counter()
+        func()
+        seconds.append(time.perf_counter() - start_time)
+    clear_stores()
+    get_reusable_executor().shutdown(wait=True)
+    children = _ChildrenMemory()
+    tracemalloc.start()
+    try:
+        with children:
+            func()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    children_peak = None
+    if children.peak is not None:
+        children_peak = children.peak / 2 ** 20
+    return min(seconds), peak / 2 ** 20, children_peak
+
+
+class _ChildrenMemory:
+    # Sample the summed resident memory of the descendants of this
+    # process in a thread, and keep its peak in bytes.
+
+    def __init__(self, interval=0.1):
+        self.interval = interval
+        self.peak = 0 if os.path.isdir("/proc/self") else None
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+
+    def __enter__(self):
+        if self.peak is not None:
+            self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        if self.peak is not None:
+            self._stop.set()
+            self._thread.join()
+
+    def _sample(self):
+        while True:
+            self.peak = max(self.peak, _children_rss())
+            if self._stop.wait(self.interval):
+                return
+
+
+def _children_rss():
+    # The resident memory in bytes of the descendants of this process.
+    children = dict()
+    for name in os.listdir("/proc"):
+        if not name.isdigit():
+            continue
+        try:
+            with open(os.path.join("/proc", name, "stat")) as infile:
+                stat = infile.read()
+        except OSError:
+            # The process exited.
+            continue
+        # The parent follows the state, after the command in parentheses.
+        parent = int(stat.rsplit(")", 1)[1].split()[1])
+        children.setdefault(parent, []).append(name)
+    rss = 0
+    pids = list(children.get(os.getpid(), []))
+    while pids:
+        pid = pids.pop()
+        pids.extend(children.get(int(pid), []))
+        try:
+            with open(os.path.join("/proc", pid, "statm")) as infile:
+                rss += int(infile.read().split()[1])
+        except OSError:
+            continue
+    return rss * os.sysconf("SC_PAGE_SIZE")
+
+
+def get_benchmarks(
+    X, y, columns_names, benchmarks=BENCHMARKS, max_experiment_size=2e6
+):
+    """Returns the name and function of each benchmark for a dataset, or
+    the reason why it is skipped."""
+
+    n_samples, n_features = X.shape
+    config = get_config(n_features)
+    k = min(10, n_features)
+    cases = []
+    if "selectors" in benchmarks:
+        feature_list = get_features_selectors(config)
+        params = {
+            "relief_f": dict(n_features_to_select=k, n_neighbors=3),
+            "mutual_info": dict(param=k),
+            "fisher_score": dict(param=k),
+            "variance_threshold": dict(threshold=0.5),
+        }
+        for key, step_params in params.items():
+            name, selector = feature_list[key][0]
+            if key == "relief_f" and n_samples > MAX_RELIEFF_SAMPLES:
+                cases.append((f"selector:{name}", "too many samples"))
+                continue
+            selector = clone(selector).set_params(**step_params)
+            cases.append(
+                (f"selector:{name}", lambda s=selector: s.fit(X, y))
+            )
+    if "cross_validation" in benchmarks:
+        feature_list = get_features_selectors(config)
+        models, hparams = get_models(
+            "mutual_info",
+            feature_list["mutual_info"],
+            get_classifiers(config),
+        )
+        cases.append(
+            (
+                "cross_validation:lr+mutual_info_classif",
+                lambda: cross_validation(
+                    X=X,
+                    y=y,
+                    columns_names=columns_names,
+                    experiment_id="lr",
+                    model=models["lr"],
+                    hparams=hparams["lr"],
+                    df=DataFrame(dtype="float"),
+                    selector="mutual_info_classif",
+                    cv=config["config"]["CV"],
+                    max_evals=config["config"]["MAX_EVALS"],
+                    random_state=0,
+                    verbose=0,
+                ),
+            )
+        )
+    if "experiment" in benchmarks:
+        if n_samples * n_features > max_experiment_size:
+            cases.append(("experiment", "larger than max_experiment_size"))
+        else:
+            cases.append(
+                ("experiment", lambda: _run_experiment(X, y, columns_names))
+            )
+    return cases
+
+
+def _run_experiment(X, y, columns_names):
+    config = get_config(X.shape[1])
+    with tempfile.TemporaryDirectory() as path:
+        config["config"]["features_file"] = os.path.join(path, "data.csv")
+        config["config"]["output_dir"] = os.path.join(path, "run_")
+        data = DataFrame(X, columns=columns_names)
+        data["y"] = y
+        data.to_csv(config["config"]["features_file"], index=False)
+        handlers = list(logging.getLogger().handlers)
+        try:
+            experiment(config, verbose=0)
+        finally:
+            # Close the log file of the run before its directory is
+            # removed.
+            for handler in list(logging.getLogger().handlers):
+                if handler not in handlers:
+                    handler.close()
+                    logging.getLogger().removeHandler(handler)
+
+
+def run(sizes, benchmarks=BENCHMARKS, repeat=1, max_experiment_size=2e6):
+    """
+    Run the benchmarks on synthetic datasets of the given sizes.
+
+    Args:
+        sizes: List of (rows, features) tuples.
+        benchmarks: The benchmarks to run, among BENCHMARKS.
+        repeat: The number of timed runs of each benchmark.
+        max_experiment_size: The largest rows x features dataset the
+            whole experiment is run on.
+
+    Returns:
+        (dict): The environment and the results of the benchmarks.
+
+    """
+    results = []
+    for n_samples, n_features in sizes:
+        X, y, columns_names = make_radiomics_data(n_samples, n_features)
+        for name, func in get_benchmarks(
+            X, y, columns_names, benchmarks, max_experiment_size
+        ):
+            result = dict(
+                benchmark=name, n_samples=n_samples, n_features=n_features
+            )
+            if isinstance(func, str):
+                result["skipped"] = func
+            else:
+                seconds, peak_mb, children_mb = measure(func, repeat)
+                result.update(
+                    seconds=round(seconds, 4),
+                    samples_per_second=round(n_samples / seconds, 1),
+                    peak_memory_mb=round(peak_mb, 2),
+                    children_peak_rss_mb=None
+                    if children_mb is None
+                    else round(children_mb, 2),
+                )
+            print(result, flush=True)
+            results.append(result)
+    return dict(environment=_environment(), results=results)
+
+
+def compare(baseline: dict, current: dict, tolerance: float = 0.25):
+    """
+    Compare the results of two benchmark runs.
+
+    Args:
+        baseline: The results of the reference run.
+        current: The results of the new run.
+        tolerance: The relative increase of the time or of a peak
+            memory that is reported as a regression.
+
+    Returns:
+        (list): The regressions, a message each.
+
+    """
+    reference = {_key(r): r for r in baseline["results"]}
+    regressions = []
+    for result in current["results"]:
+        previous = reference.get(_key(result))
+        if previous is None or "skipped" in result or "skipped" in previous:
+            continue
+        for metric in METRICS:
+            before, after = previous.get(metric), result.get(metric)
+            if before is None or after is None:
+                continue
+            if after > before * (1 + tolerance):
+                regressions.append(
+                    "{} {}x{}: {} {} -> {} ({:+.0%})".format(
+                        result["benchmark"],
+                        result["n_samples"],
+                        result["n_features"],
+                        metric,
+                        before,
+                        after,
+                        after / before - 1 if before > 0 else np.inf,
+                    )
+                )
+    return regressions
+
+
+def _key(result):
+    return result["benchmark"], result["n_samples"], result["n_features"]
+
+
+def _environment():
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+            cwd=os.path.dirname(path_config),
+        ).stdout.strip()
+    except OSError:
+        commit = ""
+    return dict(
+        commit=commit,
+        date=str(datetime.datetime.now()),
+        platform=platform.platform(),
+        python=platform.python_version(),
+        numpy=np.__version__,
+        pandas=pd.__version__,
+        sklearn=sklearn.__version__,
+        cpu_count=os.cpu_count(),
+    )
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Benchmarks of the experiment engine"
+    )
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    parser_run = subparsers.add_parser("run", help="Run the benchmarks")
+    parser_run.add_argument(
+        "-sizes",
+        choices=sorted(SIZES),
+        default="small",
+        help="Preset of the rows and features of the datasets",
+    )
+    parser_run.add_argument(
+        "-rows", type=int, nargs="+", help="Rows of the datasets"
+    )
+    parser_run.add_argument(
+        "-features", type=int, nargs="+", help="Features of the datasets"
+    )
+    parser_run.add_argument(
+        "-benchmarks",
+        nargs="+",
+        choices=BENCHMARKS,
+        default=list(BENCHMARKS),
+        help="The benchmarks to run",
+    )
+    parser_run.add_argument(
+        "-repeat", type=int, default=1, help="Timed runs of each benchmark"
+    )
+    parser_run.add_argument(
+        "-max_experiment_size",
+        type=float,
+        default=2e6,
+        help="Largest rows x features dataset the experiment is run on",
+    )
+    parser_run.add_argument(
+        "-output", type=str, required=True, help="The JSON results file"
+    )
+    parser_compare = subparsers.add_parser(
+        "compare", help="Compare two results files"
+    )
+    parser_compare.add_argument("baseline", type=str)
+    parser_compare.add_argument("current", type=str)
+    parser_compare.add_argument(
+        "-tolerance",
+        type=float,
+        default=0.25,
+        help="Relative increase reported as a regression",
+    )
+    args = parser.parse_args(argv)
+
+    if args.command == "run":
+        rows, features = SIZES[args.sizes]
+        sizes = [
+            (n_samples, n_features)
+            for n_samples in args.rows or rows
+            for n_features in args.features or features
+        ]
+        results = run(
+            sizes, args.benchmarks, args.repeat, args.max_experiment_size
+        )
+        with open(args.output, "w") as outfile:
+            json.dump(results, outfile, indent=2)
+        return 0
+
+    with open(args.baseline) as infile:
+        baseline = json.load(infile)
+    with open(args.current) as infile:
+        current = json.load(infile)
+    regressions = compare(baseline, current, args.tolerance)
+    for regression in regressions:
+        print("REGRESSION " + regression)
+    if not regressions:
+        print("No regressions")
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -14,15 +14,27 @@ __email__ = "ahmed.albuni@gmail.com"
 
 
 import os
+import shutil
+import tempfile
+import time
 from collections import OrderedDict
 from datetime import datetime
+from functools import partial
 from multiprocessing import cpu_count
 
 import numpy as np
 from pandas import DataFrame
-from sklearn.model_selection import RandomizedSearchCV
+from sklearn.base import clone
+from sklearn.pipeline import Pipeline
 
-from utils import ioutil
+from experiment.search import get_search, search_space_size
+from utils import ioutil, oof, shared_data
+from utils.fit_timeout import TimeoutPipeline, TimeoutScorer
+from utils.warm_start import (
+    WARM_START_PARAMS,
+    WarmStartPipeline,
+    clear_paths,
+)
 
 
 def cross_validation(
@@ -35,12 +47,22 @@ def cross_validation(
     df: DataFrame,
     selector: str,
     score_func: str = "roc_auc",
-    cv: int = 10,
+    cv=10,
     max_evals: int = 100,
     verbose: int = 1,
     random_state=None,
     path_tmp_results: str = None,
     n_jobs: int = 1,
+    search: str = "random",
+    time_budget: float = None,
+    deadline: float = None,
+    fit_timeout: float = None,
+    warm_start: bool = False,
+    path_results_log: str = None,
+    path_models: str = None,
+    path_predictions: str = None,
+    all_predictions: bool = False,
+    refit: str = "full",
 ):
     """
     A cross-validtion model comparison.
@@ -55,13 +77,42 @@ def cross_validation(
         df:
         selector:
         score_func: Optimisation objective.
-        cv (int): The number of cross-validation folds.
+        cv: The number of cross-validation folds, or the splitter of the
+            folds.
         random_state: A list of seed values for pseudo-random number
             generator.
         max_evals:
         verbose:
         path_tmp_results: Reference to preliminary experimental results.
         n_jobs:
+        search: The hyper-parameter search strategy, "random", "halving",
+            "tpe" or "racing".
+        time_budget: Seconds after which the search stops evaluating new
+            candidates.
+        deadline: Time (as time.time()) after which the search stops
+            evaluating new candidates, the end of the global budget.
+        fit_timeout: Seconds after which a single fit is stopped, the
+            candidate is then scored as a failed fit.
+        warm_start: Order the candidates along the warm start param of
+            the classifier, and start each fit from the previous one on
+            the same fold, the candidates of the search are then
+            evaluated one after the other. Not used with fit_timeout.
+        path_results_log: Directory of the JSON Lines logs with the
+            params, fold scores and times of every evaluated candidate,
+            one file per cell and seed, appended as the candidates
+            finish.
+        path_models: Directory where the best pipeline refitted on all
+            the data is stored, with its manifest, to score new data
+            without refitting (see experiment.predict).
+        path_predictions: Directory where the out-of-fold predictions of
+            the best candidate are stored, to compute other metrics
+            without refitting (see experiment.metrics).
+        all_predictions: Store the out-of-fold predictions of all the
+            candidates.
+        refit: "full" refits the best candidate on all the data, "lazy"
+            reads its selected features from its fits on the training
+            folds instead, and stores it unfitted, it is refitted when
+            it is first used (see experiment.predict).
 
     Returns:
         (dict):
@@ -74,7 +125,8 @@ def cross_validation(
         path_case_file = ""
     else:
         path_case_file = os.path.join(
-            path_tmp_results, f"experiment_{random_state}_{experiment_id}"
+            path_tmp_results,
+            f"experiment_{random_state}_{selector}_{experiment_id}",
         )
     # Throughput written to file.
     output = {"random_state": random_state, "model_name": experiment_id}
@@ -84,13 +136,102 @@ def cross_validation(
     if verbose > 0:
         print(f"Running experiment {random_state} with {experiment_id}")
 
-    # Set random state for the model.
-    # model.random_state = random_state
+    # Set random state for the model, the fitted steps may be shared
+    # between cells (see utils.cache), so they should not depend on the
+    # state of the global random number generator.
+    model = clone(model).set_params(
+        **{
+            f"{name}__random_state": random_state
+            for name, step in model.steps
+            if step is not None and "random_state" in step.get_params()
+        }
+    )
+
+    # The searches evaluate new candidates until the earliest of the cell
+    # and the global budgets runs out.
+    if time_budget is not None:
+        cell_deadline = time.time() + time_budget
+        if deadline is not None:
+            cell_deadline = min(cell_deadline, deadline)
+    else:
+        cell_deadline = deadline
+    # Run every fit of the search in a process that can be stopped, the
+    # fits that time out are scored NaN.
+    base_model = model
+    scoring = score_func
+    warm_start_param = None
+    fit_params = dict()
+    if fit_timeout is not None:
+        # The fit process reads the rows of each fold from the file mapped
+        # by X, if any, instead of receiving a copy of them.
+        path_X = shared_data.mapped_file(X)
+        model = TimeoutPipeline(
+            model.steps,
+            fit_timeout=fit_timeout,
+            path_X=path_X,
+            memory=model.memory,
+        )
+        scoring = TimeoutScorer(score_func)
+        if path_X is not None:
+            fit_params["rows"] = np.arange(len(X))
+    elif warm_start:
+        # Order the candidates along a param of the classifier, and start
+        # each fit from the previous one.
+        warm_start_param = _warm_start_param(model, hparams)
+        if warm_start_param is not None:
+            model = WarmStartPipeline(model.steps, memory=model.memory)
+            # The fits of the previous cells of this process are not
+            # continued.
+            clear_paths()
+
+    # Log every candidate as soon as it is evaluated, a rerun of the cell
+    # starts a new log.
+    results_log = None
+    if path_results_log is not None:
+        os.makedirs(path_results_log, exist_ok=True)
+        path_log_file = os.path.join(
+            path_results_log,
+            f"{selector}__{experiment_id}__{random_state}.jsonl",
+        )
+        open(path_log_file, "w").close()
+        results_log = partial(
+            ioutil.append_results_log,
+            path_log_file,
+            {
+                "selector": selector,
+                "model_name": experiment_id,
+                "random_state": random_state,
+            },
+        )
 
     # Record model training and validation performance.
 
     selected_features = ""
     extras = ""
+    # The scorer records the predictions of the candidates on the test
+    # folds, and without refit the outputs of their selector.
+    path_records = None
+    if path_predictions is not None:
+        path_records = os.path.join(
+            path_predictions, f".{selector}__{experiment_id}__{random_state}"
+        )
+    elif refit == "lazy":
+        path_records = tempfile.mkdtemp()
+    if path_records is not None:
+        test_fold = oof.setup_predictions(path_records, X, y, cv)
+        # The recorder finds the test fold of each fit from the rows of
+        # the dataset it is fitted on.
+        if type(model) is Pipeline:
+            model = oof.RowsPipeline(model.steps, memory=model.memory)
+        fit_params["rows"] = np.arange(len(X))
+        scoring = oof.PredictionRecorder(
+            scoring,
+            path_records,
+            hparams or {},
+            predictions=path_predictions is not None,
+            selector=selector if refit == "lazy" else None,
+        )
+
     # Set the number of workers to use for parallelisation.
     if n_jobs > cpu_count():
         n_jobs = cpu_count()
@@ -98,21 +239,82 @@ def cross_validation(
         n_jobs = 1
     # n_jobs = cpu_count() - 1 if cpu_count() > 1 else 1
     # Find optimal hyper-parameters with K-folds.
-    optimizer = RandomizedSearchCV(
+    optimizer = get_search(
+        search,
         estimator=model,
-        param_distributions=hparams,
+        hparams=hparams,
         n_iter=max_evals,
-        scoring=score_func,
+        selector=selector,
+        scoring=scoring,
         cv=cv,
-        return_train_score=True,
         n_jobs=n_jobs,
+        random_state=random_state,
+        deadline=cell_deadline,
+        refit=False,
+        warm_start=warm_start_param,
+        results_log=results_log,
     )
-    optimizer.fit(X, y)
+    search_start_time = time.time()
+    optimizer.fit(X, y, **fit_params)
+    search_time = time.time() - search_start_time
+    if path_predictions is not None:
+        oof.write_predictions(
+            path_records,
+            os.path.join(
+                path_predictions,
+                f"{selector}__{experiment_id}__{random_state}.npz",
+            ),
+            optimizer.cv_results_,
+            optimizer.best_index_,
+            y,
+            test_fold,
+            all_candidates=all_predictions,
+            selector=selector,
+            model_name=experiment_id,
+            random_state=random_state,
+            score_func=score_func,
+            test_score=optimizer.best_score_,
+        )
+    fold_selection = None
+    if refit == "lazy" and not np.isnan(optimizer.best_score_):
+        fold_selection = oof.read_fold_selection(
+            path_records, optimizer.best_params_
+        )
+    if path_records is not None:
+        shutil.rmtree(path_records, ignore_errors=True)
     # Include the optimal hyper-parameters in the output.
     output.update(**optimizer.best_params_)
-    best_model = optimizer.best_estimator_
+    # Refit the best candidate on all the data, without the fit timeout.
+    # If all the candidates failed there is no best model.
+    best_model = None
+    refit_selector_time, refit_classifier_time = 0.0, 0.0
+    if not np.isnan(optimizer.best_score_):
+        best_model = clone(base_model).set_params(**optimizer.best_params_)
+        if refit == "full":
+            refit_selector_time, refit_classifier_time = timed_fit(
+                best_model, X, y
+            )
 
-    if selector != "No_feature_selection":
+    input_columns = columns_names
+    # The features removed by the correlation filter, the selector only
+    # sees the remaining ones.
+    removed_features = []
+    if fold_selection is not None:
+        # The features selected, or removed, in at least half of the
+        # folds, and the scores averaged over the folds.
+        selected_features, extras, removed_features = _fold_features(
+            fold_selection, selector, columns_names
+        )
+    elif best_model is not None and "CorrelationFilter" in model.named_steps:
+        support = best_model.named_steps["CorrelationFilter"].get_support()
+        removed_features = get_feature_names(~support, columns_names)
+        columns_names = get_feature_names(support, columns_names)
+
+    if (
+        fold_selection is None
+        and best_model is not None
+        and selector != "No_feature_selection"
+    ):
         features = best_model.named_steps[selector]
         if selector == "ReliefF" or selector == "MultiSURF":
             selected_features = get_selected_features_relieff(
@@ -131,9 +333,6 @@ def cross_validation(
                 extras = "feature_variances: " + ", ".join(append_feature_name(
                     features.variances_, columns_names
                 ))
-            elif selector == "fisher_score":
-                pass
-                # the fisher score used doesn't provide the scores
             else:
                 extras = "feature_scores: " + ", ".join(append_feature_name(
                     features.scores_, columns_names
@@ -169,26 +368,170 @@ def cross_validation(
                 ),
                 ("selected features ", ", ".join(selected_features),),
                 ("features scores/importance ", extras,),
+                (
+                    "n_candidates_evaluated",
+                    len(optimizer.cv_results_["params"]),
+                ),
+                ("search_space_size", search_space_size(hparams or {})),
+                (
+                    "timed_out_candidates",
+                    "; ".join(
+                        str(params)
+                        for params, timed_out in zip(
+                            optimizer.cv_results_["params"],
+                            optimizer.cv_results_["timed_out"],
+                        )
+                        if timed_out
+                    ),
+                ),
             ]
         )
     )
+    if "pruned" in optimizer.cv_results_:
+        # The candidates dropped by the racing search, and the number of
+        # fold fits of all the candidates.
+        output["pruned_candidates"] = "; ".join(
+            str(params)
+            for params, pruned in zip(
+                optimizer.cv_results_["params"],
+                optimizer.cv_results_["pruned"],
+            )
+            if pruned
+        )
+        output["n_fold_fits"] = int(
+            optimizer.cv_results_["n_folds_evaluated"].sum()
+        )
+    if "CorrelationFilter" in model.named_steps:
+        output["removed correlated features"] = ", ".join(removed_features)
+    # Timings in seconds, the fold fit and score times of the best
+    # candidate, the time of the whole search, and the refit time of the
+    # scaler and selector steps and of the classifier.
+    duration = datetime.now() - start_time
+    days = duration.days
+    hours, rem = divmod(duration.seconds, 3600)
+    minutes, seconds = divmod(rem, 60)
+    output.update(
+        OrderedDict(
+            [
+                (
+                    "fit_time",
+                    "{:.3f}".format(
+                        optimizer.cv_results_["mean_fit_time"][
+                            optimizer.best_index_
+                        ]
+                    ),
+                ),
+                (
+                    "score_time",
+                    "{:.3f}".format(
+                        optimizer.cv_results_["mean_score_time"][
+                            optimizer.best_index_
+                        ]
+                    ),
+                ),
+                ("search_time", "{:.3f}".format(search_time)),
+                ("refit_selector_time", "{:.3f}".format(refit_selector_time)),
+                (
+                    "refit_classifier_time",
+                    "{:.3f}".format(refit_classifier_time),
+                ),
+                ("cell_time", "{:.3f}".format(duration.total_seconds())),
+                (
+                    "exp_duration",
+                    "{} days {:02d}:{:02d}:{:02d}".format(
+                        days, hours, minutes, seconds
+                    ),
+                ),
+            ]
+        )
+    )
+    if path_models is not None and best_model is not None:
+        ioutil.write_model(
+            path_models,
+            f"{selector}__{experiment_id}__{random_state}",
+            best_model,
+            {
+                "selector": selector,
+                "model_name": experiment_id,
+                "random_state": random_state,
+                "score_func": score_func,
+                "test_score": test_scores,
+                "params": optimizer.best_params_,
+                "features": input_columns,
+                "selected_features": selected_features,
+                "classes": np.unique(y),
+                "fitted": refit == "full",
+                "created": datetime.now().isoformat(timespec="seconds"),
+            },
+        )
     df.at[experiment_id, selector] = test_scores
     if path_tmp_results is not None:
         ioutil.write_prelim_results(path_case_file, output)
 
         if verbose > 0:
-            duration = datetime.now() - start_time
-            days = duration.days
-            hours, rem = divmod(duration.seconds, 3600)
-            minutes, seconds = divmod(rem, 60)
-
             print(f"Experiment {random_state} completed in {duration}")
-            output["exp_duration"] = "{} days {:02d}:{:02d}:{:02d}".format(
-                days, hours, minutes, seconds
-            )
     return output, df, selected_features
 
 
+def timed_fit(model: Pipeline, X: np.ndarray, y: np.ndarray):
+    """
+    Fit a pipeline, timing the transformer steps and the final classifier
+    apart.
+
+    Args:
+        model: The scikit-learn Pipeline.
+        X: Feature matrix (n samples x n features).
+        y: Ground truth vector (n samples).
+
+    Returns:
+        (tuple): The fit times in seconds of the transformers (scaler and
+            selector) and of the classifier.
+
+    """
+    start_time = time.time()
+    transformers = Pipeline(model.steps[:-1], memory=model.memory)
+    Xt = transformers.fit_transform(X, y)
+    # The transformers may have been replaced by fitted copies from the
+    # cache.
+    model.steps[:-1] = transformers.steps
+    transformers_time = time.time() - start_time
+    model.steps[-1][1].fit(Xt, y)
+    return transformers_time, time.time() - start_time - transformers_time
+
+
+def _warm_start_param(model: Pipeline, hparams: dict):
+    # The searched param along which the classifier can be warm started.
+    name, classifier = model.steps[-1]
+    param = WARM_START_PARAMS.get(type(classifier).__name__)
+    if param is None or f"{name}__{param}" not in (hparams or {}):
+        return None
+    return f"{name}__{param}"
+
+
+def _fold_features(fold_selection, selector, columns_names):
+    # The selected features, their scores and the removed correlated
+    # features of the best candidate, from the folds.
+    selected_features, extras, removed_features = [], "", []
+    if fold_selection["removed"] is not None:
+        removed_features = get_feature_names(
+            fold_selection["removed"] >= 0.5, columns_names
+        )
+    if fold_selection["selected"] is not None:
+        selected_features = get_feature_names(
+            fold_selection["selected"] >= 0.5, columns_names
+        )
+        if selector == "ReliefF" or selector == "MultiSURF":
+            name = "feature_importance: "
+        elif selector == "VarianceThreshold":
+            name = "feature_variances: "
+        else:
+            name = "feature_scores: "
+        extras = name + ", ".join(
+            append_feature_name(fold_selection["scores"], columns_names)
+        )
+    return selected_features, extras, removed_features
+
+
 def get_feature_names(selector_array, features_list):
     selected_features = []
     for i, val in enumerate(selector_array):
@@ -12,27 +12,44 @@ __email__ = "ahmed.albuni@gmail.com"
 
 
 import datetime
+import json
 import logging
 import os
 import time
 from collections import Counter
 from pathlib import Path
 
-import matplotlib.pyplot as plt
+import joblib
 import numpy
 import pandas as pd
-import seaborn as sns
 from pandas import DataFrame
 from sklearn.pipeline import Pipeline
 from sklearn.preprocessing import StandardScaler
 
-from experiment.model_comparison import model_comparison_experiment
-from utils import classifiers, features_selectors
+from experiment.model_comparison import repeated_comparison_experiment
+from utils import classifiers, features_selectors, ioutil
+from utils.cache import TransformerCache
+from utils.features_selectors import CorrelationFilter
 
+# The settings that do not change the results of the cells, a run can be
+# resumed with other values. The features file is compared by its data.
+RESUME_IGNORED = ("output_dir", "features_file", "N_JOBS", "CACHE_MB")
 
-def experiment(config, verbose=1):
-    path = config["config"]["output_dir"] + str(time.strftime("%Y%m%d-%H%M%S"))
-    os.mkdir(path)
+
+def experiment(config, verbose=1, resume=None, path_queue=None):
+    # Resume an interrupted experiment in its output directory, the cells
+    # stored in its checkpoints are not run again. With a path_queue, the
+    # cells are run by the workers that share this directory.
+    if resume is None:
+        path = config["config"]["output_dir"] + str(
+            time.strftime("%Y%m%d-%H%M%S")
+        )
+        os.mkdir(path)
+        with open(Path(path, "config.json"), "w") as config_file:
+            json.dump(config, config_file, indent=2)
+    else:
+        # The stored configuration of the run is kept.
+        path = resume
     path_to_log_file = Path(
         path, "log_" + str(time.strftime("%Y%m%d-%H%M%S")),
     ).with_suffix(".log")
@@ -45,31 +62,79 @@ def experiment(config, verbose=1):
 
     # The number cross-validation folds.
     CV = config["config"]["CV"]
-    # The number of times each experiment is repeated with a different
-    # random seed.
-    random_state = config["config"]["SEED"]
+    # The experiment is repeated with each random seed.
+    random_states = get_random_states(config)
     # setting the random seed globally to reproduce the results, setting
     # this value in the RandomizedSearchCV will did not provide that,
     # number of jobs should be 1 to get the exact results each time
-    numpy.random.seed(random_state)
+    numpy.random.seed(random_states[0])
     # The number of hyper-parameter configurations to try evaluating.
     MAX_EVALS = config["config"]["MAX_EVALS"]
     # N_Jobs for parallelisation
     n_jobs = config["config"]["N_JOBS"]
     # Score function
     score_fun = config["config"]["SCORE_FUN"]
-    # Read from the CSV file that contains the features and the response.
-    X, y, columns_names = read_Xy_data(config["config"]["features_file"])
+    # Hyper-parameter search strategy, random search, successive halving,
+    # tpe or racing.
+    search = config["config"].get("SEARCH", "random")
+    # Time budgets in seconds, of the search in each cell and of the whole
+    # experiment, and timeout of a single fit.
+    time_budget = config["config"].get("TIME_BUDGET")
+    total_time_budget = config["config"].get("TOTAL_TIME_BUDGET")
+    fit_timeout = config["config"].get("FIT_TIMEOUT")
+    # Warm start the fits along the regularisation path of the classifier.
+    warm_start = config["config"].get("WARM_START", False)
+    deadline = None
+    if total_time_budget is not None:
+        deadline = time.time() + total_time_budget
+    # Size limit in MB of the cache of fitted scalers and selectors.
+    cache_mb = config["config"].get("CACHE_MB", 512)
+    # The features correlated above this threshold with a previous feature
+    # are removed in each fold before the scaler and the selectors.
+    correlation_threshold = config["config"].get("CORRELATION_THRESHOLD")
+    # Store the best pipeline of each cell to score new data.
+    save_models = config["config"].get("SAVE_MODELS", True)
+    # Store the out-of-fold predictions of the best candidate of each cell,
+    # or of all the candidates, to compute other metrics without refitting.
+    oof_predictions = config["config"].get("OOF_PREDICTIONS", "none")
+    path_predictions = None
+    if oof_predictions != "none":
+        path_predictions = Path(path, "predictions")
+    # Refit the best candidate of each cell on all the data, or read its
+    # selected features from the folds and refit it when it is used.
+    refit = config["config"].get("REFIT", "full")
+    # Read from the CSV file that contains the features and the response,
+    # or memory-map it from its binary cache.
+    X, y, columns_names = read_Xy_data(
+        config["config"]["features_file"],
+        cache=config["config"].get("DATA_CACHE", False),
+        float32=config["config"].get("FLOAT32", False),
+    )
+    # The checkpoints of the finished cells are only reused with the same
+    # settings and data.
+    fingerprint = get_fingerprint(config, X, y, columns_names)
+    path_fingerprint = Path(path, "fingerprint.txt")
+    if resume is None:
+        path_fingerprint.write_text(fingerprint)
+    elif (
+        not path_fingerprint.is_file()
+        or path_fingerprint.read_text() != fingerprint
+    ):
+        raise ValueError(
+            f"The settings or the data differ from the ones of {path}, "
+            "start a new run instead of resuming it."
+        )
 
     # Get lists of feature selectors and classifier to be used in the pipeline.
     feature_list = features_selectors.get_features_selectors(config)
     classifier_list = classifiers.get_classifiers(config)
 
-    # df to store the results for the final graph of the cross-validation.
-    scores_df = DataFrame(dtype="float")
-    all_selected_features = list()
+    # The scaler and selector steps are fitted once per fold and selector
+    # params, and shared between the classifiers.
+    memory = TransformerCache(max_bytes=cache_mb * 2 ** 20)
 
-    # Loop over the feature selectors.
+    # Loop over the feature selectors and prepare the grid of pipelines.
+    grid = dict()
     for feature_selector_k, feature_selector_v in feature_list.items():
         path_to_results = Path(
             path,
@@ -81,26 +146,40 @@ def experiment(config, verbose=1):
 
         # Loop over the classifiers and prepare the pipelines
         models, hparams = get_models(
-            feature_selector_k, feature_selector_v, classifier_list
+            feature_selector_k,
+            feature_selector_v,
+            classifier_list,
+            memory,
+            correlation_threshold,
         )
+        grid[feature_selector_v[0][0]] = (models, hparams, path_to_results)
 
-        scores_df, selected_features = model_comparison_experiment(
-            models=models,
-            hparams=hparams,
-            path_final_results=path_to_results,
-            random_state=random_state,
-            score_func=score_fun,
-            max_evals=MAX_EVALS,
-            selector=feature_selector_v[0][0],
-            cv=CV,
-            X=X,
-            y=y,
-            columns_names=columns_names,
-            df=scores_df,
-            verbose=verbose,
-            n_jobs=n_jobs,
-        )
-        all_selected_features += selected_features
+    # Run all the (selector, classifier, seed) cells with a global budget
+    # of n_jobs workers.
+    scores, times, selected_features = repeated_comparison_experiment(
+        grid=grid,
+        random_states=random_states,
+        score_func=score_fun,
+        max_evals=MAX_EVALS,
+        cv=CV,
+        X=X,
+        y=y,
+        columns_names=columns_names,
+        verbose=verbose,
+        n_jobs=n_jobs,
+        search=search,
+        path_checkpoints=Path(path, "checkpoints"),
+        path_queue=path_queue,
+        time_budget=time_budget,
+        deadline=deadline,
+        fit_timeout=fit_timeout,
+        warm_start=warm_start,
+        path_results_log=Path(path, "candidates"),
+        path_models=Path(path, "models") if save_models else None,
+        path_predictions=path_predictions,
+        all_predictions=oof_predictions == "all",
+        refit=refit,
+    )
 
     end_time = datetime.datetime.now()
     logger.info("Process end time: " + str(end_time))
@@ -108,6 +187,12 @@ def experiment(config, verbose=1):
     logger.info("JSON file used for configurations: ")
     logger.info(config)
     logging.shutdown()
+    # The features are counted over all the seeds.
+    all_selected_features = [
+        feature
+        for random_state in random_states
+        for feature in selected_features[random_state]
+    ]
     counter_list = (Counter(all_selected_features)).most_common()
     counter_dict = dict(counter_list)
     path_to_features_freq_file = Path(
@@ -116,21 +201,110 @@ def experiment(config, verbose=1):
     with open(path_to_features_freq_file, "w") as f:
         for key in counter_dict.keys():
             f.write("%s,%s\n" % (key, counter_dict[key]))
-    plot_heat_map(scores_df, config, verbose, path)
+    if len(random_states) == 1:
+        scores_df = scores[random_states[0]]
+        if verbose > 0:
+            print(scores_df)
+        plot_heat_map(
+            scores_df, config, verbose, path, times[random_states[0]]
+        )
+        return scores_df
+
+    # The scores of each seed, and the heat-maps of the mean and standard
+    # deviation over the seeds.
+    for random_state in random_states:
+        scores[random_state].to_csv(
+            Path(
+                path,
+                f"heatmap_data_seed{random_state}_"
+                + str(time.strftime("%Y%m%d-%H%M%S")),
+            ).with_suffix(".csv")
+        )
+    scores_df, std_df = mean_std(scores.values())
+    times_df, _ = mean_std(times.values())
+    if verbose > 0:
+        print(scores_df)
+    plot_heat_map(scores_df, config, verbose, path, times_df, std_df)
 
     return scores_df
 
 
+def get_random_states(config):
+    """Returns the seeds of the repeats of the experiment, SEED is a seed
+    or a list of seeds, with N_REPEATS the experiment is repeated with
+    the seeds SEED, SEED + 1, ..."""
+
+    seed = config["config"]["SEED"]
+    if isinstance(seed, list):
+        return list(seed)
+    n_repeats = config["config"].get("N_REPEATS", 1)
+    return [seed + i for i in range(n_repeats)]
+
+
+def mean_std(dfs):
+    """Returns the mean and the standard deviation of dataframes with the
+    same cells, ordered as the first one."""
+
+    dfs = list(dfs)
+    values = numpy.stack([df.reindex_like(dfs[0]).to_numpy() for df in dfs])
+    mean_df = DataFrame(
+        values.mean(axis=0), index=dfs[0].index, columns=dfs[0].columns
+    )
+    std_df = DataFrame(
+        values.std(axis=0, ddof=1), index=dfs[0].index, columns=dfs[0].columns
+    )
+    return mean_df, std_df
+
+
+def get_fingerprint(config, X, y, columns_names):
+    """Returns a hash of the settings of the experiment that change the
+    results of the cells, and of its data."""
+
+    settings = {
+        key: value
+        for key, value in config["config"].items()
+        if key not in RESUME_IGNORED
+    }
+    return joblib.hash(
+        (settings, numpy.asarray(X), numpy.asarray(y), list(columns_names))
+    )
+
+
 def merge_dict(dict1, dict2):
     merged = dict1.copy()
     merged.update(dict2)
     return merged
 
 
-def plot_heat_map(scores_df, config, verbose, path):
+def plot_heat_map(
+    scores_df, config, verbose, path, times_df=None, std_df=None
+):
     # Plot a heat-map of the scores obtained from the various feature
-    # selectors and classifiers.
-    sns.heatmap(scores_df.transpose() * 100, annot=True, fmt=".1f")
+    # selectors and classifiers, annotated with mean ± std over the seeds
+    # if std_df is given. The plotting libraries are only imported here,
+    # the workers never plot.
+    import matplotlib.pyplot as plt
+    import seaborn as sns
+
+    plt.figure()
+    if std_df is None:
+        sns.heatmap(scores_df.transpose() * 100, annot=True, fmt=".1f")
+    else:
+        std_df = std_df.reindex_like(scores_df)
+        # Formatted column by column, DataFrame.map needs pandas 2.1.
+        means = (scores_df * 100).apply(
+            lambda column: column.map("{:.1f}".format)
+        )
+        stds = (std_df * 100).apply(
+            lambda column: column.map("\n±{:.1f}".format)
+        )
+        annot = means + stds
+        sns.heatmap(
+            scores_df.transpose() * 100,
+            annot=annot.transpose().to_numpy(),
+            fmt="",
+            annot_kws={"size": 8},
+        )
     plt.xlabel("Classification Algorithms")
     plt.ylabel("Feature Selection Algorithms")
     plt.title(config["config"]["SCORE_FUN"], x=1.1, y=1.1)
@@ -143,11 +317,55 @@ def plot_heat_map(scores_df, config, verbose, path):
     ).with_suffix(".csv")
     plt.savefig(path_to_image, dpi=200)
     scores_df.to_csv(path_to_csv)
+    if std_df is not None:
+        std_df.to_csv(
+            Path(
+                path,
+                "heatmap_std_data_" + str(time.strftime("%Y%m%d-%H%M%S")),
+            ).with_suffix(".csv")
+        )
+    if times_df is not None:
+        # Companion heat-map of the seconds spent in each cell.
+        times_df = times_df.reindex_like(scores_df)
+        plt.figure()
+        sns.heatmap(times_df.transpose(), annot=True, fmt=".1f")
+        plt.xlabel("Classification Algorithms")
+        plt.ylabel("Feature Selection Algorithms")
+        plt.title("seconds per cell", x=1.1, y=1.1)
+        plt.tight_layout()
+        path_to_image = Path(
+            path, "image_time_" + str(time.strftime("%Y%m%d-%H%M%S")),
+        ).with_suffix(".jpg")
+        path_to_csv = Path(
+            path, "time_heatmap_data_" + str(time.strftime("%Y%m%d-%H%M%S")),
+        ).with_suffix(".csv")
+        plt.savefig(path_to_image, dpi=200)
+        times_df.to_csv(path_to_csv)
     if verbose > 0:
         plt.show()
 
 
-def read_Xy_data(file):
+def read_Xy_data(file, cache=False, float32=False):
+    """
+    Read the features and the response from a CSV file.
+
+    Args:
+        file: Path to the CSV file, the response should be the last field.
+        cache: Memory-map the data from a binary cache stored next to the
+            CSV file (file.csv.cache), the cache is created on the first
+            read and rebuilt when the CSV file changes.
+        float32: Read the features as 32-bit floats, which halves the
+            memory.
+
+    Returns:
+        (tuple): X, y and the columns names of the features.
+
+    """
+    dtype = numpy.float32 if float32 else numpy.float64
+    if cache:
+        cached = ioutil.read_cached_Xy(file, dtype)
+        if cached is not None:
+            return cached
     X_y = pd.read_csv(file)
     # Store column names to be used to get selected features.
     columns_names = X_y.columns.tolist()
@@ -156,29 +374,57 @@ def read_Xy_data(file):
     X = X_y.iloc[:, : X_y.shape[1] - 1].values
     y = X_y.iloc[:, X_y.shape[1] - 1 :].values
     y = y.reshape(-1)
+    if cache:
+        try:
+            ioutil.write_cached_Xy(file, X, y, columns_names)
+            return ioutil.read_cached_Xy(file, dtype)
+        except OSError as error:
+            logging.warning("Could not cache the dataset: " + str(error))
+    if float32:
+        X = X.astype(numpy.float32)
     return X, y, columns_names
 
 
-def get_models(feature_selector_k, feature_selector_v, classifiers_list):
+def get_models(
+    feature_selector_k,
+    feature_selector_v,
+    classifiers_list,
+    memory=None,
+    correlation_threshold=None,
+):
     # Loop over the classifications algorithms.
     scalar = (StandardScaler.__name__, StandardScaler())
     models = dict()
     hparams = dict()
     for classifier_k, classifier_v in classifiers_list.items():
         if feature_selector_k == "No feature selection":
-            models[classifier_k] = Pipeline([scalar, classifier_v[0]])
+            models[classifier_k] = Pipeline(
+                [scalar, classifier_v[0]], memory=memory
+            )
             hparams[classifier_k] = classifier_v[1]
         else:
             # We should not scale the data before VarianceThreshold
             if feature_selector_v[0][0] == "VarianceThreshold":
                 models[classifier_k] = Pipeline(
-                    [feature_selector_v[0], scalar, classifier_v[0]]
+                    [feature_selector_v[0], scalar, classifier_v[0]],
+                    memory=memory,
                 )
             else:
                 models[classifier_k] = Pipeline(
-                    [scalar, feature_selector_v[0], classifier_v[0]]
+                    [scalar, feature_selector_v[0], classifier_v[0]],
+                    memory=memory,
                 )
             hparams[classifier_k] = merge_dict(
                 classifier_v[1], feature_selector_v[1]
             )
+        if correlation_threshold is not None:
+            # The redundant features are removed first, the filter is
+            # fitted once per fold and shared through the memory.
+            models[classifier_k].steps.insert(
+                0,
+                (
+                    CorrelationFilter.__name__,
+                    CorrelationFilter(threshold=correlation_threshold),
+                ),
+            )
     return models, hparams
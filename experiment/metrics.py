@@ -0,0 +1,233 @@
+# -*- coding: utf-8 -*-
+#
+# metrics.py
+#
+
+"""
+Metrics of the stored out-of-fold predictions, with bootstrap confidence
+intervals.
+"""
+
+__author__ = "Ahmed Albuni"
+__email__ = "ahmed.albuni@gmail.com"
+
+
+from pathlib import Path
+
+import numpy as np
+from pandas import DataFrame
+
+from experiment.experiment import plot_heat_map
+from utils.oof import read_predictions
+from validations.validate_config import score_fun_list
+
+
+def compute_metrics(
+    path: str,
+    metrics,
+    n_bootstrap: int = 1000,
+    alpha: float = 0.05,
+    random_state: int = 0,
+    verbose: int = 0,
+):
+    """
+    Compute metrics of the out-of-fold predictions of the best candidate
+    of every cell of an experiment, without fitting any model.
+
+    Each metric is computed from the predictions of all the folds
+    together, and its confidence interval from the percentiles of the
+    metric on n_bootstrap resamples of the samples. All the resamples are
+    scored at once from weighted confusion matrices and ranks, rather
+    than one call of a scikit-learn metric per resample.
+
+    For each metric, the heat-map of the values (averaged over the seeds)
+    is plotted in the metrics/<metric> folder of the output directory,
+    and the values with their confidence intervals are written to
+    metrics/metrics.csv.
+
+    Args:
+        path: The output directory of an experiment.
+        metrics: The metrics, names of validate_config.score_fun_list.
+        n_bootstrap: The number of bootstrap resamples, 0 for no
+            confidence intervals.
+        alpha: The confidence intervals are the alpha / 2 and
+            1 - alpha / 2 percentiles.
+        random_state: The seed of the resamples.
+        verbose: Show the heat-maps.
+
+    Returns:
+        (DataFrame): The value and the confidence interval of each metric
+            for each cell.
+
+    """
+    unknown = [metric for metric in metrics if metric not in score_fun_list]
+    if unknown:
+        raise ValueError(f"Unknown metrics: {', '.join(unknown)}")
+    rows = []
+    for cell in read_predictions(Path(path, "predictions")):
+        evaluated = ~np.isnan(cell["scores"])
+        y = cell["y"][evaluated]
+        labels = cell["labels"][evaluated]
+        scores = cell["scores"][evaluated]
+        # The same resamples for all the cells and metrics.
+        values = {metric: [] for metric in metrics}
+        for weights in bootstrap_weights(len(y), n_bootstrap, random_state):
+            for metric in metrics:
+                values[metric].append(
+                    metric_values(metric, y, labels, scores, weights)
+                )
+        for metric in metrics:
+            value, *resampled = np.concatenate(values[metric])
+            ci_lower, ci_upper = np.nan, np.nan
+            if n_bootstrap > 0:
+                ci_lower, ci_upper = np.nanpercentile(
+                    resampled, [100 * alpha / 2, 100 * (1 - alpha / 2)]
+                )
+            rows.append(
+                dict(
+                    selector=cell["selector"],
+                    model_name=cell["model_name"],
+                    random_state=cell["random_state"],
+                    metric=metric,
+                    value=value,
+                    ci_lower=ci_lower,
+                    ci_upper=ci_upper,
+                    n_samples=len(y),
+                )
+            )
+    results = DataFrame(rows)
+    path_metrics = Path(path, "metrics")
+    path_metrics.mkdir(exist_ok=True)
+    results.to_csv(Path(path_metrics, "metrics.csv"), index=False)
+    for metric in metrics:
+        # Classifiers x selectors, as the heat-map of the experiment.
+        scores_df = (
+            results[results["metric"] == metric]
+            .pivot_table(
+                index="model_name",
+                columns="selector",
+                values="value",
+                aggfunc="mean",
+                sort=False,
+            )
+            .rename_axis(index=None, columns=None)
+        )
+        path_metric = Path(path_metrics, metric)
+        path_metric.mkdir(exist_ok=True)
+        plot_heat_map(
+            scores_df, {"config": {"SCORE_FUN": metric}}, verbose, path_metric
+        )
+    return results
+
+
+def bootstrap_weights(
+    n_samples: int, n_bootstrap: int, random_state=0, batch_size=2 ** 22
+):
+    """
+    The number of times each sample is drawn in each bootstrap resample,
+    by batches of resamples of about batch_size weights.
+
+    Args:
+        n_samples: The number of samples.
+        n_bootstrap: The number of resamples.
+        random_state: The seed of the resamples.
+        batch_size: The number of weights of a batch.
+
+    Yields:
+        (np.ndarray): The weights of a batch (n resamples x n samples),
+            the first row of the first batch is the original sample.
+
+    """
+    rng = np.random.RandomState(random_state)
+    n_rows = max(1, batch_size // max(n_samples, 1))
+    for start in range(0, n_bootstrap + 1, n_rows):
+        stop = min(start + n_rows, n_bootstrap + 1)
+        batch = np.ones((stop - start, n_samples), dtype=np.float32)
+        for i in range(max(start, 1), stop):
+            batch[i - start] = np.bincount(
+                rng.randint(n_samples, size=n_samples), minlength=n_samples
+            )
+        yield batch
+
+
+def metric_values(metric: str, y, labels, scores, weights):
+    """
+    A metric of the predictions weighted by each row of weights.
+
+    Args:
+        metric: Name of the metric, in validate_config.score_fun_list.
+        y: Ground truth vector (n samples), the second class is positive.
+        labels: The predicted classes.
+        scores: The probabilities of the second class, or the decision
+            function.
+        weights: The weights of the samples (n rows x n samples).
+
+    Returns:
+        (np.ndarray): The value of the metric for each row of weights,
+            NaN if it is undefined.
+
+    """
+    classes = np.unique(y)
+    positive = y == classes[-1]
+    if metric == "roc_auc":
+        return _roc_auc(positive, scores, weights)
+    predicted = labels == classes[-1]
+    tp = weights @ (positive & predicted).astype(weights.dtype)
+    fp = weights @ (~positive & predicted).astype(weights.dtype)
+    fn = weights @ (positive & ~predicted).astype(weights.dtype)
+    tn = weights @ (~positive & ~predicted).astype(weights.dtype)
+    total = tp + fp + fn + tn
+    name, _, average = metric.partition("_")
+    if name == "accuracy" or average == "micro":
+        # The micro averages of a binary problem are the accuracy.
+        return _divide(tp + tn, total)
+    value = _confusion_metric(name, tp, fp, fn)
+    if average == "":
+        return value
+    # The negative class as the positive one.
+    negative_value = _confusion_metric(name, tn, fn, fp)
+    if average == "macro":
+        return (value + negative_value) / 2
+    return _divide(value * (tp + fn) + negative_value * (tn + fp), total)
+
+
+def _confusion_metric(name, tp, fp, fn):
+    # As scikit-learn, the undefined ratios are 0.
+    if name == "precision":
+        return _divide(tp, tp + fp)
+    if name == "recall":
+        return _divide(tp, tp + fn)
+    return _divide(2 * tp, 2 * tp + fp + fn)
+
+
+def _divide(numerator, denominator):
+    return np.divide(
+        numerator,
+        denominator,
+        out=np.zeros(np.shape(numerator)),
+        where=denominator > 0,
+    )
+
+
+def _roc_auc(positive, scores, weights):
+    # The probability that a positive sample has a higher score than a
+    # negative one, the ties count half, from the weights of the positive
+    # and negative samples of each distinct score.
+    order = np.argsort(scores, kind="mergesort")
+    sorted_scores = scores[order]
+    starts = np.flatnonzero(
+        np.r_[True, sorted_scores[1:] != sorted_scores[:-1]]
+    )
+    weights = weights[:, order]
+    positive = positive[order]
+    positive_weights = np.add.reduceat(weights * positive, starts, axis=1)
+    negative_weights = np.add.reduceat(weights * ~positive, starts, axis=1)
+    negative_below = np.cumsum(negative_weights, axis=1) - negative_weights
+    pairs = np.sum(
+        positive_weights * (negative_below + negative_weights / 2), axis=1
+    )
+    n_pairs = positive_weights.sum(axis=1) * negative_weights.sum(axis=1)
+    auc = _divide(pairs, n_pairs)
+    # Undefined with a single class.
+    auc[n_pairs == 0] = np.nan
+    return auc
@@ -11,6 +11,16 @@ __author__ = "Severin Langberg, Ahmed Albuni"
 __email__ = "langberg91@gmail.com, ahmed85@gmail.com"
 
 
+import os
+import socket
+import tempfile
+import threading
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from contextlib import ExitStack
+from functools import partial
+from multiprocessing import cpu_count
 from typing import Dict
 
 import numpy as np
@@ -19,6 +29,8 @@ from tqdm import tqdm
 
 from experiment.comparison_schemes import cross_validation
 from utils import ioutil
+from utils.shared_data import SharedDataset
+from utils.work_queue import WorkQueue
 
 
 def model_comparison_experiment(
@@ -36,6 +48,7 @@ def model_comparison_experiment(
     path_final_results: str = None,
     verbose: int = 1,
     n_jobs: int = 1,
+    search: str = "random",
 ):
     """
     Compare model performances with optional feature selection.
@@ -55,41 +68,502 @@ def model_comparison_experiment(
         n_jobs: number of cpu units used for processing
         path_final_results: output directory
         verbose:
+        search: hyper-parameter search strategy, "random", "halving", "tpe"
+            or "racing"
 
     """
-    # Setup temporary directory to store preliminary results.
-    path_tmp_results = ioutil.setup_tempdir("tmp_comparison", root=".")
-
-    # Iterate through models and run experiments in parallel.
-    results = []
-    all_selected_features = list()
-    for model_name, model in tqdm(models.items()):
-
-        # Get hyper-parameters for this model.
-        model_hparams = hparams[model_name]
-        result, df, selected_features = cross_validation(
-            X=X,
-            y=y,
-            columns_names=columns_names,
-            model=model,
-            experiment_id=model_name,
-            hparams=model_hparams,
-            cv=cv,
-            score_func=score_func,
-            max_evals=max_evals,
-            random_state=random_state,
-            path_tmp_results=path_tmp_results,
-            df=df,
-            selector=selector,
-            verbose=verbose,
-            n_jobs=n_jobs,
-        )
-        results.append(result)
-        all_selected_features += selected_features
+    return grid_comparison_experiment(
+        X=X,
+        y=y,
+        columns_names=columns_names,
+        grid={selector: (models, hparams, path_final_results)},
+        score_func=score_func,
+        cv=cv,
+        max_evals=max_evals,
+        df=df,
+        random_state=random_state,
+        verbose=verbose,
+        n_jobs=n_jobs,
+        search=search,
+    )
+
+
+def grid_comparison_experiment(
+    X: np.ndarray,
+    y: np.ndarray,
+    columns_names: list,
+    grid: Dict,
+    score_func: str,
+    cv: int,
+    max_evals: int,
+    df: DataFrame,
+    random_state: int = 0,
+    verbose: int = 1,
+    n_jobs: int = 1,
+    search: str = "random",
+    path_checkpoints: str = None,
+    path_queue: str = None,
+    time_budget: float = None,
+    deadline: float = None,
+    fit_timeout: float = None,
+    times_df: DataFrame = None,
+    warm_start: bool = False,
+    path_results_log: str = None,
+    path_models: str = None,
+    path_predictions: str = None,
+    all_predictions: bool = False,
+    refit: str = "full",
+):
+    """
+    Run all the (selector, classifier) cells of the experiment grid.
+
+    The cells are sent to a pool of processes sharing a global budget of
+    n_jobs workers, the remaining workers are given to the hyper-parameter
+    search inside each cell. The scores table is filled as cells finish,
+    and it is ordered as the grid once all of them are done. Each cell
+    reseeds the random number generator, so the results do not depend on
+    the order in which the cells are run.
+
+    The results of every finished cell are stored in path_checkpoints,
+    and the cells already stored there are not run again, so an
+    interrupted experiment can be resumed.
+
+    If path_queue is given, the cells are not run here but written to a
+    work queue in this directory, and run by the workers (run_worker) of
+    any node that shares it.
+
+    Args:
+        X: Feature matrix (n samples x m features).
+        y: Ground truth vector (n samples).
+        columns_names: name of the features
+        grid: Key-value pairs with the selector name and a tuple of the
+            models, hparams (as returned by get_models) and the path of
+            the final results file for this selector.
+        score_func: score function
+        cv: number of cross validation splitting
+        max_evals:
+        df: dataframe to temporary store the results for plotting
+        random_state: random state value
+        verbose:
+        n_jobs: global number of cpu units used for processing
+        search: hyper-parameter search strategy, "random", "halving", "tpe"
+            or "racing"
+        path_checkpoints: directory of the results of the finished cells
+        path_queue: directory of the work queue shared with the workers
+        time_budget: seconds after which the search of a cell stops
+            evaluating new candidates
+        deadline: time (as time.time()) after which the searches of all
+            the cells stop evaluating new candidates
+        fit_timeout: seconds after which a single fit is stopped
+        times_df: dataframe to store the seconds of each cell for plotting
+        warm_start: start the fits of the searches from the previous
+            candidate along the warm start param of the classifier
+        path_results_log: directory of the logs of every evaluated
+            candidate, one JSON Lines file per cell
+        path_models: directory of the best pipeline of every cell,
+            refitted on all the data
+        path_predictions: directory of the out-of-fold predictions of
+            every cell
+        all_predictions: store the out-of-fold predictions of all the
+            candidates, not only of the best one
+        refit: "full" refits the best candidate of every cell on all the
+            data, "lazy" only when its stored model is first used
+
+    Returns:
+        (tuple): The scores dataframe and the list of selected features.
+
+    """
+    scores, times, selected_features = repeated_comparison_experiment(
+        X=X,
+        y=y,
+        columns_names=columns_names,
+        grid=grid,
+        score_func=score_func,
+        cv=cv,
+        max_evals=max_evals,
+        random_states=[random_state],
+        verbose=verbose,
+        n_jobs=n_jobs,
+        search=search,
+        path_checkpoints=path_checkpoints,
+        path_queue=path_queue,
+        time_budget=time_budget,
+        deadline=deadline,
+        fit_timeout=fit_timeout,
+        warm_start=warm_start,
+        path_results_log=path_results_log,
+        path_models=path_models,
+        path_predictions=path_predictions,
+        all_predictions=all_predictions,
+        refit=refit,
+    )
+    scores_df = scores[random_state]
+    for model_name in scores_df.index:
+        for selector in scores_df.columns:
+            df.at[model_name, selector] = scores_df.at[model_name, selector]
+            if times_df is not None:
+                times_df.at[model_name, selector] = times[random_state].at[
+                    model_name, selector
+                ]
+    df = df.reindex(
+        index=[m for m in df.index if m not in scores_df.index]
+        + list(scores_df.index),
+        columns=[s for s in df.columns if s not in scores_df.columns]
+        + list(scores_df.columns),
+    )
     if verbose > 0:
         print(df)
-    # Remove temporary directory.
-    ioutil.teardown_tempdir(path_tmp_results)
-    # Write final results to disk.
-    ioutil.write_final_results(path_final_results, results)
-    return df, all_selected_features
+    return df, selected_features[random_state]
+
+
+def repeated_comparison_experiment(
+    X: np.ndarray,
+    y: np.ndarray,
+    columns_names: list,
+    grid: Dict,
+    score_func: str,
+    cv: int,
+    max_evals: int,
+    random_states: list,
+    verbose: int = 1,
+    n_jobs: int = 1,
+    search: str = "random",
+    path_checkpoints: str = None,
+    path_queue: str = None,
+    time_budget: float = None,
+    deadline: float = None,
+    fit_timeout: float = None,
+    warm_start: bool = False,
+    path_results_log: str = None,
+    path_models: str = None,
+    path_predictions: str = None,
+    all_predictions: bool = False,
+    refit: str = "full",
+):
+    """
+    Run all the (selector, classifier) cells of the experiment grid once
+    for each random seed.
+
+    The cells of all the seeds are run together, as in
+    grid_comparison_experiment, and share the same dataset files and
+    cross-validation splits, so the repeats only differ in the sampled
+    hyper-parameters and the random states of the pipeline steps. The
+    checkpoints, queue jobs, candidates logs, stored models and
+    predictions are keyed by the (selector, classifier, seed) cell.
+
+    Args:
+        random_states: The seeds, one repeat of the grid each.
+        See grid_comparison_experiment for the other arguments.
+
+    Returns:
+        (tuple): The scores dataframe, the dataframe of the seconds spent
+            in each cell and the list of selected features of each seed,
+            as dicts keyed by the seed. The results file of each selector
+            has the rows of all the seeds.
+
+    """
+    if path_queue is None:
+        # Setup temporary directory to store preliminary results, a new
+        # one for each run, the runs started from the same directory do
+        # not share their mapped dataset files.
+        path_tmp_results = tempfile.mkdtemp(prefix="tmp_comparison_", dir=".")
+    else:
+        # The workers need the dataset and a temporary directory on the
+        # shared file system, so an X mapped from a local file is copied.
+        queue = WorkQueue(path_queue)
+        queue.reset()
+        path_tmp_results = ioutil.setup_tempdir("tmp", root=queue.path)
+        X = np.asarray(X)
+        if path_results_log is not None:
+            path_results_log = os.path.abspath(path_results_log)
+        if path_models is not None:
+            path_models = os.path.abspath(path_models)
+        if path_predictions is not None:
+            path_predictions = os.path.abspath(path_predictions)
+    try:
+        # The dataset and the cross-validation splits are stored once, and
+        # every cell maps the same files.
+        data = SharedDataset.create(
+            os.path.join(path_tmp_results, "data"), X, y, cv
+        )
+
+        cells = []
+        for random_state in random_states:
+            for selector, (models, hparams, _) in grid.items():
+                for model_name, model in models.items():
+                    cells.append(
+                        dict(
+                            data=data,
+                            columns_names=columns_names,
+                            model=model,
+                            experiment_id=model_name,
+                            hparams=hparams[model_name],
+                            score_func=score_func,
+                            max_evals=max_evals,
+                            random_state=random_state,
+                            path_tmp_results=path_tmp_results,
+                            selector=selector,
+                            verbose=verbose,
+                            search=search,
+                            time_budget=time_budget,
+                            deadline=deadline,
+                            fit_timeout=fit_timeout,
+                            warm_start=warm_start,
+                            path_results_log=path_results_log,
+                            path_models=path_models,
+                            path_predictions=path_predictions,
+                            all_predictions=all_predictions,
+                            refit=refit,
+                        )
+                    )
+
+        # Collect the results of the cells as they finish.
+        results = dict()
+        if path_checkpoints is not None:
+            os.makedirs(path_checkpoints, exist_ok=True)
+            cells_keys = {_cell_key(cell) for cell in cells}
+            for checkpoint in ioutil.read_checkpoints(path_checkpoints):
+                key = (
+                    checkpoint["selector"],
+                    checkpoint["model_name"],
+                    checkpoint["random_state"],
+                )
+                if key not in cells_keys:
+                    continue
+                results[key] = [
+                    checkpoint["score"],
+                    checkpoint["result"],
+                    checkpoint["selected_features"],
+                ]
+            cells = [cell for cell in cells if _cell_key(cell) not in results]
+        # The cells of a selector are run by the same worker process, so
+        # they share its cache of the fitted transformers (see utils.cache).
+        n_selectors = len({cell["selector"] for cell in cells})
+        n_cells_jobs, n_search_jobs = split_workers(n_jobs, n_selectors)
+
+        def collect(key, score, result, selected_features):
+            results[key] = [score, result, selected_features]
+            if path_checkpoints is not None:
+                ioutil.write_checkpoint(
+                    path_checkpoints,
+                    _cell_name(key),
+                    dict(
+                        selector=key[0],
+                        model_name=key[1],
+                        random_state=key[2],
+                        score=score,
+                        result=result,
+                        selected_features=selected_features,
+                    ),
+                )
+
+        if path_queue is not None:
+            _run_queue(queue, cells, collect)
+        elif n_cells_jobs == 1:
+            for cell in tqdm(cells):
+                collect(_cell_key(cell), *_run_cell(cell, n_search_jobs))
+        else:
+            with ExitStack() as stack:
+                futures = dict()
+                for worker_cells in assign_workers(cells, n_cells_jobs):
+                    executor = stack.enter_context(
+                        ProcessPoolExecutor(max_workers=1)
+                    )
+                    for cell in worker_cells:
+                        futures[
+                            executor.submit(_run_cell, cell, n_search_jobs)
+                        ] = _cell_key(cell)
+                for future in tqdm(as_completed(futures), total=len(futures)):
+                    collect(futures[future], *future.result())
+
+        # Fill the tables of each seed in grid order, and write the final
+        # results to disk, one file per selector.
+        scores, times, all_selected_features = dict(), dict(), dict()
+        for random_state in random_states:
+            scores[random_state] = DataFrame(dtype="float")
+            times[random_state] = DataFrame(dtype="float")
+            all_selected_features[random_state] = list()
+        for selector, (models, _, path_final_results) in grid.items():
+            selector_results = []
+            for random_state in random_states:
+                for model_name in models.keys():
+                    score, result, selected_features = results[
+                        (selector, model_name, random_state)
+                    ]
+                    scores[random_state].at[model_name, selector] = score
+                    times[random_state].at[model_name, selector] = float(
+                        result.get("cell_time", np.nan)
+                    )
+                    selector_results.append(result)
+                    all_selected_features[random_state] += selected_features
+            ioutil.write_final_results(path_final_results, selector_results)
+    finally:
+        # Remove the temporary directory, and tell the workers to exit,
+        # also when a cell failed.
+        if path_queue is None:
+            ioutil.teardown_tempdir(path_tmp_results)
+        else:
+            queue.stop()
+    return scores, times, all_selected_features
+
+
+def run_worker(
+    path_queue: str,
+    n_jobs: int = 1,
+    lease_timeout: float = 300.0,
+    poll_interval: float = 1.0,
+):
+    """
+    Run the cells of a work queue until the coordinator stops it. The
+    worker can be started before the coordinator, and any number of
+    workers can run on the nodes that share the queue directory.
+
+    Args:
+        path_queue: directory of the work queue shared with the
+            coordinator.
+        n_jobs: number of cpu units used for the hyper-parameter search
+            of each cell.
+        lease_timeout: seconds after which the cell of a worker that does
+            not renew its lease is given to another worker.
+        poll_interval: seconds between two looks at the queue.
+
+    Returns:
+        (int): The number of cells run by this worker.
+
+    """
+    queue = WorkQueue(path_queue, lease_timeout, poll_interval)
+    worker = f"{socket.gethostname()}:{os.getpid()}"
+    n_cells = 0
+    # Wait for the coordinator, the stop marker of a previous experiment
+    # is removed when the next one starts.
+    while queue.stopped():
+        time.sleep(queue.poll_interval)
+    while not queue.stopped():
+        queue.requeue_expired()
+        leased = queue.lease()
+        if leased is None:
+            time.sleep(queue.poll_interval)
+            continue
+        name, cell = leased
+        # Renew the lease while the cell runs.
+        finished = threading.Event()
+        heartbeat = threading.Thread(
+            target=_renew_lease,
+            args=(queue, name, finished),
+            daemon=True,
+        )
+        heartbeat.start()
+        try:
+            score, result, selected_features = _run_cell(cell, n_jobs)
+        except Exception:
+            error = f"Worker {worker}\n" + traceback.format_exc()
+            report = partial(queue.fail, name, error)
+        else:
+            report = partial(
+                queue.complete,
+                name,
+                dict(
+                    selector=cell["selector"],
+                    model_name=cell["experiment_id"],
+                    random_state=cell["random_state"],
+                    score=score,
+                    result=result,
+                    selected_features=selected_features,
+                ),
+            )
+            n_cells += 1
+        finally:
+            finished.set()
+            heartbeat.join()
+        try:
+            report()
+        except OSError:
+            # A cell run twice after its lease expired may finish after
+            # the coordinator has stopped the queue.
+            if not queue.stopped():
+                raise
+    return n_cells
+
+
+def split_workers(n_jobs: int, n_cells: int):
+    """Split a global budget of workers between the cells and the
+    hyper-parameter search inside each cell."""
+
+    if n_jobs < 0:
+        n_jobs = cpu_count() + 1 + n_jobs
+    n_jobs = max(1, min(n_jobs, cpu_count()))
+    n_cells_jobs = max(1, min(n_jobs, n_cells))
+    return n_cells_jobs, max(1, n_jobs // n_cells_jobs)
+
+
+def assign_workers(cells: list, n_workers: int):
+    """Split the cells between the worker processes, all the cells of a
+    selector go to the same worker, the selectors with the most cells
+    first to the worker with the fewest cells."""
+
+    selectors = dict()
+    for cell in cells:
+        selectors.setdefault(cell["selector"], []).append(cell)
+    workers = [[] for _ in range(max(1, min(n_workers, len(selectors))))]
+    for selector_cells in sorted(selectors.values(), key=len, reverse=True):
+        min(workers, key=len).extend(selector_cells)
+    return workers
+
+
+def _run_queue(queue: WorkQueue, cells: list, collect):
+    # Write the cells as jobs and collect the results of the workers.
+    pending = dict()
+    for cell in cells:
+        key = _cell_key(cell)
+        pending[key] = _cell_name(key)
+        queue.put(pending[key], cell)
+    with tqdm(total=len(pending)) as progress:
+        while pending:
+            for name, error in queue.failures().items():
+                raise RuntimeError(f"The cell {name} failed:\n{error}")
+            for result in queue.results():
+                key = (
+                    result["selector"],
+                    result["model_name"],
+                    result["random_state"],
+                )
+                if key not in pending:
+                    continue
+                del pending[key]
+                collect(
+                    key,
+                    result["score"],
+                    result["result"],
+                    result["selected_features"],
+                )
+                progress.update()
+            if pending:
+                queue.requeue_expired()
+                time.sleep(queue.poll_interval)
+
+
+def _cell_key(cell: Dict):
+    return cell["selector"], cell["experiment_id"], cell["random_state"]
+
+
+def _cell_name(key: tuple):
+    # Name of the checkpoint and queue job of a cell.
+    return "__".join(str(k) for k in key)
+
+
+def _renew_lease(queue: WorkQueue, name: str, finished: threading.Event):
+    while not finished.wait(queue.lease_timeout / 4):
+        queue.renew(name)
+
+
+def _run_cell(cell: Dict, n_jobs: int):
+    # Reseed for every cell, so the sampled hyper-parameters are the same
+    # whether the cells run in sequence or in parallel.
+    np.random.seed(cell["random_state"])
+    cell = dict(cell)
+    X, y, cv = cell.pop("data").load()
+    cell_df = DataFrame(dtype="float")
+    result, cell_df, selected_features = cross_validation(
+        X=X, y=y, cv=cv, df=cell_df, n_jobs=n_jobs, **cell
+    )
+    return cell_df.iat[0, 0], result, selected_features
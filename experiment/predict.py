@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+#
+# predict.py
+#
+
+"""
+Score new samples with the pipelines stored by an experiment.
+"""
+
+__author__ = "Ahmed Albuni"
+__email__ = "ahmed.albuni@gmail.com"
+
+
+import json
+from datetime import datetime
+from pathlib import Path
+
+import pandas as pd
+
+from experiment.experiment import read_Xy_data
+from utils import ioutil
+
+
+def predict(
+    path_models: str,
+    path_features: str,
+    path_output: str,
+    models="best",
+    chunksize: int = 10000,
+):
+    """
+    Score a features CSV file with the best pipelines of an experiment.
+
+    The file is read and scored chunksize rows at a time, and the scores
+    are appended to the output file, so the memory does not grow with the
+    number of samples. The pipelines are the ones refitted on all the
+    data at the end of each cell, no model is fitted again, except the
+    ones stored unfitted by a lazy REFIT, see export_models.
+
+    Args:
+        path_models: The models folder of the output directory of an
+            experiment.
+        path_features: CSV file of the new samples, with the features
+            columns of the features file of the experiment. The response
+            is not needed, and the columns that are not features, such as
+            an identifier, are copied to the output.
+        path_output: CSV file of the scores, one column per model named
+            after its (selector, classifier, seed) cell, with the
+            probability of the second class, or the decision function of
+            the classifiers without probabilities (Ridge, SVC).
+        models: The names of the models to use, "best" for the one with
+            the best cross-validation score, or "all".
+        chunksize: The number of rows scored at once.
+
+    Returns:
+        (list): The names of the models used.
+
+    """
+    models = export_models(path_models, models)
+    manifests = ioutil.read_models_manifest(path_models)
+    pipelines = {
+        name: ioutil.read_model(path_models, manifests[name])
+        for name in models
+    }
+    features = {
+        feature for name in models for feature in manifests[name]["features"]
+    }
+
+    header = True
+    for chunk in pd.read_csv(path_features, chunksize=chunksize):
+        missing = [
+            feature for feature in features if feature not in chunk.columns
+        ]
+        if missing:
+            raise ValueError(f"Missing features: {', '.join(missing)}")
+        scores = chunk[[c for c in chunk.columns if c not in features]].copy()
+        for name, pipeline in pipelines.items():
+            X = chunk[manifests[name]["features"]].to_numpy(dtype=float)
+            if hasattr(pipeline, "predict_proba"):
+                scores[name] = pipeline.predict_proba(X)[:, 1]
+            else:
+                scores[name] = pipeline.decision_function(X)
+        scores.to_csv(
+            path_output,
+            mode="w" if header else "a",
+            header=header,
+            index=False,
+        )
+        header = False
+    return models
+
+
+def export_models(path_models: str, models="best"):
+    """
+    Fit the stored models that an experiment with a lazy REFIT stored
+    unfitted, on all the data of its features file, so that only the
+    models that are used are refitted, once. The fitted models replace
+    the unfitted ones.
+
+    Args:
+        path_models: The models folder of the output directory of an
+            experiment, next to its config.json.
+        models: The names of the models, "best" for the one with the best
+            cross-validation score, or "all".
+
+    Returns:
+        (list): The names of the models.
+
+    """
+    manifests = ioutil.read_models_manifest(path_models)
+    if len(manifests) == 0:
+        raise ValueError(f"No stored models in {path_models}")
+    if models == "best":
+        models = [
+            max(manifests, key=lambda name: manifests[name]["test_score"])
+        ]
+    elif models == "all":
+        models = list(manifests)
+    else:
+        unknown = [name for name in models if name not in manifests]
+        if unknown:
+            raise ValueError(f"Unknown models: {', '.join(unknown)}")
+    unfitted = [
+        name for name in models if not manifests[name].get("fitted", True)
+    ]
+    if unfitted:
+        with open(Path(path_models).parent / "config.json") as config_file:
+            config = json.load(config_file)["config"]
+        X, y, columns_names = read_Xy_data(
+            config["features_file"],
+            cache=config.get("DATA_CACHE", True),
+            float32=config.get("FLOAT32", False),
+        )
+    for name in unfitted:
+        manifest = manifests[name]
+        if manifest["features"] != columns_names:
+            raise ValueError(
+                f"The features of {config['features_file']} are not the "
+                f"features of the model {name}"
+            )
+        pipeline = ioutil.read_model(path_models, manifest)
+        pipeline.fit(X, y)
+        manifest.update(
+            fitted=True, created=datetime.now().isoformat(timespec="seconds")
+        )
+        ioutil.write_model(path_models, name, pipeline, manifest)
+    return models
@@ -0,0 +1,1035 @@
+# -*- coding: utf-8 -*-
+#
+# search.py
+#
+
+"""
+Hyper-parameter search strategies for the model comparison experiments.
+"""
+
+__author__ = "Ahmed Albuni"
+__email__ = "ahmed.albuni@gmail.com"
+
+
+import itertools
+import time
+import warnings
+from collections import OrderedDict
+
+import numpy as np
+from joblib import Parallel, delayed, effective_n_jobs
+from scipy.stats import rv_discrete
+from scipy.stats import t as student_t
+from sklearn.base import clone, is_classifier
+from sklearn.exceptions import FitFailedWarning
+from sklearn.metrics import check_scoring
+from sklearn.model_selection import check_cv
+from sklearn.model_selection._search import BaseSearchCV
+from sklearn.model_selection._search_successive_halving import (
+    BaseSuccessiveHalving,
+)
+from sklearn.utils import check_random_state
+
+# The available search strategies, selected with SEARCH in the config file.
+SEARCH_LIST = ("random", "halving", "tpe", "racing")
+
+
+class _TimeoutsMixin:
+    # Record the candidates with a fit that timed out in cv_results_, the
+    # fits stopped by a TimeoutPipeline are scored NaN after fit_timeout
+    # seconds. The outputs of the fits are private to scikit-learn, its
+    # versions are pinned in requirements.txt.
+
+    def _format_results(
+        self, candidate_params, n_splits, out, more_results=None
+    ):
+        results = super()._format_results(
+            candidate_params, n_splits, out, more_results
+        )
+        fit_timeout = getattr(self.estimator, "fit_timeout", None)
+        timed_out = np.array(
+            [
+                fit_timeout is not None
+                and o["fit_error"] is None
+                and np.isnan(o["test_scores"])
+                and o["fit_time"] >= fit_timeout
+                for o in out
+            ]
+        )
+        results["timed_out"] = timed_out.reshape(-1, n_splits).any(axis=1)
+        return results
+
+
+class _ResultsLogMixin:
+    # Pass the results of the evaluated candidates to the results_log
+    # function as soon as each call of evaluate_candidates returns, the
+    # candidates are not split into smaller calls for the log.
+
+    def _log_results(self, evaluate_candidates):
+        if self.results_log is None:
+            return evaluate_candidates
+        n_logged = 0
+
+        def evaluate(candidate_params, *args, **kwargs):
+            nonlocal n_logged
+            results = evaluate_candidates(candidate_params, *args, **kwargs)
+            n_results = len(results["params"])
+            self.results_log(
+                [
+                    _candidate_results(results, i)
+                    for i in range(n_logged, n_results)
+                ]
+            )
+            n_logged = n_results
+            return results
+
+        return evaluate
+
+
+class CandidatesSearchCV(_ResultsLogMixin, _TimeoutsMixin, BaseSearchCV):
+    """
+    Cross-validated evaluation of a given list of candidate
+    hyper-parameters, with the same attributes as RandomizedSearchCV.
+
+    Args:
+        estimator: The scikit-learn Pipeline.
+        candidates: List of dicts with the hyper-parameters to evaluate.
+        deadline: Time (as time.time()) after which no new candidates are
+            evaluated, the first batch of n_jobs candidates is always
+            evaluated.
+        results_log: Function called with the results of the evaluated
+            candidates, a dict per candidate.
+    """
+
+    def __init__(
+        self,
+        estimator,
+        candidates,
+        deadline=None,
+        results_log=None,
+        scoring=None,
+        n_jobs=None,
+        refit=True,
+        cv=None,
+        verbose=0,
+        pre_dispatch="2*n_jobs",
+        error_score=np.nan,
+        return_train_score=True,
+    ):
+        super().__init__(
+            estimator=estimator,
+            scoring=scoring,
+            n_jobs=n_jobs,
+            refit=refit,
+            cv=cv,
+            verbose=verbose,
+            pre_dispatch=pre_dispatch,
+            error_score=error_score,
+            return_train_score=return_train_score,
+        )
+        self.candidates = candidates
+        self.deadline = deadline
+        self.results_log = results_log
+
+    def _run_search(self, evaluate_candidates):
+        evaluate_candidates = self._log_results(evaluate_candidates)
+        if self.deadline is None:
+            evaluate_candidates(list(self.candidates))
+        else:
+            _evaluate_in_batches(
+                evaluate_candidates,
+                list(self.candidates),
+                max(1, effective_n_jobs(self.n_jobs)),
+                self.deadline,
+            )
+
+
+class CandidatesHalvingSearchCV(
+    _ResultsLogMixin, _TimeoutsMixin, BaseSuccessiveHalving
+):
+    """
+    Successive halving over a given list of candidate hyper-parameters.
+
+    All the candidates are scored on a subsample of the data, the best
+    1 / factor of them move up to a subsample factor times larger, until
+    the last iteration is scored on all the samples.
+
+    Args:
+        estimator: The scikit-learn Pipeline.
+        candidates: List of dicts with the hyper-parameters to evaluate.
+        factor: The fraction of candidates kept at each iteration is
+            1 / factor.
+        deadline: Time (as time.time()) after which no new iteration is
+            started, the best candidate is then taken from the last
+            finished iteration.
+        results_log: Function called with the results of each iteration,
+            a dict per candidate.
+    """
+
+    def __init__(
+        self,
+        estimator,
+        candidates,
+        deadline=None,
+        results_log=None,
+        scoring=None,
+        n_jobs=None,
+        refit=True,
+        cv=5,
+        verbose=0,
+        random_state=None,
+        error_score=np.nan,
+        return_train_score=True,
+        factor=3,
+    ):
+        super().__init__(
+            estimator=estimator,
+            scoring=scoring,
+            n_jobs=n_jobs,
+            refit=refit,
+            cv=cv,
+            verbose=verbose,
+            random_state=random_state,
+            error_score=error_score,
+            return_train_score=return_train_score,
+            factor=factor,
+        )
+        self.candidates = candidates
+        self.deadline = deadline
+        self.results_log = results_log
+
+    def _generate_candidate_params(self):
+        return list(self.candidates)
+
+    def _run_search(self, evaluate_candidates, callback_ctx=None):
+        evaluate_candidates = self._log_results(evaluate_candidates)
+        if self.deadline is not None:
+            evaluate_candidates = _until_deadline(
+                evaluate_candidates, self.deadline
+            )
+        # The callback context of the recent scikit-learn versions.
+        if callback_ctx is None:
+            super()._run_search(evaluate_candidates)
+        else:
+            super()._run_search(evaluate_candidates, callback_ctx=callback_ctx)
+
+
+class TPESearchCV(_ResultsLogMixin, _TimeoutsMixin, BaseSearchCV):
+    """
+    Sequential model-based search with tree-structured Parzen estimators.
+
+    The first candidates are sampled at random from the distributions.
+    The next ones are proposed from the scores seen so far: the evaluated
+    candidates are split into the best gamma fraction and the rest, a
+    Parzen density is fitted to the params of each group, and the
+    proposals are the draws from the best group density with the highest
+    ratio of the two densities. The candidates are proposed in batches of
+    n_jobs, so all the workers stay busy.
+
+    Args:
+        estimator: The scikit-learn Pipeline.
+        param_distributions: Key-value pairs with the param name and a
+            scipy distribution or a list of values.
+        n_iter: The number of candidates to evaluate.
+        selector: The name of the selector step in the pipeline.
+        n_initial: The number of random candidates evaluated first,
+            by default a quarter of n_iter, at least one batch.
+        gamma: The fraction of the best candidates.
+        n_ei_candidates: The number of draws to propose each candidate.
+        random_state: Seed of the pseudo-random number generator.
+        deadline: Time (as time.time()) after which no new candidates are
+            proposed, the first batch of n_jobs candidates is always
+            evaluated.
+        results_log: Function called with the results of the initial
+            candidates and of each batch of proposals, a dict per
+            candidate.
+    """
+
+    def __init__(
+        self,
+        estimator,
+        param_distributions,
+        n_iter=10,
+        selector=None,
+        n_initial=None,
+        gamma=0.25,
+        n_ei_candidates=24,
+        random_state=None,
+        deadline=None,
+        results_log=None,
+        scoring=None,
+        n_jobs=None,
+        refit=True,
+        cv=None,
+        verbose=0,
+        pre_dispatch="2*n_jobs",
+        error_score=np.nan,
+        return_train_score=True,
+    ):
+        super().__init__(
+            estimator=estimator,
+            scoring=scoring,
+            n_jobs=n_jobs,
+            refit=refit,
+            cv=cv,
+            verbose=verbose,
+            pre_dispatch=pre_dispatch,
+            error_score=error_score,
+            return_train_score=return_train_score,
+        )
+        self.param_distributions = param_distributions
+        self.n_iter = n_iter
+        self.selector = selector
+        self.n_initial = n_initial
+        self.gamma = gamma
+        self.n_ei_candidates = n_ei_candidates
+        self.random_state = random_state
+        self.deadline = deadline
+        self.results_log = results_log
+
+    def _run_search(self, evaluate_candidates):
+        rng = check_random_state(self.random_state)
+        n_batch = max(1, effective_n_jobs(self.n_jobs))
+        # A finite search space is not evaluated more than once.
+        n_iter = int(
+            min(self.n_iter, search_space_size(self.param_distributions))
+        )
+        n_initial = self.n_initial
+        if n_initial is None:
+            n_initial = max(n_batch, n_iter // 4)
+        n_initial = max(1, min(n_initial, n_iter))
+        initial_candidates = sample_candidates(
+            self.param_distributions, n_initial, self.selector, rng
+        )
+        evaluate_candidates = self._log_results(evaluate_candidates)
+        if self.deadline is None:
+            results = evaluate_candidates(initial_candidates)
+        else:
+            results = _evaluate_in_batches(
+                evaluate_candidates, initial_candidates, n_batch, self.deadline
+            )
+        n_evaluated = len(results["params"])
+        while n_evaluated < n_iter and not _expired(self.deadline):
+            n_proposals = min(n_batch, n_iter - n_evaluated)
+            results = evaluate_candidates(
+                propose_candidates(
+                    self.param_distributions,
+                    results["params"],
+                    results["mean_test_score"],
+                    n_proposals,
+                    gamma=self.gamma,
+                    n_ei_candidates=max(
+                        self.n_ei_candidates, 4 * n_proposals
+                    ),
+                    random_state=rng,
+                )
+            )
+            n_evaluated += n_proposals
+
+
+class RacingSearchCV(BaseSearchCV):
+    """
+    Racing of a given list of candidate hyper-parameters over the
+    cross-validation folds.
+
+    The candidates still in the race are evaluated together on the next
+    fold. Once they have min_folds folds, after each fold every candidate
+    is compared with the leader, the candidate with the best mean score,
+    by a one-sided paired t-test on their fold scores. The candidates
+    that score lower than the leader at the alpha level, or that failed a
+    fit, are dropped and not evaluated on the next folds. The best
+    candidate is the remaining one with the best mean score.
+
+    The mean scores and times of a dropped candidate in cv_results_ are
+    over the folds it was evaluated on, its other split scores are NaN,
+    and cv_results_ also has the pruned candidates and the number of
+    folds of each candidate (n_folds_evaluated).
+
+    Args:
+        estimator: The scikit-learn Pipeline.
+        candidates: List of dicts with the hyper-parameters to evaluate.
+        min_folds: The number of folds of every candidate before the
+            first test, at least 2.
+        alpha: The significance level of the tests.
+        deadline: Time (as time.time()) after which the race is stopped,
+            the first min_folds folds are always evaluated.
+        results_log: Function called with the results of the candidates
+            once they are dropped or evaluated on all the folds, a dict
+            per candidate.
+    """
+
+    def __init__(
+        self,
+        estimator,
+        candidates,
+        min_folds=3,
+        alpha=0.05,
+        deadline=None,
+        results_log=None,
+        scoring=None,
+        n_jobs=None,
+        refit=True,
+        cv=None,
+        verbose=0,
+        pre_dispatch="2*n_jobs",
+        error_score=np.nan,
+        return_train_score=True,
+    ):
+        super().__init__(
+            estimator=estimator,
+            scoring=scoring,
+            n_jobs=n_jobs,
+            refit=refit,
+            cv=cv,
+            verbose=verbose,
+            pre_dispatch=pre_dispatch,
+            error_score=error_score,
+            return_train_score=return_train_score,
+        )
+        self.candidates = candidates
+        self.min_folds = min_folds
+        self.alpha = alpha
+        self.deadline = deadline
+        self.results_log = results_log
+
+    def fit(self, X, y=None, **params):
+        estimator = self.estimator
+        scorer = check_scoring(estimator, self.scoring)
+        cv = check_cv(self.cv, y, classifier=is_classifier(estimator))
+        splits = list(cv.split(X, y))
+        n_splits = len(splits)
+        candidates = list(self.candidates)
+        out = [[None] * n_splits for _ in candidates]
+        racing = np.ones(len(candidates), dtype=bool)
+        logged = np.zeros(len(candidates), dtype=bool)
+        min_folds = min(max(2, self.min_folds), n_splits)
+        n_folds = 0
+        with Parallel(
+            n_jobs=self.n_jobs, pre_dispatch=self.pre_dispatch
+        ) as parallel:
+            while n_folds < n_splits and racing.any():
+                if n_folds >= min_folds and _expired(self.deadline):
+                    break
+                folds = range(n_folds, max(n_folds + 1, min_folds))
+                tasks = [
+                    (i, k) for i in np.flatnonzero(racing) for k in folds
+                ]
+                fold_results = parallel(
+                    delayed(_fit_fold)(
+                        estimator,
+                        candidates[i],
+                        X,
+                        y,
+                        scorer,
+                        splits[k],
+                        self.return_train_score,
+                        self.error_score,
+                        params,
+                    )
+                    for i, k in tasks
+                )
+                for (i, k), result in zip(tasks, fold_results):
+                    out[i][k] = result
+                n_folds = folds[-1] + 1
+                if n_folds >= min_folds:
+                    scores = np.array(
+                        [
+                            [o["test_scores"] for o in out[i][:n_folds]]
+                            for i in np.flatnonzero(racing)
+                        ]
+                    )
+                    racing[racing] = _race(scores, self.alpha)
+                # The candidates are logged once they are out of the race
+                # or evaluated on all the folds.
+                finished = ~logged & (~racing | (n_folds == n_splits))
+                self._log_finished(candidates, out, racing, finished)
+                logged |= finished
+        # The candidates still in the race at the deadline.
+        self._log_finished(candidates, out, racing, ~logged)
+
+        self.cv_results_ = _racing_results(
+            candidates, out, racing, getattr(estimator, "fit_timeout", None)
+        )
+        self.best_index_ = int(np.argmin(self.cv_results_["rank_test_score"]))
+        self.best_score_ = self.cv_results_["mean_test_score"][
+            self.best_index_
+        ]
+        self.best_params_ = candidates[self.best_index_]
+        self.scorer_ = scorer
+        self.multimetric_ = False
+        self.n_splits_ = n_splits
+        if self.refit:
+            self.best_estimator_ = clone(estimator).set_params(
+                **self.best_params_
+            )
+            refit_start_time = time.time()
+            self.best_estimator_.fit(X, y, **params)
+            self.refit_time_ = time.time() - refit_start_time
+        return self
+
+    def _log_finished(self, candidates, out, racing, finished):
+        if self.results_log is None or not finished.any():
+            return
+        results = _racing_results(
+            candidates,
+            out,
+            racing,
+            getattr(self.estimator, "fit_timeout", None),
+        )
+        self.results_log(
+            [_candidate_results(results, i) for i in np.flatnonzero(finished)]
+        )
+
+
+def _fit_fold(
+    estimator,
+    params,
+    X,
+    y,
+    scorer,
+    split,
+    return_train_score,
+    error_score,
+    fit_params=None,
+):
+    # Fit a candidate on the training part of a fold and score it, the
+    # failed fits are scored error_score as in the scikit-learn searches.
+    # As in them, the fit params with a value per sample are taken on the
+    # training samples.
+    train, test = split
+    fit_params = {
+        key: np.asarray(value)[train]
+        if hasattr(value, "__len__") and len(value) == len(X)
+        else value
+        for key, value in (fit_params or {}).items()
+    }
+    model = clone(estimator).set_params(**params)
+    start_time = time.time()
+    try:
+        model.fit(X[train], y[train], **fit_params)
+    except Exception as error:
+        if error_score == "raise":
+            raise
+        warnings.warn(
+            f"The fit of {params} failed: {error!r}", FitFailedWarning
+        )
+        result = dict(
+            test_scores=error_score,
+            fit_time=time.time() - start_time,
+            score_time=0.0,
+        )
+        if return_train_score:
+            result["train_scores"] = error_score
+        return result
+    fit_time = time.time() - start_time
+    test_score = scorer(model, X[test], y[test])
+    result = dict(
+        test_scores=test_score,
+        fit_time=fit_time,
+        score_time=time.time() - start_time - fit_time,
+    )
+    if return_train_score:
+        result["train_scores"] = scorer(model, X[train], y[train])
+    return result
+
+
+def _race(scores, alpha):
+    # The candidates that stay in the race, from their scores on the same
+    # folds (n candidates x n folds): the candidates with a failed fit are
+    # dropped, and the ones whose scores are lower than the leader's by a
+    # one-sided paired t-test.
+    finite = np.isfinite(scores).all(axis=1)
+    if not finite.any():
+        return finite
+    means = np.where(finite, scores.mean(axis=1), -np.inf)
+    differences = scores - scores[np.argmax(means)]
+    n_folds = scores.shape[1]
+    mean = differences.mean(axis=1)
+    std = differences.std(axis=1, ddof=1)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        statistic = mean / (std / np.sqrt(n_folds))
+    # The same differences on every fold: dropped if they are negative.
+    statistic[std == 0] = np.where(mean[std == 0] < 0, -np.inf, 0)
+    p_values = student_t.cdf(statistic, n_folds - 1)
+    return finite & (p_values >= alpha)
+
+
+def _racing_results(candidates, out, racing, fit_timeout=None):
+    # The cv_results_ of a race, the folds a candidate was not evaluated
+    # on are left out of its means.
+    n_candidates, n_splits = len(out), len(out[0])
+    evaluated = np.array([[o is not None for o in row] for row in out])
+    n_folds = evaluated.sum(axis=1)
+
+    def fold_values(key):
+        return np.array(
+            [
+                [np.nan if o is None else o.get(key, np.nan) for o in row]
+                for row in out
+            ],
+            dtype=float,
+        )
+
+    results = dict(params=candidates)
+    for name in sorted({name for params in candidates for name in params}):
+        values = np.ma.masked_all(n_candidates, dtype=object)
+        for i, params in enumerate(candidates):
+            if name in params:
+                values[i] = params[name]
+        results[f"param_{name}"] = values
+    for key in ("test_score", "train_score", "fit_time", "score_time"):
+        values = fold_values(key + "s" if key.endswith("score") else key)
+        if key.endswith("score"):
+            for k in range(n_splits):
+                results[f"split{k}_{key}"] = values[:, k]
+        # The failed fits stay NaN.
+        total = np.where(evaluated, values, 0).sum(axis=1)
+        mean = total / np.maximum(n_folds, 1)
+        squares = np.where(evaluated, (values - mean[:, None]) ** 2, 0)
+        results[f"mean_{key}"] = mean
+        results[f"std_{key}"] = np.sqrt(
+            squares.sum(axis=1) / np.maximum(n_folds, 1)
+        )
+    # The candidates that were not dropped come first.
+    mean_test_score = results["mean_test_score"]
+    order = np.lexsort(
+        (-np.nan_to_num(mean_test_score, nan=-np.inf), ~racing)
+    )
+    results["rank_test_score"] = np.empty(n_candidates, dtype=np.int32)
+    results["rank_test_score"][order] = np.arange(1, n_candidates + 1)
+    # As _TimeoutsMixin, the fits stopped by a TimeoutPipeline.
+    results["timed_out"] = np.array(
+        [
+            any(
+                fit_timeout is not None
+                and o is not None
+                and np.isnan(o["test_scores"])
+                and o["fit_time"] >= fit_timeout
+                for o in row
+            )
+            for row in out
+        ]
+    )
+    results["pruned"] = ~racing
+    results["n_folds_evaluated"] = n_folds
+    return results
+
+
+def _evaluate_in_batches(evaluate_candidates, candidates, n_batch, deadline):
+    # Evaluate n_batch candidates at a time until the deadline, if any.
+    for start in range(0, len(candidates), n_batch):
+        results = evaluate_candidates(candidates[start : start + n_batch])
+        if _expired(deadline):
+            break
+    return results
+
+
+def _until_deadline(evaluate_candidates, deadline):
+    # After the deadline, the candidates are not evaluated any more and
+    # the results so far are returned.
+    results = None
+
+    def evaluate(candidate_params, *args, **kwargs):
+        nonlocal results
+        if results is None or not _expired(deadline):
+            results = evaluate_candidates(candidate_params, *args, **kwargs)
+        return results
+
+    return evaluate
+
+
+def _candidate_results(results, index):
+    # The params, fold scores and times of a candidate, the ranks are
+    # left out since they change with the next candidates.
+    candidate = dict(candidate=index, params=results["params"][index])
+    for key, values in results.items():
+        if key != "params" and not key.startswith(("param_", "rank_")):
+            candidate[key] = values[index]
+    return candidate
+
+
+def _expired(deadline):
+    return deadline is not None and time.time() >= deadline
+
+
+def propose_candidates(
+    hparams: dict,
+    params: list,
+    scores: list,
+    n_proposals: int,
+    gamma: float = 0.25,
+    n_ei_candidates: int = 24,
+    random_state=None,
+):
+    """
+    Propose new candidates with tree-structured Parzen estimators.
+
+    Args:
+        hparams: Key-value pairs with the param name and a scipy
+            distribution or a list of values.
+        params: The evaluated candidates.
+        scores: The scores of the evaluated candidates, higher is better.
+        n_proposals: The number of candidates to propose.
+        gamma: The fraction of the best candidates.
+        n_ei_candidates: The number of draws from the best candidates
+            density, the proposals are the draws with the highest ratio
+            of the best to the other candidates densities.
+        random_state: Seed of the pseudo-random number generator.
+
+    Returns:
+        (list): The proposed candidates, a dict of params each.
+
+    """
+    rng = check_random_state(random_state)
+    scores = np.nan_to_num(np.asarray(scores, dtype=float), nan=-np.inf)
+    order = np.argsort(-scores, kind="mergesort")
+    n_good = max(1, int(np.ceil(gamma * len(order))))
+    good = [params[i] for i in order[:n_good]]
+    other = [params[i] for i in order[n_good:]]
+
+    draws = [dict() for _ in range(n_ei_candidates)]
+    log_ratio = np.zeros(n_ei_candidates)
+    for name, values in sorted(hparams.items()):
+        good_density = _Parzen(values, [p[name] for p in good])
+        other_density = _Parzen(values, [p[name] for p in other])
+        samples = good_density.sample(n_ei_candidates, rng)
+        log_ratio += good_density.log_pdf(samples)
+        log_ratio -= other_density.log_pdf(samples)
+        for draw, sample in zip(draws, samples):
+            draw[name] = sample
+
+    # Keep the best distinct draws that were not evaluated before.
+    seen = {_params_key(p) for p in params}
+    proposals = []
+    for i in np.argsort(-log_ratio, kind="mergesort"):
+        if len(proposals) == n_proposals:
+            break
+        key = _params_key(draws[i])
+        if key not in seen:
+            seen.add(key)
+            proposals.append(draws[i])
+    # Fill up with random candidates if the best region is exhausted.
+    if len(proposals) < n_proposals:
+        proposals += _sample(hparams, n_proposals - len(proposals), rng)
+    return proposals
+
+
+class _Parzen:
+    # Parzen density of the observed values of a param, mixed with the
+    # prior distribution of the param.
+
+    def __init__(self, values, observations):
+        self.values = values
+        self.numeric = hasattr(values, "rvs")
+        if self.numeric:
+            self.discrete = isinstance(values.dist, rv_discrete)
+            self.observations = np.asarray(observations, dtype=float)
+            self.low, self.high = values.support()
+            low, high = values.ppf([0.01, 0.99])
+            width = (high - low) if high > low else 1.0
+            self.sigma = width / (1 + len(self.observations)) ** 0.2
+            if self.discrete:
+                self.sigma = max(self.sigma, 0.5)
+        else:
+            counts = np.ones(len(values))
+            for observation in observations:
+                counts[_index(values, observation)] += 1
+            self.probs = counts / counts.sum()
+
+    def sample(self, n, rng):
+        if not self.numeric:
+            indices = rng.choice(len(self.values), n, p=self.probs)
+            return [self.values[i] for i in indices]
+        samples = []
+        for component in rng.randint(len(self.observations) + 1, size=n):
+            # The last component is the prior distribution.
+            if component == len(self.observations):
+                samples.append(self.values.rvs(random_state=rng))
+                continue
+            sample = rng.normal(self.observations[component], self.sigma)
+            sample = np.clip(sample, self.low, self.high)
+            if self.discrete:
+                sample = int(np.round(sample))
+            samples.append(sample)
+        return samples
+
+    def log_pdf(self, samples):
+        if not self.numeric:
+            return np.log(
+                [self.probs[_index(self.values, s)] for s in samples]
+            )
+        x = np.asarray(samples, dtype=float)
+        if self.discrete:
+            prior = self.values.pmf(x)
+        else:
+            prior = self.values.pdf(x)
+        z = (x[:, None] - self.observations[None, :]) / self.sigma
+        kernels = np.exp(-0.5 * z ** 2) / (self.sigma * np.sqrt(2 * np.pi))
+        density = (prior + kernels.sum(axis=1)) / (len(self.observations) + 1)
+        return np.log(density + np.finfo(float).tiny)
+
+
+def _index(values, value):
+    for i, v in enumerate(values):
+        if v == value:
+            return i
+    raise ValueError(f"{value} is not one of {values}")
+
+
+def _params_key(params):
+    return tuple(sorted((name, str(value)) for name, value in params.items()))
+
+
+def sample_candidates(
+    hparams: dict, n_iter: int, selector: str = None, random_state=None
+):
+    """
+    Sample n_iter distinct candidates from the hyper-parameters
+    distributions.
+
+    The params of the selector step are sampled with their own random
+    stream, so all the classifiers combined with a selector are given the
+    same sequence of selector params, and the fitted selectors can be
+    shared between them (see utils.cache). A candidate sampled before is
+    drawn again, and if the search space has at most n_iter candidates,
+    all of them are returned in random order.
+
+    Args:
+        hparams: Key-value pairs with the param name and a scipy
+            distribution or a list of values.
+        n_iter: The number of candidates.
+        selector: The name of the selector step in the pipeline.
+        random_state: Seed of the pseudo-random number generator.
+
+    Returns:
+        (list): The candidates, a dict of params each.
+
+    """
+    rng = check_random_state(random_state)
+    selector_seed, model_seed = rng.randint(np.iinfo(np.int32).max, size=2)
+    prefix = f"{selector}__"
+    selector_hparams = {
+        k: v for k, v in hparams.items() if k.startswith(prefix)
+    }
+    model_hparams = {
+        k: v for k, v in hparams.items() if not k.startswith(prefix)
+    }
+    if search_space_size(hparams) <= n_iter:
+        candidates = _enumerate(hparams)
+        return [candidates[i] for i in rng.permutation(len(candidates))]
+    selector_rng = check_random_state(selector_seed)
+    model_rng = check_random_state(model_seed)
+    # The model params are drawn again for a selector params already
+    # sampled with them, as many times as there are model params.
+    n_model_draws = int(min(search_space_size(model_hparams), 10))
+    candidates, seen = [], set()
+    for _ in range(100 * n_iter):
+        if len(candidates) == n_iter:
+            break
+        selector_params = _sample(selector_hparams, 1, selector_rng)[0]
+        for _ in range(n_model_draws):
+            model_params = _sample(model_hparams, 1, model_rng)[0]
+            params = dict(**model_params, **selector_params)
+            key = _params_key(params)
+            if key not in seen:
+                seen.add(key)
+                candidates.append(params)
+                break
+    return candidates
+
+
+def search_space_size(hparams: dict):
+    """
+    Returns the number of distinct candidates of the hyper-parameters
+    distributions, inf if one of them is continuous or unbounded.
+
+    Args:
+        hparams: Key-value pairs with the param name and a scipy
+            distribution or a list of values.
+
+    """
+    size = 1
+    for values in hparams.values():
+        if hasattr(values, "rvs"):
+            if not isinstance(values.dist, rv_discrete):
+                return np.inf
+            low, high = values.support()
+            if not (np.isfinite(low) and np.isfinite(high)):
+                return np.inf
+            size *= int(high - low + 1)
+        else:
+            size *= len(_values(values))
+    return size
+
+
+def _values(values):
+    # The distinct values of a param of a finite search space.
+    if hasattr(values, "rvs"):
+        low, high = values.support()
+        return list(range(int(low), int(high) + 1))
+    distinct = OrderedDict()
+    for value in values:
+        distinct.setdefault(str(value), value)
+    return list(distinct.values())
+
+
+def _enumerate(hparams):
+    # All the candidates of a finite search space.
+    names = sorted(hparams)
+    return [
+        dict(zip(names, values))
+        for values in itertools.product(
+            *(_values(hparams[name]) for name in names)
+        )
+    ]
+
+
+def _sample(hparams, n_iter, random_state):
+    rng = check_random_state(random_state)
+    candidates = []
+    for _ in range(n_iter):
+        params = dict()
+        for name, values in sorted(hparams.items()):
+            if hasattr(values, "rvs"):
+                params[name] = values.rvs(random_state=rng)
+            else:
+                params[name] = values[rng.randint(len(values))]
+        candidates.append(params)
+    return candidates
+
+
+def order_candidates(candidates: list, param: str):
+    """
+    Order the candidates for warm starts along a param.
+
+    The candidates that only differ in param are put next to each other,
+    in the order of their first appearance, and sorted by the value of
+    param, so each fit can start from the previous one (see
+    utils.warm_start).
+
+    Args:
+        candidates: The candidates, a dict of params each.
+        param: The name of the warm start param.
+
+    Returns:
+        (list): The ordered candidates.
+
+    """
+    groups = OrderedDict()
+    for params in candidates:
+        others = {k: v for k, v in params.items() if k != param}
+        groups.setdefault(_params_key(others), []).append(params)
+    return [
+        params
+        for group in groups.values()
+        for params in sorted(group, key=lambda p: p.get(param, 0))
+    ]
+
+
+def get_search(
+    search: str,
+    estimator,
+    hparams: dict,
+    n_iter: int,
+    selector: str = None,
+    scoring=None,
+    cv=None,
+    n_jobs=None,
+    random_state=None,
+    factor=3,
+    deadline=None,
+    refit=True,
+    warm_start=None,
+    results_log=None,
+):
+    """
+    Returns the hyper-parameter search for the given strategy.
+
+    Args:
+        search: "random" evaluates n_iter random candidates on all the
+            folds, "halving" evaluates them with successive halving,
+            "tpe" proposes each next candidate from the previous scores,
+            and "racing" drops the candidates that score lower than the
+            best one on the first folds.
+        estimator: The scikit-learn Pipeline.
+        hparams: Key-value pairs with the param name and a scipy
+            distribution or a list of values.
+        n_iter: The number of candidates.
+        selector: The name of the selector step in the pipeline.
+        scoring: Optimisation objective.
+        cv: The number of cross-validation folds.
+        n_jobs: The number of workers.
+        random_state: Seed of the pseudo-random number generator.
+        factor: The fraction of candidates kept at each halving iteration
+            is 1 / factor.
+        deadline: Time (as time.time()) after which the search stops
+            evaluating new candidates.
+        refit: Refit the best candidate on all the data.
+        warm_start: The param along which the random, halving and racing
+            candidates are ordered for warm starts, the candidates are
+            then evaluated one after the other.
+        results_log: Function called with the results of the candidates
+            as soon as they are evaluated, a dict per candidate.
+
+    """
+    # Each warm start continues from the previous fit of the process on
+    # the same fold, in parallel it would depend on which fits each
+    # worker took before.
+    if warm_start is not None:
+        n_jobs = 1
+    if search == "tpe":
+        return TPESearchCV(
+            estimator=estimator,
+            param_distributions=hparams,
+            n_iter=n_iter,
+            selector=selector,
+            random_state=random_state,
+            deadline=deadline,
+            results_log=results_log,
+            scoring=scoring,
+            cv=cv,
+            n_jobs=n_jobs,
+            refit=refit,
+        )
+    # Find optimal hyper-parameters with K-folds. The selector params are
+    # sampled apart from the classifier params, so that every classifier
+    # reuses the same fitted selectors.
+    candidates = sample_candidates(hparams, n_iter, selector, random_state)
+    if warm_start is not None:
+        candidates = order_candidates(candidates, warm_start)
+    if search == "halving":
+        return CandidatesHalvingSearchCV(
+            estimator=estimator,
+            candidates=candidates,
+            deadline=deadline,
+            results_log=results_log,
+            scoring=scoring,
+            cv=cv,
+            n_jobs=n_jobs,
+            refit=refit,
+            random_state=random_state,
+            factor=factor,
+        )
+    if search == "racing":
+        return RacingSearchCV(
+            estimator=estimator,
+            candidates=candidates,
+            deadline=deadline,
+            results_log=results_log,
+            scoring=scoring,
+            cv=cv,
+            n_jobs=n_jobs,
+            refit=refit,
+        )
+    if search == "random":
+        return CandidatesSearchCV(
+            estimator=estimator,
+            candidates=candidates,
+            deadline=deadline,
+            results_log=results_log,
+            scoring=scoring,
+            cv=cv,
+            n_jobs=n_jobs,
+            refit=refit,
+        )
+    raise ValueError(f"Unknown search {search}, allowed: {SEARCH_LIST}")
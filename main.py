@@ -13,9 +13,13 @@ __email__ = "ahmed.albuni@gmail.com"
 
 import argparse
 import json
+import os
 
 import experiment.experiment as ex
 import validations.validate_config as validate
+from experiment.metrics import compute_metrics
+from experiment.model_comparison import run_worker
+from experiment.predict import export_models, predict
 
 parser = argparse.ArgumentParser(
     description="Features selection and " "classifications (2 classes)"
@@ -27,12 +31,130 @@ parser.add_argument(
     "path, response var y should be "
     "the last field",
 )
+parser.add_argument(
+    "-resume",
+    "--resume",
+    type=str,
+    help="Output directory of an interrupted experiment to resume, the "
+    "finished cells are not run again. The configurations stored in this "
+    "directory are used if -file is not given",
+)
+parser.add_argument(
+    "-queue",
+    "--queue",
+    type=str,
+    help="Directory of a work queue on a shared file system, the cells are "
+    "run by the workers started with -worker on any node",
+)
+parser.add_argument(
+    "-worker",
+    "--worker",
+    type=str,
+    help="Run the cells of the work queue in this directory until the "
+    "experiment is finished",
+)
+parser.add_argument(
+    "-predict",
+    "--predict",
+    type=str,
+    help="Models folder of the output directory of an experiment, score "
+    "the features CSV file given with -data with the stored pipelines",
+)
+parser.add_argument(
+    "-export",
+    "--export",
+    type=str,
+    help="Models folder of the output directory of an experiment, fit the "
+    "models given with -models that were stored unfitted (REFIT lazy)",
+)
+parser.add_argument(
+    "-data", "--data", type=str, help="Features CSV file to score",
+)
+parser.add_argument(
+    "-output", "--output", type=str, help="CSV file of the scores",
+)
+parser.add_argument(
+    "-models",
+    "--models",
+    type=str,
+    default="best",
+    help="Comma separated names of the models used to score the data or "
+    "exported, "
+    '"best" (default) for the model with the best cross-validation score, '
+    'or "all"',
+)
+parser.add_argument(
+    "-chunksize",
+    "--chunksize",
+    type=int,
+    default=10000,
+    help="Number of rows of the features CSV file scored at once",
+)
+parser.add_argument(
+    "-metrics",
+    "--metrics",
+    type=str,
+    help="Output directory of an experiment, compute the metrics given "
+    "with -score_fun from the stored out-of-fold predictions, without "
+    "fitting the models again",
+)
+parser.add_argument(
+    "-score_fun",
+    "--score_fun",
+    type=str,
+    default="roc_auc",
+    help="Comma separated metrics computed with -metrics, such as "
+    "roc_auc,f1,recall",
+)
+parser.add_argument(
+    "-bootstrap",
+    "--bootstrap",
+    type=int,
+    default=1000,
+    help="Number of bootstrap resamples of the confidence intervals of the "
+    "metrics",
+)
+parser.add_argument(
+    "-n_jobs",
+    "--n_jobs",
+    type=int,
+    default=1,
+    help="Number of cpu units used by a worker",
+)
 
 if __name__ == "__main__":
 
     args = parser.parse_args()
 
-    with open(args.file) as config_file:
-        config = json.load(config_file)
-    if validate.validate_config_file(config):
-        ex.experiment(config)
+    if args.worker is not None:
+        run_worker(args.worker, n_jobs=args.n_jobs)
+    elif args.metrics is not None:
+        print(
+            compute_metrics(
+                args.metrics,
+                args.score_fun.split(","),
+                n_bootstrap=args.bootstrap,
+            ).to_string()
+        )
+    elif args.predict is not None or args.export is not None:
+        models = args.models
+        if models not in ("best", "all"):
+            models = models.split(",")
+        if args.predict is None:
+            export_models(args.export, models=models)
+        else:
+            predict(
+                args.predict,
+                args.data,
+                args.output,
+                models=models,
+                chunksize=args.chunksize,
+            )
+    else:
+        config_path = args.file
+        if config_path is None and args.resume is not None:
+            config_path = os.path.join(args.resume, "config.json")
+        with open(config_path) as config_file:
+            config = json.load(config_file)
+        if validate.validate_config_file(config):
+            ex.experiment(config, resume=args.resume, path_queue=args.queue)
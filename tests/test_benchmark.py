@@ -0,0 +1,41 @@
+import os
+import subprocess
+import sys
+
+import numpy as np
+import pytest
+
+from benchmarks.benchmark import compare, make_radiomics_data, measure, run
+
+
+def test_make_radiomics_data():
+    X, y, columns_names = make_radiomics_data(200, 25, block_size=10)
+    assert X.shape == (200, 25) and y.shape == (200,)
+    assert len(columns_names) == 25 and set(np.unique(y)) == {0, 1}
+    corr = np.corrcoef(X, rowvar=False)
+    # The features of a block are correlated, not those of two blocks.
+    assert corr[0, 1:10].min() > 0.7
+    assert np.abs(corr[0, 10:]).max() < 0.5
+
+
+def test_run_compare():
+    results = run([(100, 20)], benchmarks=("selectors", "cross_validation"))
+    names = [r["benchmark"] for r in results["results"]]
+    assert len(names) == 5 and "cross_validation" in names[-1]
+    assert all(r["seconds"] > 0 for r in results["results"])
+    assert compare(results, results) == []
+    slower = dict(
+        results=[dict(r, seconds=r["seconds"] * 2) for r in results["results"]]
+    )
+    assert len(compare(results, slower, tolerance=0.5)) == 5
+
+
+@pytest.mark.skipif(not os.path.isdir("/proc/self"), reason="Linux only")
+def test_measure_children():
+    code = "import numpy, time; a = numpy.ones(2 ** 24); time.sleep(1)"
+    seconds, peak_mb, children_mb = measure(
+        lambda: subprocess.run([sys.executable, "-c", code], check=True)
+    )
+    # The 128 MB of the child are not seen by tracemalloc.
+    assert seconds > 1 and peak_mb < 16
+    assert children_mb > 128
@@ -43,3 +43,37 @@ def test_seed():
     config["config"]["SEED"] = "S"
     with pytest.raises(ValidationError):
         validate.validate_config_file(config)
+    config["config"]["SEED"] = []
+    with pytest.raises(ValidationError):
+        validate.validate_config_file(config)
+    config["config"]["SEED"] = [1, 2, 3]
+    assert validate.validate_config_file(config)
+    config["config"]["SEED"] = [1, 2, 1]
+    with pytest.raises(ValidationError):
+        validate.validate_config_file(config)
+    config["config"]["SEED"] = 1
+    config["config"]["N_REPEATS"] = 0
+    with pytest.raises(ValidationError):
+        validate.validate_config_file(config)
+    config["config"]["N_REPEATS"] = 3
+    assert validate.validate_config_file(config)
+
+
+def test_search():
+    config["config"]["SEARCH"] = "halving"
+    assert validate.validate_config_file(config)
+    config["config"]["SEARCH"] = "racing"
+    assert validate.validate_config_file(config)
+    config["config"]["SEARCH"] = "grid"
+    with pytest.raises(ValidationError):
+        validate.validate_config_file(config)
+
+
+def test_time_limits():
+    for key in ("TIME_BUDGET", "TOTAL_TIME_BUDGET", "FIT_TIMEOUT"):
+        config["config"][key] = 0.5
+        assert validate.validate_config_file(config)
+        config["config"][key] = 0
+        with pytest.raises(ValidationError):
+            validate.validate_config_file(config)
+        del config["config"][key]
@@ -1,10 +1,72 @@
+import copy
+import glob
 import json
 import os
+import re
 import shutil
+import time
+import warnings
+from multiprocessing import Process, cpu_count
 
-from experiment.experiment import experiment, read_Xy_data
+import numpy as np
+import pytest
+from pandas import DataFrame, read_csv
+from scipy.stats import randint as sp_randint
+from scipy.stats import uniform as sp_uniform
+from sklearn.datasets import make_classification
+from sklearn.base import clone
+from sklearn.feature_selection import SelectKBest, VarianceThreshold
+from sklearn.linear_model import LogisticRegression
+from sklearn.metrics import f1_score, get_scorer, roc_auc_score
+from sklearn.model_selection import StratifiedKFold, cross_val_predict
+from sklearn.pipeline import Pipeline
+from sklearn.preprocessing import StandardScaler
+
+from experiment.comparison_schemes import cross_validation, timed_fit
+from experiment.experiment import (
+    experiment,
+    get_models,
+    get_random_states,
+    mean_std,
+    merge_dict,
+    plot_heat_map,
+    read_Xy_data,
+)
+from experiment.model_comparison import (
+    assign_workers,
+    grid_comparison_experiment,
+    repeated_comparison_experiment,
+    run_worker,
+    split_workers,
+)
+from experiment.metrics import (
+    bootstrap_weights,
+    compute_metrics,
+    metric_values,
+)
+from experiment.predict import export_models, predict
+from experiment.search import (
+    SEARCH_LIST,
+    CandidatesSearchCV,
+    RacingSearchCV,
+    TPESearchCV,
+    get_search,
+    order_candidates,
+    propose_candidates,
+    sample_candidates,
+    search_space_size,
+)
 from utils.classifiers import get_classifiers
+from utils.ioutil import (
+    read_model,
+    read_models_manifest,
+    read_results_log,
+)
 from utils.features_selectors import get_features_selectors
+from utils.oof import read_predictions
+from utils.warm_start import WarmStartPipeline, clear_paths
+from utils.work_queue import WorkQueue
+from validations.validate_config import score_fun_list
 
 current_path = os.path.dirname(os.path.abspath(__file__))
 json_path = os.path.join(current_path, "test_config.json")
@@ -13,7 +75,7 @@ with open(json_path) as config_file:
 config["config"]["features_file"] = os.path.join(
     current_path, "test_dataset.csv"
 )
-config["config"]["output_dir"] = os.path.join(current_path, "temp\\")
+config["config"]["output_dir"] = os.path.join(current_path, "temp", "")
 
 
 def test_read_Xy():
@@ -24,24 +86,1006 @@ def test_read_Xy():
     assert columns_names[0] == "Elongation"
 
 
-def test_exp():
-    p = config["config"]["output_dir"]
-    folder_to_delete = [os.path.join(p, f) for f in os.listdir(p)]
-    for f in folder_to_delete:
-        shutil.rmtree(f)
-    df = experiment(config, verbose=0)
+def test_read_Xy_cache(tmp_path):
+    path = str(tmp_path / "dataset.csv")
+    shutil.copy(config["config"]["features_file"], path)
+    X, y, columns_names = read_Xy_data(path)
+    X_cached, y_cached, columns_cached = read_Xy_data(path, cache=True)
+    assert os.path.isfile(path + ".cache/meta.json")
+    assert isinstance(X_cached, np.memmap)
+    assert np.array_equal(X_cached, X) and np.array_equal(y_cached, y)
+    assert columns_cached == columns_names
+    X_float32, _, _ = read_Xy_data(path, cache=True, float32=True)
+    assert X_float32.dtype == np.float32
+    assert np.allclose(X_float32, X, rtol=1e-6)
+    # Touching the file keeps the cache, changing it rebuilds the cache.
+    os.utime(path, (0, 0))
+    assert read_Xy_data(path, cache=True)[0].shape == X.shape
+    with open(path) as infile:
+        lines = infile.readlines()
+    with open(path, "w") as outfile:
+        outfile.writelines(lines[:-10])
+    os.utime(path, (0, 0))
+    assert read_Xy_data(path, cache=True)[0].shape == (X.shape[0] - 10, 22)
+    X_float32, _, _ = read_Xy_data(path, cache=True, float32=True)
+    assert X_float32.shape == (X.shape[0] - 10, 22)
+
+
+def test_string_labels(tmp_path):
+    path = str(tmp_path / "dataset.csv")
+    dataset = read_csv(config["config"]["features_file"])
+    dataset["DFS"] = np.where(dataset["DFS"] == 1, "event", "censored")
+    dataset.to_csv(path, index=False)
+    X, y, columns_names = read_Xy_data(path)
+    for _ in range(2):
+        # The cache is written, then read.
+        X_cached, y_cached, _ = read_Xy_data(path, cache=True)
+        assert np.array_equal(X_cached, X) and np.array_equal(y_cached, y)
+    # The labels are shared with the cells of a parallel run.
+    feature_list = get_features_selectors(config)
+    models, hparams = get_models(
+        "No feature selection",
+        feature_list["No feature selection"],
+        get_classifiers(config),
+    )
+    grid = {"No_feature_selection": (models, hparams, path + ".results")}
+    df, _ = grid_comparison_experiment(
+        X=X_cached,
+        y=y_cached,
+        columns_names=columns_names,
+        grid=grid,
+        score_func="roc_auc",
+        cv=2,
+        max_evals=1,
+        random_state=0,
+        verbose=0,
+        n_jobs=2,
+        df=DataFrame(dtype="float"),
+    )
+    assert ((df > 0) & (df < 1)).all(axis=None)
+
+
+def test_exp(tmp_path):
+    exp_config = copy.deepcopy(config)
+    p = os.path.join(str(tmp_path), "")
+    exp_config["config"]["output_dir"] = p
+    path_features = os.path.join(str(tmp_path), "features.csv")
+    shutil.copy(config["config"]["features_file"], path_features)
+    exp_config["config"]["features_file"] = path_features
+    df = experiment(exp_config, verbose=0)
+    # The binary cache of the features is opt-in.
+    assert not os.path.exists(path_features + ".cache")
     assert df.shape == (
-        len(get_classifiers(config)),
-        len(get_features_selectors(config)),
+        len(get_classifiers(exp_config)),
+        len(get_features_selectors(exp_config)),
     )
-    folder_name = [os.path.join(p, f) for f in os.listdir(p)]
-    assert len([f for f in os.listdir(folder_name[0])]) == 8
-    df2 = experiment(config, verbose=0)
+    folder_name = [
+        os.path.join(p, f) for f in os.listdir(p) if f != "features.csv"
+    ]
+    # The outputs, without the time stamps in their names.
+    assert sorted(
+        re.sub(r"_\d{8}-\d{6}", "", f) for f in os.listdir(folder_name[0])
+    ) == [
+        "candidates",
+        "checkpoints",
+        "config.json",
+        "features_freq.csv",
+        "fingerprint.txt",
+        "heatmap_data.csv",
+        "image.jpg",
+        "image_time.jpg",
+        "log.log",
+        "models",
+        "results_No_feature_selection.csv",
+        "results_ReliefF.csv",
+        "results_VarianceThreshold.csv",
+        "results_fisher_score.csv",
+        "results_mutual_info_classif.csv",
+        "time_heatmap_data.csv",
+    ]
+    df2 = experiment(exp_config, verbose=0)
     # Make sure we are able to reproduce the results when using the same seed
     assert df.equals(df2)
-    config["config"]["SEED"] = 999
-    df3 = experiment(config, verbose=0)
+    # A run is resumed from its checkpoints with the same settings only,
+    # and its stored configuration is kept.
+    assert experiment(exp_config, verbose=0, resume=folder_name[0]).equals(df)
+    changed_config = copy.deepcopy(exp_config)
+    changed_config["config"]["MAX_EVALS"] += 1
+    with pytest.raises(ValueError):
+        experiment(changed_config, verbose=0, resume=folder_name[0])
+    with open(os.path.join(folder_name[0], "config.json")) as config_file:
+        assert json.load(config_file) == exp_config
+    exp_config["config"]["SEED"] = 999
+    df3 = experiment(exp_config, verbose=0)
     assert not (df.equals(df3))
-    folder_to_delete = [os.path.join(p, f) for f in os.listdir(p)]
-    for f in folder_to_delete:
-        shutil.rmtree(f)
+
+
+def test_split_workers():
+    n_cells_jobs, n_search_jobs = split_workers(1, 30)
+    assert (n_cells_jobs, n_search_jobs) == (1, 1)
+    n_cells_jobs, n_search_jobs = split_workers(-1, 30)
+    assert n_cells_jobs * n_search_jobs <= cpu_count()
+    n_cells_jobs, n_search_jobs = split_workers(cpu_count(), 1)
+    assert (n_cells_jobs, n_search_jobs) == (1, cpu_count())
+
+
+def test_assign_workers():
+    cells = [
+        dict(selector=selector, experiment_id=model_name)
+        for selector, n_models in (("a", 1), ("b", 3), ("c", 2))
+        for model_name in range(n_models)
+    ]
+    workers = assign_workers(cells, 2)
+    assert [[cell["selector"] for cell in w] for w in workers] == [
+        ["b", "b", "b"],
+        ["c", "c", "a"],
+    ]
+    assert len(assign_workers(cells, 8)) == 3
+    assert len(assign_workers([], 8)) == 1
+
+
+def test_sample_candidates():
+    feature_list = get_features_selectors(config)
+    classifier_list = get_classifiers(config)
+    selector, selector_hparams = feature_list["relief_f"]
+    candidates = [
+        sample_candidates(
+            merge_dict(classifier_v[1], selector_hparams),
+            10,
+            selector[0],
+            random_state=0,
+        )
+        for classifier_v in classifier_list.values()
+    ]
+    assert all(len(c) == 10 for c in candidates)
+    # The candidates are distinct, and the classifiers are given the same
+    # sequence of selector params, except for the search spaces with only
+    # 10 candidates, which are all enumerated.
+    sequences = []
+    for classifier_v, c in zip(classifier_list.values(), candidates):
+        assert len({str(sorted(params.items())) for params in c}) == 10
+        hparams = merge_dict(classifier_v[1], selector_hparams)
+        if search_space_size(hparams) == 10:
+            continue
+        sequences.append([])
+        for params in c:
+            selector_params = [params[name] for name in selector_hparams]
+            if selector_params not in sequences[-1]:
+                sequences[-1].append(selector_params)
+    assert len(sequences) > 1
+    for sequence in sequences[1:]:
+        n = min(len(sequence), len(sequences[0]))
+        assert sequence[:n] == sequences[0][:n]
+
+
+def test_search_space_size():
+    hparams = {
+        "a": sp_randint(1, 2),
+        "b": ["x", "y", "x"],
+        "c": sp_randint(10, 15),
+    }
+    assert search_space_size(hparams) == 10
+    candidates = sample_candidates(hparams, 80, random_state=0)
+    assert len(candidates) == 10
+    assert len({str(sorted(p.items())) for p in candidates}) == 10
+    hparams["d"] = sp_uniform(0, 1)
+    assert search_space_size(hparams) == np.inf
+    assert len(sample_candidates(hparams, 80, random_state=0)) == 80
+
+
+@pytest.mark.parametrize("search", SEARCH_LIST)
+def test_cross_validation_search(search):
+    X, y, columns_names = read_Xy_data(config["config"]["features_file"])
+    feature_list = get_features_selectors(config)
+    models, hparams = get_models(
+        "mutual_info", feature_list["mutual_info"], get_classifiers(config)
+    )
+    output, df, selected_features = cross_validation(
+        X=X,
+        y=y,
+        columns_names=columns_names,
+        experiment_id="lr",
+        model=models["lr"],
+        hparams=hparams["lr"],
+        df=DataFrame(dtype="float"),
+        selector="mutual_info_classif",
+        cv=2,
+        max_evals=9,
+        random_state=0,
+        verbose=0,
+        search=search,
+    )
+    assert 0 <= df.at["lr", "mutual_info_classif"] <= 1
+    assert len(selected_features) == output["mutual_info_classif__param"]
+    # The search space of the test config has only 5 candidates.
+    assert output["search_space_size"] == 5
+    assert output["n_candidates_evaluated"] >= 5
+    assert output["timed_out_candidates"] == ""
+    assert float(output["cell_time"]) >= float(output["search_time"]) > 0
+    if search == "racing":
+        # Two folds are not enough to drop a candidate.
+        assert output["pruned_candidates"] == ""
+        assert output["n_fold_fits"] == 2 * output["n_candidates_evaluated"]
+
+
+def test_cross_validation_correlation_filter():
+    X, y, columns_names = read_Xy_data(config["config"]["features_file"])
+    feature_list = get_features_selectors(config)
+    models, hparams = get_models(
+        "mutual_info",
+        feature_list["mutual_info"],
+        get_classifiers(config),
+        correlation_threshold=0.9,
+    )
+    assert models["lr"].steps[0][0] == "CorrelationFilter"
+    output, _, selected_features = cross_validation(
+        X=X,
+        y=y,
+        columns_names=columns_names,
+        experiment_id="lr",
+        model=models["lr"],
+        hparams=hparams["lr"],
+        df=DataFrame(dtype="float"),
+        selector="mutual_info_classif",
+        cv=2,
+        max_evals=3,
+        random_state=0,
+        verbose=0,
+    )
+    removed_features = output["removed correlated features"].split(", ")
+    corr = DataFrame(X, columns=columns_names).corr().abs()
+    for feature in removed_features:
+        assert corr[feature].drop(feature).max() > 0.9
+    assert len(selected_features) == output["mutual_info_classif__param"]
+    assert not set(selected_features) & set(removed_features)
+
+
+def test_cross_validation_lazy_refit(tmp_path):
+    X, y, columns_names = read_Xy_data(config["config"]["features_file"])
+    feature_list = get_features_selectors(config)
+    models, hparams = get_models(
+        "mutual_info",
+        feature_list["mutual_info"],
+        get_classifiers(config),
+        correlation_threshold=0.9,
+    )
+    output, _, selected_features = cross_validation(
+        X=X,
+        y=y,
+        columns_names=columns_names,
+        experiment_id="lr",
+        model=models["lr"],
+        hparams=hparams["lr"],
+        df=DataFrame(dtype="float"),
+        selector="mutual_info_classif",
+        cv=3,
+        max_evals=3,
+        random_state=0,
+        verbose=0,
+        n_jobs=2,
+        path_models=tmp_path / "models",
+        refit="lazy",
+    )
+    assert output["refit_selector_time"] == "0.000"
+    # The features selected, or removed, in at least half of the folds by
+    # the best candidate.
+    best_params = {k: v for k, v in output.items() if "__" in k}
+    model = clone(models["lr"]).set_params(
+        **best_params,
+        mutual_info_classif__random_state=0,
+        LogisticRegression__random_state=0,
+    )
+    selected = np.zeros(len(columns_names))
+    removed = np.zeros(len(columns_names))
+    for train, _ in StratifiedKFold(3).split(X, y):
+        model.fit(X[train], y[train])
+        support = model.named_steps["CorrelationFilter"].get_support()
+        removed += ~support
+        selector = model.named_steps["mutual_info_classif"]
+        selected[np.flatnonzero(support)[selector.get_support()]] += 1
+    assert selected_features == [
+        name for name, n in zip(columns_names, selected) if n >= 1.5
+    ]
+    assert output["removed correlated features"] == ", ".join(
+        name for name, n in zip(columns_names, removed) if n >= 1.5
+    )
+    assert output["features scores/importance "].startswith("feature_scores")
+
+    # The model is stored unfitted, and fitted on the features file of the
+    # experiment when it is first used.
+    name = "mutual_info_classif__lr__0"
+    assert not read_models_manifest(tmp_path / "models")[name]["fitted"]
+    with open(tmp_path / "config.json", "w") as config_file:
+        json.dump(
+            {
+                "config": {
+                    "features_file": config["config"]["features_file"],
+                    "DATA_CACHE": False,
+                }
+            },
+            config_file,
+        )
+    DataFrame(X, columns=columns_names).to_csv(
+        tmp_path / "new.csv", index=False
+    )
+    predict(tmp_path / "models", tmp_path / "new.csv", tmp_path / "s.csv")
+    manifest = read_models_manifest(tmp_path / "models")[name]
+    assert manifest["fitted"]
+    model.fit(X, y)
+    assert np.allclose(
+        read_csv(tmp_path / "s.csv")[name], model.predict_proba(X)[:, 1]
+    )
+    assert export_models(tmp_path / "models") == [name]
+
+
+def test_predict(tmp_path):
+    X, y, columns_names = read_Xy_data(config["config"]["features_file"])
+    feature_list = get_features_selectors(config)
+    models, hparams = get_models(
+        "mutual_info", feature_list["mutual_info"], get_classifiers(config)
+    )
+    outputs = dict()
+    for model_name in ("lr", "ridge"):
+        outputs[model_name], _, selected_features = cross_validation(
+            X=X,
+            y=y,
+            columns_names=columns_names,
+            experiment_id=model_name,
+            model=models[model_name],
+            hparams=hparams[model_name],
+            df=DataFrame(dtype="float"),
+            selector="mutual_info_classif",
+            cv=2,
+            max_evals=3,
+            random_state=0,
+            verbose=0,
+            path_models=tmp_path / "models",
+        )
+    manifests = read_models_manifest(tmp_path / "models")
+    assert list(manifests) == [
+        "mutual_info_classif__lr__0",
+        "mutual_info_classif__ridge__0",
+    ]
+    manifest = manifests["mutual_info_classif__lr__0"]
+    assert manifest["features"] == columns_names
+    assert manifest["selected_features"] == selected_features
+    assert f"{manifest['test_score']:.5f}" == outputs["lr"]["test_score"]
+
+    # The new samples have an identifier and no response.
+    new_data = DataFrame(X[::-1], columns=columns_names)
+    new_data.insert(0, "id", np.arange(len(X)))
+    new_data.to_csv(tmp_path / "new.csv", index=False)
+    used = predict(
+        tmp_path / "models",
+        tmp_path / "new.csv",
+        tmp_path / "scores.csv",
+        models="all",
+        chunksize=50,
+    )
+    assert used == list(manifests)
+    scores = read_csv(tmp_path / "scores.csv")
+    assert list(scores.columns) == ["id"] + used
+    assert np.array_equal(scores["id"], np.arange(len(X)))
+    lr = read_model(tmp_path / "models", manifest)
+    assert np.allclose(
+        scores["mutual_info_classif__lr__0"], lr.predict_proba(X[::-1])[:, 1]
+    )
+    ridge = read_model(
+        tmp_path / "models", manifests["mutual_info_classif__ridge__0"]
+    )
+    assert np.allclose(
+        scores["mutual_info_classif__ridge__0"],
+        ridge.decision_function(X[::-1]),
+    )
+    best = max(used, key=lambda name: manifests[name]["test_score"])
+    assert predict(
+        tmp_path / "models", tmp_path / "new.csv", tmp_path / "best.csv"
+    ) == [best]
+
+
+def test_cross_validation_predictions(tmp_path):
+    X, y, columns_names = read_Xy_data(config["config"]["features_file"])
+    feature_list = get_features_selectors(config)
+    models, hparams = get_models(
+        "mutual_info", feature_list["mutual_info"], get_classifiers(config)
+    )
+    for model_name in ("lr", "svc"):
+        output, _, _ = cross_validation(
+            X=X,
+            y=y,
+            columns_names=columns_names,
+            experiment_id=model_name,
+            model=models[model_name],
+            hparams=hparams[model_name],
+            df=DataFrame(dtype="float"),
+            selector="mutual_info_classif",
+            cv=3,
+            max_evals=4,
+            random_state=0,
+            verbose=0,
+            n_jobs=2,
+            path_predictions=tmp_path / "predictions",
+            all_predictions=True,
+        )
+        # The same predictions as the best candidate fitted on each fold.
+        best_params = {k: v for k, v in output.items() if "__" in k}
+        model = clone(models[model_name]).set_params(**best_params)
+        for name, step in model.steps:
+            if "random_state" in step.get_params():
+                model.set_params(**{name + "__random_state": 0})
+        method = (
+            "predict_proba"
+            if hasattr(model, "predict_proba")
+            else "decision_function"
+        )
+        expected = cross_val_predict(
+            model, X, y, cv=StratifiedKFold(3), method=method
+        )
+        if method == "predict_proba":
+            expected = expected[:, 1]
+        cell = read_predictions(tmp_path / "predictions")[-1]
+        assert cell["model_name"] == model_name
+        assert np.allclose(cell["scores"], expected)
+        labels = cross_val_predict(model, X, y, cv=StratifiedKFold(3))
+        assert np.array_equal(cell["labels"], labels)
+        assert f"{cell['test_score']:.5f}" == output["test_score"]
+        n_candidates = output["n_candidates_evaluated"]
+        assert cell["candidate_scores"].shape == (n_candidates, len(y))
+        assert not np.isnan(cell["candidate_scores"]).any()
+    assert sorted(os.listdir(tmp_path / "predictions")) == [
+        "mutual_info_classif__lr__0.npz",
+        "mutual_info_classif__svc__0.npz",
+    ]
+
+    results = compute_metrics(tmp_path, ["roc_auc", "f1"], n_bootstrap=50)
+    assert len(results) == 4
+    lr = results[results["model_name"] == "lr"].set_index("metric")
+    cell = read_predictions(tmp_path / "predictions")[0]
+    assert lr.at["roc_auc", "value"] == pytest.approx(
+        roc_auc_score(y, cell["scores"])
+    )
+    assert lr.at["f1", "value"] == pytest.approx(f1_score(y, cell["labels"]))
+    assert np.all(results["ci_lower"] <= results["value"])
+    assert np.all(results["value"] <= results["ci_upper"])
+    assert os.path.exists(tmp_path / "metrics" / "metrics.csv")
+    assert os.listdir(tmp_path / "metrics" / "f1")
+
+
+@pytest.mark.parametrize("metric", score_fun_list)
+def test_metric_values(metric):
+    rng = np.random.RandomState(0)
+    y = rng.randint(0, 2, 300)
+    scores = np.round(rng.rand(300) + 0.3 * y, 2)
+    labels = (scores > 0.6).astype(int)
+    weights = np.vstack(list(bootstrap_weights(300, 5, batch_size=600)))
+    assert np.all(weights[0] == 1)
+    assert np.all(weights.sum(axis=1) == 300)
+    scorer = get_scorer(metric)
+    expected = [
+        scorer._score_func(
+            y,
+            scores if metric == "roc_auc" else labels,
+            sample_weight=w,
+            **scorer._kwargs,
+        )
+        for w in weights
+    ]
+    assert np.allclose(
+        metric_values(metric, y, labels, scores, weights), expected
+    )
+
+
+def test_results_log_batches():
+    X, y = make_classification(n_samples=60, random_state=0)
+    candidates = [{"C": c} for c in (0.1, 1.0, 10.0, 100.0)]
+    for deadline, n_calls in ((None, 1), (time.time() + 3600, 2)):
+        calls = []
+        CandidatesSearchCV(
+            LogisticRegression(),
+            candidates,
+            deadline=deadline,
+            results_log=calls.append,
+            cv=2,
+            n_jobs=2,
+        ).fit(X, y)
+        # The log does not split the search into batches of n_jobs, only
+        # the deadline does.
+        assert len(calls) == n_calls
+        assert sum(len(c) for c in calls) == len(candidates)
+
+
+def test_cross_validation_results_log(tmp_path):
+    X, y, columns_names = read_Xy_data(config["config"]["features_file"])
+    feature_list = get_features_selectors(config)
+    models, hparams = get_models(
+        "mutual_info", feature_list["mutual_info"], get_classifiers(config)
+    )
+    for search in SEARCH_LIST:
+        output, _, _ = cross_validation(
+            X=X,
+            y=y,
+            columns_names=columns_names,
+            experiment_id="lr",
+            model=models["lr"],
+            hparams=hparams["lr"],
+            df=DataFrame(dtype="float"),
+            selector="mutual_info_classif",
+            cv=2,
+            max_evals=6,
+            random_state=0,
+            verbose=0,
+            n_jobs=2,
+            search=search,
+            path_results_log=str(tmp_path),
+        )
+        log = read_results_log(str(tmp_path))
+        # Every evaluated candidate is logged with its fold scores.
+        assert len(log) == output["n_candidates_evaluated"]
+        assert (log["selector"] == "mutual_info_classif").all()
+        assert log["split1_test_score"].notna().all()
+        if search == "halving":
+            # The best candidate of the last iteration.
+            log = log[log["iter"] == log["iter"].max()]
+        best = log["mean_test_score"].idxmax()
+        assert "{:.5f}".format(log.at[best, "mean_test_score"]) == (
+            output["test_score"]
+        )
+
+
+def test_timed_fit():
+    X, y = make_classification(n_samples=80, n_features=6, random_state=0)
+    model = Pipeline(
+        [
+            ("scaler", StandardScaler()),
+            ("selector", VarianceThreshold()),
+            ("lr", LogisticRegression()),
+        ]
+    )
+    expected = clone(model).fit(X, y).decision_function(X)
+    times = timed_fit(model, X, y)
+    assert all(t >= 0 for t in times)
+    assert np.array_equal(model.decision_function(X), expected)
+
+
+def test_cross_validation_budget():
+    X, y, columns_names = read_Xy_data(config["config"]["features_file"])
+    feature_list = get_features_selectors(config)
+    models, hparams = get_models(
+        "No feature selection",
+        feature_list["No feature selection"],
+        get_classifiers(config),
+    )
+    kwargs = dict(
+        X=X,
+        y=y,
+        columns_names=columns_names,
+        experiment_id="svc",
+        model=models["svc"],
+        hparams=hparams["svc"],
+        selector="No_feature_selection",
+        cv=2,
+        max_evals=4,
+        random_state=0,
+        verbose=0,
+    )
+    # The search stops after the first batch once the budget runs out.
+    output, _, _ = cross_validation(
+        df=DataFrame(dtype="float"), time_budget=0, **kwargs
+    )
+    assert output["n_candidates_evaluated"] == 1
+    # The fits that time out are stopped and scored NaN, with every search
+    # strategy of the pinned scikit-learn versions.
+    for search in SEARCH_LIST:
+        output, df, _ = cross_validation(
+            df=DataFrame(dtype="float"),
+            fit_timeout=1e-6,
+            search=search,
+            **kwargs,
+        )
+        # The halving search evaluates the kept candidates again.
+        n_evaluated = 6 if search == "halving" else 4
+        assert output["n_candidates_evaluated"] == n_evaluated
+        assert output["timed_out_candidates"].count("{") == n_evaluated
+        assert np.isnan(df.at["svc", "No_feature_selection"])
+
+
+def test_cross_validation_timeout_rows(tmp_path):
+    X, y, columns_names = read_Xy_data(config["config"]["features_file"])
+    np.save(str(tmp_path / "X.npy"), X)
+    X_mapped = np.load(str(tmp_path / "X.npy"), mmap_mode="r")
+    feature_list = get_features_selectors(config)
+    models, hparams = get_models(
+        "No feature selection",
+        feature_list["No feature selection"],
+        get_classifiers(config),
+    )
+    for search in SEARCH_LIST:
+        kwargs = dict(
+            y=y,
+            columns_names=columns_names,
+            experiment_id="svc",
+            model=models["svc"],
+            hparams=hparams["svc"],
+            selector="No_feature_selection",
+            cv=3,
+            max_evals=4,
+            random_state=0,
+            verbose=0,
+            search=search,
+        )
+        _, df, _ = cross_validation(
+            X=X, df=DataFrame(dtype="float"), **kwargs
+        )
+        # The fit process reads the folds from the mapped file of X.
+        output, df_timeout, _ = cross_validation(
+            X=X_mapped, df=DataFrame(dtype="float"), fit_timeout=60, **kwargs
+        )
+        assert df_timeout.equals(df)
+        assert output["timed_out_candidates"] == ""
+
+
+def test_cross_validation_warm_start():
+    X, y, columns_names = read_Xy_data(config["config"]["features_file"])
+    warm_config = copy.deepcopy(config)
+    warm_config["config"]["classifications"]["ET"].update(
+        n_estimators_from=5, n_estimators_to=30
+    )
+    feature_list = get_features_selectors(warm_config)
+    models, hparams = get_models(
+        "No feature selection",
+        feature_list["No feature selection"],
+        get_classifiers(warm_config),
+    )
+    # The candidates only differ in the number of trees.
+    n_estimators = "ExtraTreesClassifier__n_estimators"
+    candidates = order_candidates(
+        [{"a": 1, "b": 3}, {"a": 2, "b": 1}, {"a": 1, "b": 1}], "b"
+    )
+    assert candidates == [{"a": 1, "b": 1}, {"a": 1, "b": 3}, {"a": 2, "b": 1}]
+    kwargs = dict(
+        X=X,
+        y=y,
+        columns_names=columns_names,
+        experiment_id="et",
+        model=models["et"],
+        hparams={n_estimators: hparams["et"][n_estimators]},
+        selector="No_feature_selection",
+        cv=2,
+        max_evals=6,
+        random_state=0,
+        verbose=0,
+    )
+    output, df, _ = cross_validation(df=DataFrame(dtype="float"), **kwargs)
+    # The trees of the warm started fits are the same as of the cold fits.
+    output_warm, df_warm, _ = cross_validation(
+        df=DataFrame(dtype="float"), warm_start=True, **kwargs
+    )
+    assert df_warm.equals(df)
+    assert output_warm["test_score"] == output["test_score"]
+
+
+def test_warm_start_parallel():
+    X, y = make_classification(n_samples=200, n_features=8, random_state=0)
+    # Few iterations, so the solution depends on the starting point.
+    model = WarmStartPipeline(
+        [
+            ("scaler", StandardScaler()),
+            ("clf", LogisticRegression(max_iter=3, tol=1e-8)),
+        ]
+    )
+    hparams = {"clf__C": sp_uniform(0.01, 10)}
+    results = []
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        for n_jobs in (1, 4):
+            clear_paths()
+            optimizer = get_search(
+                "random",
+                model,
+                hparams,
+                n_iter=12,
+                scoring="neg_log_loss",
+                cv=4,
+                n_jobs=n_jobs,
+                random_state=0,
+                refit=False,
+                warm_start="clf__C",
+            ).fit(X, y)
+            results.append(optimizer.cv_results_)
+    # The same warm starts with any number of jobs.
+    for i in range(4):
+        assert np.array_equal(
+            results[0][f"split{i}_test_score"],
+            results[1][f"split{i}_test_score"],
+        )
+
+
+def test_tpe_search():
+    X, y = make_classification(n_samples=80, n_features=6, random_state=0)
+    hparams = {
+        "LogisticRegression__C": sp_uniform(0.01, 10),
+        "LogisticRegression__fit_intercept": [True, False],
+    }
+    model = Pipeline([("LogisticRegression", LogisticRegression())])
+    optimizer = TPESearchCV(
+        model, hparams, n_iter=12, random_state=0, cv=2, n_jobs=2
+    ).fit(X, y)
+    params = optimizer.cv_results_["params"]
+    assert len(params) == 12
+    assert all(0.01 <= p["LogisticRegression__C"] <= 10.01 for p in params)
+    # The proposals are not evaluated twice.
+    proposals = propose_candidates(
+        hparams, params, optimizer.cv_results_["mean_test_score"], 4
+    )
+    assert len(proposals) == 4
+    assert all(p not in params for p in proposals)
+
+
+def test_racing_search():
+    X, y = make_classification(
+        n_samples=300,
+        n_features=20,
+        n_informative=5,
+        shuffle=False,
+        random_state=0,
+    )
+    model = Pipeline(
+        [
+            ("StandardScaler", StandardScaler()),
+            ("SelectKBest", SelectKBest()),
+            ("LogisticRegression", LogisticRegression()),
+        ]
+    )
+    candidates = [
+        {"SelectKBest__k": k, "LogisticRegression__C": C}
+        for k in (1, 2, 5, 10)
+        for C in (0.001, 1.0)
+    ]
+    racing = RacingSearchCV(
+        model, candidates, scoring="roc_auc", cv=10, refit=False, n_jobs=2
+    ).fit(X, y)
+    full = CandidatesSearchCV(
+        model, candidates, scoring="roc_auc", cv=10, refit=False, n_jobs=2
+    ).fit(X, y)
+    results = racing.cv_results_
+    # The same best candidate with fewer fold fits.
+    assert racing.best_params_ == full.best_params_
+    assert racing.best_score_ == pytest.approx(full.best_score_)
+    assert results["pruned"].any() and not results["pruned"].all()
+    assert results["n_folds_evaluated"].sum() < 10 * len(candidates)
+    assert np.all(results["n_folds_evaluated"] >= 3)
+    assert np.all(results["n_folds_evaluated"][~results["pruned"]] == 10)
+    assert results["rank_test_score"][racing.best_index_] == 1
+    for i in np.flatnonzero(~results["pruned"]):
+        assert results["mean_test_score"][i] == pytest.approx(
+            full.cv_results_["mean_test_score"][i]
+        )
+    pruned = np.flatnonzero(results["pruned"])[0]
+    n_folds = results["n_folds_evaluated"][pruned]
+    assert np.isnan(results[f"split{n_folds}_test_score"][pruned])
+    assert results[f"split{n_folds - 1}_test_score"][pruned] == (
+        full.cv_results_[f"split{n_folds - 1}_test_score"][pruned]
+    )
+
+
+def test_grid_checkpoints(tmp_path):
+    X, y, columns_names = read_Xy_data(config["config"]["features_file"])
+    feature_list = get_features_selectors(config)
+    models, hparams = get_models(
+        "No feature selection",
+        feature_list["No feature selection"],
+        get_classifiers(config),
+    )
+    grid = {
+        "No_feature_selection": (
+            models,
+            hparams,
+            os.path.join(tmp_path, "results.csv"),
+        )
+    }
+    kwargs = dict(
+        X=X,
+        y=y,
+        columns_names=columns_names,
+        grid=grid,
+        score_func="roc_auc",
+        cv=2,
+        max_evals=1,
+        random_state=0,
+        verbose=0,
+        path_checkpoints=os.path.join(tmp_path, "checkpoints"),
+    )
+    times_df = DataFrame(dtype="float")
+    df, _ = grid_comparison_experiment(
+        df=DataFrame(dtype="float"), times_df=times_df, **kwargs
+    )
+    assert times_df.shape == df.shape and (times_df > 0).all(axis=None)
+    assert len(os.listdir(kwargs["path_checkpoints"])) == len(models)
+    # Stored cells are not run again.
+    checkpoint_file = os.path.join(
+        kwargs["path_checkpoints"], "No_feature_selection__lr__0.json"
+    )
+    with open(checkpoint_file) as f:
+        checkpoint = json.load(f)
+    checkpoint["score"] = 0.5
+    with open(checkpoint_file, "w") as f:
+        json.dump(checkpoint, f)
+    df2, _ = grid_comparison_experiment(df=DataFrame(dtype="float"), **kwargs)
+    assert df2.at["lr", "No_feature_selection"] == 0.5
+    assert df2.drop(index="lr").equals(df.drop(index="lr"))
+
+
+def test_repeated_comparison(tmp_path):
+    X, y, columns_names = read_Xy_data(config["config"]["features_file"])
+    feature_list = get_features_selectors(config)
+    models, hparams = get_models(
+        "mutual_info", feature_list["mutual_info"], get_classifiers(config)
+    )
+    models = {k: models[k] for k in ("lr", "dt")}
+    grid = {
+        "mutual_info_classif": (
+            models,
+            hparams,
+            os.path.join(tmp_path, "results.csv"),
+        )
+    }
+    kwargs = dict(
+        X=X,
+        y=y,
+        columns_names=columns_names,
+        grid=grid,
+        score_func="roc_auc",
+        cv=2,
+        max_evals=2,
+        verbose=0,
+    )
+    scores, times, features = repeated_comparison_experiment(
+        random_states=[0, 1],
+        n_jobs=2,
+        path_checkpoints=os.path.join(tmp_path, "checkpoints"),
+        **kwargs,
+    )
+    assert len(os.listdir(os.path.join(tmp_path, "checkpoints"))) == 4
+    # Each repeat gives the same results as a single run with its seed.
+    for random_state in (0, 1):
+        df, selected_features = grid_comparison_experiment(
+            df=DataFrame(dtype="float"), random_state=random_state, **kwargs
+        )
+        assert scores[random_state].equals(df)
+        assert features[random_state] == selected_features
+        assert (times[random_state] > 0).all(axis=None)
+    assert not scores[0].equals(scores[1])
+    mean_df, std_df = mean_std(scores.values())
+    assert np.allclose(mean_df, (scores[0] + scores[1]) / 2)
+    assert (std_df > 0).any(axis=None)
+    plot_heat_map(mean_df, config, 0, str(tmp_path), std_df=std_df)
+    assert os.path.isfile(glob.glob(str(tmp_path / "image_*.jpg"))[0])
+
+
+def test_get_random_states():
+    repeat_config = copy.deepcopy(config)
+    assert get_random_states(repeat_config) == [
+        repeat_config["config"]["SEED"]
+    ]
+    repeat_config["config"].update(SEED=10, N_REPEATS=3)
+    assert get_random_states(repeat_config) == [10, 11, 12]
+    repeat_config["config"]["SEED"] = [5, 3]
+    assert get_random_states(repeat_config) == [5, 3]
+
+
+def test_work_queue_lease(tmp_path):
+    queue = WorkQueue(str(tmp_path), lease_timeout=0.5)
+    queue.reset()
+    queue.put("cell", {"a": 1})
+    assert queue.lease() == ("cell", {"a": 1})
+    assert queue.lease() is None
+    # The file times are not used, a just taken lease does not expire.
+    coordinator = WorkQueue(str(tmp_path), lease_timeout=0.5)
+    os.utime(os.path.join(queue.path, "leases", "cell.pkl"), (0, 0))
+    coordinator.requeue_expired()
+    assert queue.lease() is None
+    # A renewed lease does not expire.
+    time.sleep(0.6)
+    queue.renew("cell")
+    coordinator.requeue_expired()
+    assert queue.lease() is None
+    # An expired lease is given to the next worker.
+    time.sleep(0.6)
+    coordinator.requeue_expired()
+    assert queue.lease() == ("cell", {"a": 1})
+    queue.complete("cell", {"score": 1.0})
+    assert queue.results() == [{"score": 1.0}]
+    assert not os.listdir(os.path.join(queue.path, "leases"))
+
+
+def test_grid_work_queue(tmp_path):
+    X, y, columns_names = read_Xy_data(config["config"]["features_file"])
+    feature_list = get_features_selectors(config)
+    grid = dict()
+    for name in ("No feature selection", "variance_threshold"):
+        models, hparams = get_models(
+            name, feature_list[name], get_classifiers(config)
+        )
+        selector = feature_list[name][0][0]
+        path_results = os.path.join(tmp_path, selector + ".csv")
+        grid[selector] = (models, hparams, path_results)
+    kwargs = dict(
+        X=X,
+        y=y,
+        columns_names=columns_names,
+        grid=grid,
+        score_func="roc_auc",
+        cv=2,
+        max_evals=2,
+        random_state=0,
+        verbose=0,
+    )
+    path_queue = os.path.join(tmp_path, "queue")
+    workers = [
+        Process(target=run_worker, args=(path_queue, 1, 60, 0.1))
+        for _ in range(3)
+    ]
+    for worker in workers:
+        worker.start()
+    try:
+        df, features = grid_comparison_experiment(
+            df=DataFrame(dtype="float"), path_queue=path_queue, **kwargs
+        )
+    finally:
+        for worker in workers:
+            worker.join(timeout=10)
+            worker.terminate()
+    # The workers exit once the coordinator stops the queue.
+    assert all(worker.exitcode == 0 for worker in workers)
+    assert os.listdir(path_queue) == ["STOP"]
+    df_local, features_local = grid_comparison_experiment(
+        df=DataFrame(dtype="float"), **kwargs
+    )
+    assert df.equals(df_local)
+    assert features == features_local
+
+
+def test_grid_failed_cell(tmp_path, monkeypatch):
+    X, y, columns_names = read_Xy_data(config["config"]["features_file"])
+    feature_list = get_features_selectors(config)
+    models, hparams = get_models(
+        "No feature selection",
+        feature_list["No feature selection"],
+        get_classifiers(config),
+    )
+    # The cells fail after their search, the selector is not a step.
+    grid = {"missing_selector": (models, hparams, str(tmp_path / "r.csv"))}
+    kwargs = dict(
+        X=X,
+        y=y,
+        columns_names=columns_names,
+        grid=grid,
+        score_func="roc_auc",
+        cv=2,
+        max_evals=1,
+        random_state=0,
+        verbose=0,
+        df=DataFrame(dtype="float"),
+    )
+    monkeypatch.chdir(tmp_path)
+    # The temporary directory of another run in the same directory.
+    os.mkdir(tmp_path / "tmp_comparison_other")
+    with pytest.raises(KeyError):
+        grid_comparison_experiment(**kwargs)
+    # Only the temporary directory of this run is removed.
+    assert glob.glob(str(tmp_path / "tmp_comparison*")) == [
+        str(tmp_path / "tmp_comparison_other")
+    ]
+    os.rmdir(tmp_path / "tmp_comparison_other")
+    path_queue = str(tmp_path / "queue")
+    worker = Process(target=run_worker, args=(path_queue, 1, 60, 0.1))
+    worker.start()
+    try:
+        with pytest.raises(RuntimeError):
+            grid_comparison_experiment(path_queue=path_queue, **kwargs)
+    finally:
+        worker.join(timeout=10)
+        worker.terminate()
+    # The worker exits, and the queue is removed.
+    assert worker.exitcode == 0
+    assert os.listdir(path_queue) == ["STOP"]
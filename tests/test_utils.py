@@ -1,10 +1,45 @@
+import copy
 import json
 import os
+import pickle
+import subprocess
+import sys
 
+import numpy as np
 import pytest
+from lightgbm import LGBMClassifier
+from sklearn.base import clone
+from sklearn.datasets import make_classification
+from sklearn.dummy import DummyClassifier
+from sklearn.ensemble import ExtraTreesClassifier
+from sklearn.feature_selection import (
+    GenericUnivariateSelect,
+    f_classif,
+    mutual_info_classif,
+)
+from sklearn.linear_model import LogisticRegression
+from sklearn.metrics import get_scorer
+from sklearn.model_selection import StratifiedKFold
+from sklearn.pipeline import Pipeline
+from sklearn.preprocessing import StandardScaler
+from sklearn.svm import SVC
+from sklearn.tree import DecisionTreeClassifier
+from skrebate import ReliefF
 
+from utils import oof
+from utils.cache import TransformerCache
 from utils.classifiers import get_classifiers
-from utils.features_selectors import get_features_selectors
+from utils.features_selectors import (
+    CorrelationFilter,
+    KBestSelector,
+    ReliefFSelector,
+    binned_mutual_info,
+    fisher_score,
+    get_features_selectors,
+)
+from utils.fit_timeout import TimeoutPipeline, TimeoutScorer
+from utils.shared_data import SharedDataset
+from utils.warm_start import WarmStartPipeline, clear_paths
 
 path = os.path.join(
     os.path.dirname(os.path.abspath(__file__)), "test_config.json"
@@ -23,3 +58,308 @@ def test_get_features_selectors():
     c_list = get_features_selectors(config)
     assert isinstance(c_list, dict)
     assert len(c_list) > 0
+
+
+def test_configured_estimators_only():
+    subset_config = copy.deepcopy(config)
+    subset_config["config"]["classifications"] = {
+        "LR": config["config"]["classifications"]["LR"]
+    }
+    subset_config["config"]["selectors"] = {
+        "mutual_info": config["config"]["selectors"]["mutual_info"]
+    }
+    assert list(get_classifiers(subset_config)) == ["lr"]
+    assert list(get_features_selectors(subset_config)) == [
+        "mutual_info",
+        "No feature selection",
+    ]
+    # The libraries of the other estimators and the plotting libraries are
+    # not imported.
+    code = (
+        "import json, sys\n"
+        "import experiment.experiment\n"
+        "from utils.classifiers import get_classifiers\n"
+        "from utils.features_selectors import get_features_selectors\n"
+        "config = json.loads(sys.argv[1])\n"
+        "get_classifiers(config)\n"
+        "get_features_selectors(config)\n"
+        "modules = ('lightgbm', 'skrebate', 'matplotlib', 'seaborn')\n"
+        "print(sorted(m for m in modules if m in sys.modules))\n"
+    )
+    output = subprocess.run(
+        [sys.executable, "-c", code, json.dumps(subset_config)],
+        cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+        capture_output=True,
+        text=True,
+        check=True,
+    ).stdout
+    assert output.strip() == "[]"
+
+
+def test_transformer_cache():
+    X, y = make_classification(n_samples=60, n_features=8, random_state=0)
+    memory = TransformerCache(name="test", max_bytes=2 ** 20)
+    memory.clear()
+    for classifier in (LogisticRegression(), DecisionTreeClassifier()):
+        Pipeline(
+            [("StandardScaler", StandardScaler()), ("clf", classifier)],
+            memory=memory,
+        ).fit(X, y)
+    assert memory.info()["misses"] == 1
+    assert memory.info()["hits"] == 1
+    memory.max_bytes = 1
+    Pipeline(
+        [("StandardScaler", StandardScaler()), ("clf", LogisticRegression())],
+        memory=memory,
+    ).fit(X[:30], y[:30])
+    assert memory.info()["nbytes"] == 0
+    memory.clear()
+
+
+scores_calls = []
+
+
+def count_f_classif(X, y):
+    scores_calls.append(1)
+    return f_classif(X, y)
+
+
+def test_k_best_selector():
+    X, y = make_classification(n_samples=60, n_features=8, random_state=0)
+    memory = TransformerCache(name="test_scores")
+    memory.clear()
+    for k in range(9):
+        selector = KBestSelector(count_f_classif, param=k, memory=memory)
+        expected = GenericUnivariateSelect(f_classif, mode="k_best", param=k)
+        assert np.array_equal(
+            selector.fit(X, y).get_support(),
+            expected.fit(X, y).get_support(),
+        )
+    # The features were scored once for all the values of k.
+    assert len(scores_calls) == 1
+    memory.clear()
+
+
+def test_fisher_score():
+    X, y = make_classification(
+        n_samples=120,
+        n_features=10,
+        n_informative=2,
+        n_redundant=0,
+        shuffle=False,
+        random_state=0,
+    )
+    X[:, -1] = 3.0
+    X[:, -2] = y
+    scores = fisher_score(X, y)
+    for j in range(8):
+        means = [X[y == k, j].mean() for k in (0, 1)]
+        variances = [X[y == k, j].var() for k in (0, 1)]
+        counts = [np.sum(y == k) for k in (0, 1)]
+        between = sum(
+            n * (m - X[:, j].mean()) ** 2 for n, m in zip(counts, means)
+        )
+        within = sum(n * v for n, v in zip(counts, variances))
+        assert scores[j] == pytest.approx(between / within)
+    assert scores[-2] == np.inf
+    assert scores[-1] == 0
+    selector = KBestSelector(score_func=fisher_score, param=2).fit(X, y)
+    assert np.array_equal(selector.scores_, scores)
+    assert set(np.flatnonzero(selector.get_support())) == {1, 8}
+
+
+def test_binned_mutual_info():
+    X, y = make_classification(
+        n_samples=2000,
+        n_features=60,
+        n_informative=10,
+        n_redundant=10,
+        random_state=0,
+    )
+    expected = mutual_info_classif(X, y, random_state=0)
+    scores = binned_mutual_info(X, y, n_jobs=2, chunk_size=16)
+    assert scores.shape == expected.shape
+    assert np.all(scores >= 0)
+    assert np.max(np.abs(scores - expected)) < 0.03
+    # The same 10 best features.
+    assert set(np.argsort(scores)[-10:]) == set(np.argsort(expected)[-10:])
+    # The scores don't depend on the chunks.
+    assert np.allclose(binned_mutual_info(X, y, chunk_size=60), scores)
+    binned_config = copy.deepcopy(config)
+    binned_config["config"]["selectors"]["mutual_info_binned"] = {
+        "param_from": 2,
+        "param_to": 5,
+        "n_bins": 8,
+    }
+    selectors = get_features_selectors(binned_config)
+    (name, selector), hparams = selectors["mutual_info_binned"]
+    assert name == "binned_mutual_info"
+    assert selector.score_func.keywords == {"n_bins": 8, "n_jobs": 1}
+    assert list(hparams) == ["binned_mutual_info__param"]
+
+
+@pytest.mark.parametrize("chunk_size", [1, 7, 256])
+def test_correlation_filter(chunk_size):
+    rng = np.random.RandomState(0)
+    X = rng.randn(200, 30)
+    X = np.hstack(
+        [
+            X,
+            3 * X[:, :8] + 5 + 0.05 * rng.randn(200, 8),
+            X[:, 4:12] + 2 * rng.randn(200, 8),
+            np.ones((200, 2)),
+        ]
+    )
+    X = X[:, rng.permutation(X.shape[1])]
+    # The features are kept in order if they are not correlated with a
+    # kept feature.
+    with np.errstate(divide="ignore", invalid="ignore"):
+        corr = np.abs(np.corrcoef(X, rowvar=False))
+    expected = []
+    for j in range(X.shape[1]):
+        if not any(corr[j, k] > 0.9 for k in expected):
+            expected.append(j)
+    selector = CorrelationFilter(threshold=0.9, chunk_size=chunk_size)
+    Xt = selector.fit_transform(X.astype(np.float32))
+    assert list(np.flatnonzero(selector.get_support())) == expected
+    # The scaled copies are removed, the noisy copies and the constant
+    # features are kept.
+    assert Xt.shape == (200, 30 + 8 + 2)
+
+
+def test_relieff_selector():
+    X, y = make_classification(n_samples=60, n_features=8, random_state=0)
+    memory = TransformerCache(name="test_relieff")
+    memory.clear()
+    for n_neighbors in (1, 3):
+        for k in (2, 5):
+            expected = ReliefF(n_features_to_select=k, n_neighbors=n_neighbors)
+            selector = ReliefFSelector(k, n_neighbors, memory=memory)
+            assert np.array_equal(
+                selector.fit(X, y).transform(X),
+                expected.fit(X, y).transform(X),
+            )
+    # One distance matrix and one ranking per value of n_neighbors.
+    assert memory.info()["misses"] == 3
+    memory.clear()
+
+
+def test_shared_dataset(tmp_path):
+    X, y = make_classification(n_samples=60, n_features=8, random_state=0)
+    data = SharedDataset.create(str(tmp_path), X, y, cv=3)
+    assert len(pickle.dumps(data)) < 1000
+    X_shared, y_shared, cv = pickle.loads(pickle.dumps(data)).load()
+    assert isinstance(X_shared, np.memmap)
+    assert np.array_equal(X_shared, X) and np.array_equal(y_shared, y)
+    # The same folds as the scikit-learn searches.
+    for (train, test), (expected_train, expected_test) in zip(
+        cv.split(X, y), StratifiedKFold(3).split(X, y)
+    ):
+        assert np.array_equal(train, expected_train)
+        assert np.array_equal(test, expected_test)
+
+
+def test_shared_dataset_string_labels(tmp_path):
+    X, y = make_classification(n_samples=60, n_features=8, random_state=0)
+    labels = np.array(["no", "yes"], dtype=object)[y]
+    data = SharedDataset.create(str(tmp_path), X, labels, cv=3)
+    _, y_shared, cv = pickle.loads(pickle.dumps(data)).load()
+    assert y_shared.dtype == object
+    assert np.array_equal(y_shared, labels)
+    for (_, test), (_, expected_test) in zip(
+        cv.split(X, labels), StratifiedKFold(3).split(X, y)
+    ):
+        assert np.array_equal(test, expected_test)
+
+
+def test_timeout_pipeline():
+    X, y = make_classification(n_samples=2000, n_features=20, random_state=0)
+    steps = [("scaler", StandardScaler()), ("svc", SVC())]
+    expected = get_scorer("roc_auc")(Pipeline(steps).fit(X, y), X, y)
+    scorer = TimeoutScorer("roc_auc")
+    model = TimeoutPipeline(steps, fit_timeout=60).fit(X, y)
+    assert not model.timed_out_
+    assert scorer(model, X, y) == expected
+    # The fit is stopped after the timeout and scored NaN, the next fit
+    # runs in a new process.
+    model = TimeoutPipeline(steps, fit_timeout=1e-3).fit(X, y)
+    assert model.timed_out_
+    assert np.isnan(scorer(model, X, y))
+    model.set_params(fit_timeout=60).fit(X, y)
+    assert scorer(model, X, y) == expected
+
+
+def test_prediction_recorder(tmp_path):
+    X, y = make_classification(n_samples=60, n_features=4, random_state=0)
+    # Duplicated rows in different folds, and a missing value.
+    last_fold = list(StratifiedKFold(3).split(X, y))[-1][1]
+    X[last_fold[0]] = X[0]
+    X[1, 0] = np.nan
+    model = oof.RowsPipeline([("clf", DummyClassifier(strategy="prior"))])
+    for cell in ("a", "b"):
+        path = str(tmp_path / cell)
+        test_fold = oof.setup_predictions(path, X, y, 3)
+        assert test_fold[0] != test_fold[last_fold[0]]
+        recorder = oof.PredictionRecorder("accuracy", path, [])
+        for fold in range(3):
+            train = np.flatnonzero(test_fold != fold)
+            fitted = clone(model).fit(X[train], y[train], rows=train)
+            # The training rows are scored first.
+            recorder(fitted, X[train], y[train])
+            recorder(fitted, X[test_fold == fold], y[test_fold == fold])
+        # Every fold is recorded once, with the indices of its samples.
+        records = [
+            np.load(os.path.join(path, name))
+            for name in os.listdir(path)
+            if name not in ("folds.npz", "X.npy")
+        ]
+        assert sorted(int(r["fold"]) for r in records) == [0, 1, 2]
+        for record in records:
+            assert np.array_equal(
+                record["index"], np.flatnonzero(test_fold == record["fold"])
+            )
+    # Only the folds of the last cell are kept.
+    assert len(oof._folds) == 1
+
+
+def test_timeout_pipeline_rows(tmp_path):
+    X, y = make_classification(n_samples=200, n_features=8, random_state=0)
+    path_X = str(tmp_path / "X.npy")
+    np.save(path_X, X)
+    rows = np.arange(0, 200, 2)
+    steps = [("scaler", StandardScaler()), ("svc", SVC())]
+    expected = Pipeline(steps).fit(X[rows], y[rows]).decision_function(X)
+    # The fit process reads the rows from the file, X is not sent.
+    model = TimeoutPipeline(steps, fit_timeout=60, path_X=path_X)
+    model.fit(None, y[rows], rows=rows)
+    assert np.array_equal(model.decision_function(X), expected)
+
+
+@pytest.mark.parametrize(
+    "classifier, param, values",
+    [
+        (ExtraTreesClassifier(random_state=0), "n_estimators", (5, 10, 20)),
+        (LGBMClassifier(verbose=-1), "n_estimators", (5, 10, 20)),
+        (LogisticRegression(), "C", (0.1, 1.0, 10.0)),
+    ],
+)
+def test_warm_start_pipeline(classifier, param, values):
+    X, y = make_classification(n_samples=200, n_features=8, random_state=0)
+    clear_paths()
+    model = WarmStartPipeline(
+        [("scaler", StandardScaler()), ("clf", classifier)]
+    )
+    fitted = []
+    for value in values:
+        params = {f"clf__{param}": value}
+        warm = clone(model).set_params(**params).fit(X, y)
+        cold = clone(Pipeline(model.steps)).set_params(**params).fit(X, y)
+        # The trees are the same, the coefficients within the tolerance.
+        assert np.allclose(
+            warm.predict_proba(X), cold.predict_proba(X), atol=1e-3
+        )
+        assert warm.get_params()[f"clf__{param}"] == value
+        fitted.append(warm.steps[-1][1])
+    if isinstance(classifier, ExtraTreesClassifier):
+        # The trees of the previous fits are kept.
+        assert fitted[-1].estimators_[0] is fitted[0].estimators_[0]
@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+#
+# cache.py
+#
+
+"""
+In-memory cache of the fitted transformers of the pipelines.
+"""
+
+__author__ = "Ahmed Albuni"
+__email__ = "ahmed.albuni@gmail.com"
+
+
+import inspect
+from collections import OrderedDict
+
+import joblib
+import numpy as np
+
+# The stores live in the memory of each process, keyed by the cache name.
+_stores = dict()
+
+
+class _LRUStore(OrderedDict):
+    def __init__(self):
+        super().__init__()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+
+
+class TransformerCache:
+    """
+    Size-bounded LRU cache for the transformer steps of a Pipeline.
+
+    Implements the cache method of the joblib.Memory interface, so it can
+    be given as the memory of a scikit-learn Pipeline. A step is fitted
+    once for each (training data, step params) key, the training data
+    being the scaled fold of the dataset, and the result is reused by all
+    the classifiers with the same fold and selector params.
+
+    Only the name and the size limit are pickled with the pipelines, so
+    every worker process keeps its own store between the fits it runs.
+
+    Args:
+        name: Name of the store.
+        max_bytes: Size limit of the store, zero disables the cache.
+    """
+
+    def __init__(self, name: str = "transformers", max_bytes: int = 2 ** 29):
+        self.name = name
+        self.max_bytes = max_bytes
+
+    def cache(self, func, ignore=None):
+        signature = inspect.signature(func)
+
+        def cached_func(*args, **kwargs):
+            if self.max_bytes <= 0:
+                return func(*args, **kwargs)
+            store = _stores.setdefault(self.name, _LRUStore())
+            arguments = signature.bind(*args, **kwargs).arguments
+            for name in ignore or ():
+                arguments.pop(name, None)
+            key = joblib.hash((func.__name__, arguments))
+            if key in store:
+                store.hits += 1
+                store.move_to_end(key)
+                return store[key][0]
+            store.misses += 1
+            result = func(*args, **kwargs)
+            size = _nbytes(result)
+            if size <= self.max_bytes:
+                store[key] = (result, size)
+                store.nbytes += size
+            # Evict the least recently used results.
+            while store.nbytes > self.max_bytes:
+                _, (_, size) = store.popitem(last=False)
+                store.nbytes -= size
+            return result
+
+        return cached_func
+
+    def info(self):
+        """Returns the hits, misses and size in bytes of the store."""
+
+        store = _stores.get(self.name, _LRUStore())
+        return {
+            "hits": store.hits,
+            "misses": store.misses,
+            "nbytes": store.nbytes,
+        }
+
+    def clear(self):
+        _stores.pop(self.name, None)
+
+
+def clear_stores():
+    """Remove the stores of all the caches of this process."""
+
+    _stores.clear()
+
+
+def _nbytes(obj):
+    # Approximate size of a fitted transformer and its output.
+    if isinstance(obj, np.ndarray):
+        return obj.nbytes
+    if isinstance(obj, (tuple, list)):
+        return sum(_nbytes(item) for item in obj)
+    if hasattr(obj, "__dict__"):
+        return sum(
+            value.nbytes
+            for value in vars(obj).values()
+            if isinstance(value, np.ndarray)
+        )
+    return 0
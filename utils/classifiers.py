@@ -11,89 +11,130 @@ __author__ = "Ahmed Albuni"
 __email__ = "ahmed.albuni@gmail.com"
 
 
-from lightgbm.sklearn import LGBMClassifier
+import importlib
+
 from scipy.stats import randint as sp_randint
-from sklearn.ensemble import ExtraTreesClassifier
-from sklearn.linear_model import LogisticRegression, RidgeClassifier
-from sklearn.svm import SVC
-from sklearn.tree import DecisionTreeClassifier
+
+# The classifiers that can be used in the experiment, keyed by their name
+# in the results. Each one is declared once with the section of the
+# config that enables it, and its module is only imported if the section
+# is in the config.
+CLASSIFIERS = dict()
+
+
+def register_classifier(key, section, module, name):
+    """
+    Declare a classifier, decorates the function that builds its search
+    space from the section of the config.
+
+    Args:
+        key: Name of the classifier in the results.
+        section: Key of the classifier in config["classifications"].
+        module: Module of the estimator class, imported when the
+            classifier is built.
+        name: Name of the estimator class, also the name of the step in
+            the pipelines.
+
+    Returns:
+        The decorator, which returns the function unchanged.
+    """
+
+    def decorator(get_hparams):
+        CLASSIFIERS[key] = (section, module, name, get_hparams)
+        return get_hparams
+
+    return decorator
+
+
+@register_classifier(
+    "ridge", "Ridge", "sklearn.linear_model", "RidgeClassifier"
+)
+def _ridge_hparams(config):
+    # "tol": (0.01, 0.001, 0.0001)
+    return {"alpha": sp_randint(config["alpha_from"], config["alpha_to"])}
+
+
+@register_classifier("lgbm", "LGBM", "lightgbm.sklearn", "LGBMClassifier")
+def _lgbm_hparams(config):
+    # "reg_alpha" and "reg_lambda": (10, 1, 0.1, 0.01, 0.001, 0.0001)
+    hparams = {
+        "max_depth": sp_randint(
+            config["max_depth_from"], config["max_depth_to"]
+        ),
+        "min_child_samples": sp_randint(
+            config["min_child_s_from"], config["min_child_s_to"]
+        ),
+        "num_leaves": sp_randint(
+            config["num_leaves_from"], config["num_leaves_to"]
+        ),
+    }
+    # The number of trees is searched if its range is given, the fits
+    # along it can be warm started (see utils.warm_start).
+    if "n_estimators_from" in config:
+        hparams["n_estimators"] = sp_randint(
+            config["n_estimators_from"], config["n_estimators_to"]
+        )
+    return hparams
+
+
+@register_classifier("svc", "SVC", "sklearn.svm", "SVC")
+def _svc_hparams(config):
+    return {"C": sp_randint(config["C_from"], config["C_to"])}
+
+
+@register_classifier("dt", "DT", "sklearn.tree", "DecisionTreeClassifier")
+def _dt_hparams(config):
+    return {
+        "criterion": ("gini", "entropy"),
+        "max_depth": config["max_depth_list"],
+        "min_samples_leaf": sp_randint(
+            config["min_samples_leaf_from"], config["min_samples_leaf_to"]
+        ),
+    }
+
+
+@register_classifier("lr", "LR", "sklearn.linear_model", "LogisticRegression")
+def _lr_hparams(config):
+    return {"C": sp_randint(config["C_from"], config["C_to"])}
+
+
+@register_classifier("et", "ET", "sklearn.ensemble", "ExtraTreesClassifier")
+def _et_hparams(config):
+    hparams = {
+        "criterion": ("gini", "entropy"),
+        "min_samples_leaf": sp_randint(
+            config["min_samples_leaf_from"], config["min_samples_leaf_to"]
+        ),
+    }
+    if "n_estimators_from" in config:
+        hparams["n_estimators"] = sp_randint(
+            config["n_estimators_from"], config["n_estimators_to"]
+        )
+    return hparams
 
 
 def get_classifiers(config):
+    """
+    Build the classifiers whose section is in the config.
+
+    Args:
+        config: The configuration of the experiment.
+
+    Returns:
+        Dict of ((step name, estimator), search space) keyed by the name of
+        the classifier in the results, the params of the search space are
+        prefixed by the step name.
+    """
 
-    ridge_param = dict()
-    lgbm_param = dict()
-    svc_param = dict()
-    dt_param = dict()
-    lr_param = dict()
-    et_param = dict()
-
-    ridge_param["RidgeClassifier__alpha"] = sp_randint(
-        config["config"]["classifications"]["Ridge"]["alpha_from"],
-        config["config"]["classifications"]["Ridge"]["alpha_to"],
-    )
-    # ridge_param["RidgeClassifier__tol"] = (0.01, 0.001, 0.0001)
-    lgbm_param["LGBMClassifier__max_depth"] = sp_randint(
-        config["config"]["classifications"]["LGBM"]["max_depth_from"],
-        config["config"]["classifications"]["LGBM"]["max_depth_to"],
-    )
-    # lgbm_param["LGBMClassifier__reg_alpha"] = (10, 1, 0.1, 0.01, 0.001,
-    # 0.0001)
-    # lgbm_param["LGBMClassifier__reg_lambda"] = (10, 1, 0.1, 0.01, 0.001,
-    # 0.0001)
-    lgbm_param["LGBMClassifier__min_child_samples"] = sp_randint(
-        config["config"]["classifications"]["LGBM"]["min_child_s_from"],
-        config["config"]["classifications"]["LGBM"]["min_child_s_to"],
-    )
-
-    lgbm_param["LGBMClassifier__num_leaves"] = sp_randint(
-        config["config"]["classifications"]["LGBM"]["num_leaves_from"],
-        config["config"]["classifications"]["LGBM"]["num_leaves_to"],
-    )
-
-    svc_param["SVC__C"] = sp_randint(
-        config["config"]["classifications"]["SVC"]["C_from"],
-        config["config"]["classifications"]["SVC"]["C_to"],
-    )
-
-    lr_param["LogisticRegression__C"] = sp_randint(
-        config["config"]["classifications"]["LR"]["C_from"],
-        config["config"]["classifications"]["LR"]["C_to"],
-    )
-    et_param["ExtraTreesClassifier__criterion"] = ("gini", "entropy")
-    et_param["ExtraTreesClassifier__min_samples_leaf"] = sp_randint(
-        config["config"]["classifications"]["ET"]["min_samples_leaf_from"],
-        config["config"]["classifications"]["ET"]["min_samples_leaf_to"],
-    )
-
-    dt_param["DecisionTreeClassifier__criterion"] = ("gini", "entropy")
-    dt_param["DecisionTreeClassifier__max_depth"] = config["config"][
-        "classifications"
-    ]["DT"]["max_depth_list"]
-    dt_param["DecisionTreeClassifier__min_samples_leaf"] = sp_randint(
-        config["config"]["classifications"]["DT"]["min_samples_leaf_from"],
-        config["config"]["classifications"]["DT"]["min_samples_leaf_to"],
-    )
+    sections = config["config"]["classifications"]
     classifiers = dict()
-    classifiers["ridge"] = (
-        (RidgeClassifier.__name__, RidgeClassifier()),
-        ridge_param,
-    )
-    classifiers["lgbm"] = (
-        (LGBMClassifier.__name__, LGBMClassifier()),
-        lgbm_param,
-    )
-    classifiers["svc"] = (SVC.__name__, SVC()), svc_param
-    classifiers["dt"] = (
-        (DecisionTreeClassifier.__name__, DecisionTreeClassifier()),
-        dt_param,
-    )
-    classifiers["lr"] = (
-        (LogisticRegression.__name__, LogisticRegression()),
-        lr_param,
-    )
-    classifiers["et"] = (
-        (ExtraTreesClassifier.__name__, ExtraTreesClassifier()),
-        et_param,
-    )
+    for key, (section, module, name, get_hparams) in CLASSIFIERS.items():
+        if section not in sections:
+            continue
+        estimator = getattr(importlib.import_module(module), name)()
+        hparams = {
+            name + "__" + param: values
+            for param, values in get_hparams(sections[section]).items()
+        }
+        classifiers[key] = (name, estimator), hparams
     return classifiers
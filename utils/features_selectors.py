@@ -11,75 +11,427 @@ __author__ = "Ahmed Albuni"
 __email__ = "ahmed.albuni@gmail.com"
 
 
+import inspect
+from functools import partial
+
+import numpy as np
+from joblib import Parallel, delayed
 from scipy.stats import randint as sp_randint
 from scipy.stats import uniform as sp_uniform
-from skfeature.function.similarity_based.fisher_score import fisher_score
-from sklearn.feature_selection import (
-    GenericUnivariateSelect,
-    VarianceThreshold,
-    mutual_info_classif,
-)
-from skrebate import ReliefF
+from sklearn.base import BaseEstimator, TransformerMixin
+from sklearn.feature_selection import VarianceThreshold, mutual_info_classif
+from sklearn.feature_selection._base import SelectorMixin
+from sklearn.utils import check_X_y
+from sklearn.utils.validation import check_is_fitted
 
+from utils.cache import TransformerCache
 
-def get_features_selectors(config):
 
-    relieff_param = {
-        "ReliefF__n_neighbors": sp_randint(
-            config["config"]["selectors"]["ReliefF"]["n_neighbors_from"],
-            config["config"]["selectors"]["ReliefF"]["n_neighbors_to"],
-        ),
-        "ReliefF__n_features_to_select": sp_randint(
-            config["config"]["selectors"]["ReliefF"][
-                "n_features_to_select_from"
-            ],
-            config["config"]["selectors"]["ReliefF"][
-                "n_features_to_select_to"
-            ],
-        ),
-    }
-    mutual_info_param = {
-        "mutual_info_classif__param": sp_randint(
-            config["config"]["selectors"]["mutual_info"]["param_from"],
-            config["config"]["selectors"]["mutual_info"]["param_to"],
-        )
-    }
-    fisher_param = {
-        "fisher_score__param": sp_randint(
-            config["config"]["selectors"]["fisher_score"]["param_from"],
-            config["config"]["selectors"]["fisher_score"]["param_to"],
-        )
-    }
-    var_t_param = {
-        "VarianceThreshold__threshold": sp_uniform(
-            config["config"]["selectors"]["VarianceThreshold"][
-                "threshold_from"
-            ],
-            config["config"]["selectors"]["VarianceThreshold"]["threshold_to"],
+class KBestSelector(SelectorMixin, BaseEstimator):
+    """
+    Select the k features with the highest scores.
+
+    Same as GenericUnivariateSelect in k_best mode, but the scores of a
+    fold are computed once and stored, so each value of k only takes the
+    top-k slice of the stored scores.
+
+    Args:
+        score_func: Function taking X and y and returning the scores.
+        param: The number of features to select.
+        memory: The store of the scores, a TransformerCache.
+        random_state: Seed given to the score functions that take a
+            random_state, such as mutual_info_classif.
+    """
+
+    def __init__(
+        self, score_func=None, param=10, memory=None, random_state=None
+    ):
+        self.score_func = score_func
+        self.param = param
+        self.memory = memory
+        self.random_state = random_state
+
+    def fit(self, X, y):
+        X, y = check_X_y(X, y)
+        self.n_features_in_ = X.shape[1]
+        memory = self.memory
+        if memory is None:
+            memory = TransformerCache(name="scores")
+        score_func = self.score_func
+        if self.random_state is not None and (
+            "random_state" in inspect.signature(score_func).parameters
+        ):
+            score_func = partial(score_func, random_state=self.random_state)
+        scores = memory.cache(_score_features)(score_func, X, y)
+        self.scores_ = np.asarray(scores, dtype=float)
+        return self
+
+    def _get_support_mask(self):
+        check_is_fitted(self, "scores_")
+        if not 0 <= self.param <= len(self.scores_):
+            raise ValueError(
+                f"param should be >=0, <= n_features = {len(self.scores_)}; "
+                f"got {self.param}."
+            )
+        scores = np.nan_to_num(self.scores_, nan=np.finfo(float).min)
+        mask = np.zeros(scores.shape, dtype=bool)
+        if self.param > 0:
+            mask[np.argsort(scores, kind="mergesort")[-self.param :]] = True
+        return mask
+
+
+class CorrelationFilter(SelectorMixin, BaseEstimator):
+    """
+    Remove the features highly correlated with a previous feature.
+
+    The features are visited in the order of the columns, and a feature
+    is removed if the absolute Pearson correlation with one of the kept
+    features before it is above the threshold, so one feature of each
+    group of near duplicates is kept. The correlation matrix is computed
+    in blocks of chunk_size columns against the kept columns only, so
+    the memory used is O(n_samples * chunk_size) and the wide tables
+    don't need the whole n_features x n_features matrix.
+
+    Args:
+        threshold: The absolute correlation above which a feature is
+            removed.
+        chunk_size: The number of columns of a block.
+    """
+
+    def __init__(self, threshold=0.95, chunk_size=256):
+        self.threshold = threshold
+        self.chunk_size = chunk_size
+
+    def fit(self, X, y=None):
+        X = np.asarray(X)
+        n_samples, n_features = X.shape
+        self.n_features_in_ = n_features
+        mean = X.mean(axis=0, dtype=np.float64)
+        std = X.std(axis=0, dtype=np.float64)
+        blocks = [
+            np.arange(start, min(start + self.chunk_size, n_features))
+            for start in range(0, n_features, self.chunk_size)
+        ]
+        keep = np.ones(n_features, dtype=bool)
+        for i, block in enumerate(blocks):
+            Z = _standardize(X, block, mean, std)
+            removed = np.zeros(len(block), dtype=bool)
+            # Against the kept features of the previous blocks.
+            for previous in blocks[:i]:
+                previous = previous[keep[previous]]
+                if len(previous) > 0:
+                    corr = _standardize(X, previous, mean, std).T @ Z
+                    removed |= np.any(
+                        np.abs(corr) > self.threshold * n_samples, axis=0
+                    )
+            # Within the block, each kept feature removes the next ones.
+            high = np.abs(Z.T @ Z) > self.threshold * n_samples
+            for j in range(len(block)):
+                if not removed[j]:
+                    removed[j + 1 :] |= high[j, j + 1 :]
+            keep[block] = ~removed
+        self.support_ = keep
+        return self
+
+    def _get_support_mask(self):
+        check_is_fitted(self, "support_")
+        return self.support_
+
+
+def _standardize(X, columns, mean, std):
+    # z-scores of some columns, the constant columns are 0.
+    Z = X[:, columns] - mean[columns]
+    scale = std[columns]
+    Z /= np.where(scale > 0, scale, 1)
+    Z[:, scale == 0] = 0
+    return Z
+
+
+def _score_features(score_func, X, y):
+    scores = score_func(X, y)
+    # Score functions like f_classif return the scores and the p-values.
+    if isinstance(scores, (list, tuple)):
+        scores = scores[0]
+    return scores
+
+
+class ReliefFSelector(TransformerMixin, BaseEstimator):
+    """
+    ReliefF with the distance matrix and the rankings of a fold cached.
+
+    The ranking of the features only depends on n_neighbors, so all the
+    sampled values of n_features_to_select share the ranking of a fold,
+    and all the values of n_neighbors share its distance matrix. The
+    selected features are ordered by rank, as in skrebate.
+
+    Args:
+        n_features_to_select: The number of features to select.
+        n_neighbors: The number of neighbors used to score the features.
+        n_jobs: The number of jobs used to score the features.
+        memory: The store of the distances and rankings, a
+            TransformerCache.
+    """
+
+    def __init__(
+        self, n_features_to_select=10, n_neighbors=100, n_jobs=1, memory=None
+    ):
+        self.n_features_to_select = n_features_to_select
+        self.n_neighbors = n_neighbors
+        self.n_jobs = n_jobs
+        self.memory = memory
+
+    def fit(self, X, y):
+        X, y = np.asarray(X), np.asarray(y)
+        self.n_features_in_ = X.shape[1]
+        memory = self.memory
+        if memory is None:
+            memory = TransformerCache(name="relieff")
+        # skrebate is only imported by the processes fitting ReliefF.
+        from utils.relieff import relieff_ranking
+
+        ranking = memory.cache(relieff_ranking, ignore=["memory", "n_jobs"])
+        self.feature_importances_, self.top_features_ = ranking(
+            X, y, self.n_neighbors, memory, self.n_jobs
         )
-    }
-    f_list = dict()
+        return self
 
-    f_list["relief_f"] = (ReliefF.__name__, ReliefF()), relieff_param
+    def transform(self, X):
+        check_is_fitted(self, "top_features_")
+        if self.n_features_in_ < self.n_features_to_select:
+            raise ValueError(
+                "Number of features to select is larger than the number of "
+                "features in the dataset."
+            )
+        return X[:, self.top_features_[: self.n_features_to_select]]
 
-    f_list["mutual_info"] = (
-        (
-            mutual_info_classif.__name__,
-            GenericUnivariateSelect(mutual_info_classif, "k_best"),
-        ),
-        mutual_info_param,
+
+def fisher_score(X, y):
+    """
+    Fisher score of each feature, the ratio of the between-class and the
+    within-class variances:
+
+        sum_k n_k (mean_k - mean) ** 2 / sum_k n_k var_k
+
+    Computed from the per-class means and variances in O(n_samples *
+    n_features), the same scores as the affinity matrix formulation of
+    skfeature without its n_samples ** 2 memory. The constant features
+    score 0, and the features that are constant within each class but
+    not overall score inf.
+
+    Args:
+        X: The training data.
+        y: The class of each sample.
+
+    Returns:
+        The score of each feature.
+    """
+
+    X = np.asarray(X)
+    mean = X.mean(axis=0, dtype=np.float64)
+    between = np.zeros(X.shape[1])
+    within = np.zeros(X.shape[1])
+    for label in np.unique(y):
+        X_k = X[y == label]
+        mean_k = X_k.mean(axis=0, dtype=np.float64)
+        between += len(X_k) * (mean_k - mean) ** 2
+        within += len(X_k) * X_k.var(axis=0, dtype=np.float64)
+    # Relative to the total variance, so the threshold doesn't depend on
+    # the scale of the features.
+    tol = 1e-12 * (between + within)
+    scores = np.zeros(X.shape[1])
+    np.divide(between, within, out=scores, where=within > tol)
+    scores[(within <= tol) & (between > 0)] = np.inf
+    return scores
+
+
+def binned_mutual_info(X, y, n_bins=10, n_jobs=1, chunk_size=256):
+    """
+    Mutual information between each feature and the class, estimated from
+    the joint histogram of the feature discretised in quantile bins.
+
+    All the features of a chunk are binned and counted at once, and the
+    chunks are scored in parallel threads. The plug-in estimate is
+    corrected for its bias with the Miller-Madow correction and clipped
+    at 0, the result is in nats, as for mutual_info_classif, which it
+    approximates much faster on large data.
+
+    Args:
+        X: The training data.
+        y: The class of each sample.
+        n_bins: The number of quantile bins of each feature, the features
+            with ties can use fewer bins.
+        n_jobs: The number of threads scoring the chunks.
+        chunk_size: The number of features of a chunk.
+
+    Returns:
+        The mutual information of each feature.
+    """
+
+    X = np.asarray(X)
+    _, y = np.unique(y, return_inverse=True)
+    chunks = [
+        slice(start, start + chunk_size)
+        for start in range(0, X.shape[1], chunk_size)
+    ]
+    scores = Parallel(n_jobs=n_jobs, prefer="threads")(
+        delayed(_binned_mutual_info)(X[:, chunk], y, n_bins)
+        for chunk in chunks
     )
-    f_list["fisher_score"] = (
-        (
-            fisher_score.__name__,
-            GenericUnivariateSelect(fisher_score, "k_best"),
+    return np.concatenate(scores) if scores else np.zeros(0)
+
+
+def _binned_mutual_info(X, y, n_bins):
+    n_samples, n_features = X.shape
+    n_classes = y.max() + 1
+    # The bin of each value is the number of inner quantile edges below it,
+    # equal values are always in the same bin.
+    edges = np.quantile(X, np.linspace(0, 1, n_bins + 1)[1:-1], axis=0)
+    bins = np.zeros(X.shape, dtype=np.intp)
+    for edge in edges:
+        bins += X > edge
+    # Joint counts of (feature, bin, class) from a single bincount.
+    index = (np.arange(n_features) * n_bins + bins) * n_classes + y[:, None]
+    joint = np.bincount(
+        index.ravel(), minlength=n_features * n_bins * n_classes
+    ).reshape(n_features, n_bins, n_classes)
+    p_xy = joint / n_samples
+    p_x = p_xy.sum(axis=2, keepdims=True)
+    p_y = p_xy.sum(axis=1, keepdims=True)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        terms = p_xy * np.log(p_xy / (p_x * p_y))
+    mi = np.nansum(terms, axis=(1, 2))
+    # Miller-Madow correction of the three entropies of the estimate.
+    n_xy = np.count_nonzero(joint, axis=(1, 2))
+    n_x = np.count_nonzero(joint.sum(axis=2), axis=1)
+    n_y = np.count_nonzero(np.bincount(y))
+    mi -= (n_xy - n_x - n_y + 1) / (2 * n_samples)
+    return np.maximum(mi, 0)
+
+
+# The selectors that can be used in the experiment, keyed by their name in
+# the results. Each one is declared once with the section of the config
+# that enables it, and is only built if the section is in the config.
+SELECTORS = dict()
+
+
+def register_selector(key, section, name):
+    """
+    Declare a feature selector, decorates the function that builds the
+    selector and its search space from the section of the config and the
+    options shared by the selectors (see get_features_selectors).
+
+    Args:
+        key: Name of the selector in the experiment.
+        section: Key of the selector in config["selectors"].
+        name: Name of the step in the pipelines, also the name of the
+            selector in the results.
+
+    Returns:
+        The decorator, which returns the function unchanged.
+    """
+
+    def decorator(build):
+        SELECTORS[key] = (section, name, build)
+        return build
+
+    return decorator
+
+
+@register_selector("relief_f", "ReliefF", "ReliefF")
+def _relieff(config, options):
+    # The rankings of a fold are shared by all the sampled values of
+    # n_features_to_select.
+    memory = TransformerCache(name="relieff", max_bytes=options["cache_bytes"])
+    hparams = {
+        "n_neighbors": sp_randint(
+            config["n_neighbors_from"], config["n_neighbors_to"]
         ),
-        fisher_param,
+        "n_features_to_select": sp_randint(
+            config["n_features_to_select_from"],
+            config["n_features_to_select_to"],
+        ),
+    }
+    return ReliefFSelector(memory=memory), hparams
+
+
+@register_selector("mutual_info", "mutual_info", "mutual_info_classif")
+def _mutual_info(config, options):
+    # The scores of a fold are shared by all the sampled values of k.
+    memory = TransformerCache(name="scores", max_bytes=options["cache_bytes"])
+    selector = KBestSelector(
+        score_func=mutual_info_classif,
+        memory=memory,
+        random_state=options["seed"],
     )
-    f_list["variance_threshold"] = (
-        (VarianceThreshold.__name__, VarianceThreshold()),
-        var_t_param,
+    hparams = {"param": sp_randint(config["param_from"], config["param_to"])}
+    return selector, hparams
+
+
+@register_selector(
+    "mutual_info_binned", "mutual_info_binned", "binned_mutual_info"
+)
+def _binned_mutual_info_selector(config, options):
+    memory = TransformerCache(name="scores", max_bytes=options["cache_bytes"])
+    score_func = partial(
+        binned_mutual_info,
+        n_bins=config.get("n_bins", 10),
+        n_jobs=config.get("n_jobs", 1),
     )
+    selector = KBestSelector(score_func=score_func, memory=memory)
+    hparams = {"param": sp_randint(config["param_from"], config["param_to"])}
+    return selector, hparams
+
+
+@register_selector("fisher_score", "fisher_score", "fisher_score")
+def _fisher_score(config, options):
+    memory = TransformerCache(name="scores", max_bytes=options["cache_bytes"])
+    selector = KBestSelector(score_func=fisher_score, memory=memory)
+    hparams = {"param": sp_randint(config["param_from"], config["param_to"])}
+    return selector, hparams
+
+
+@register_selector(
+    "variance_threshold", "VarianceThreshold", "VarianceThreshold"
+)
+def _variance_threshold(config, options):
+    hparams = {
+        "threshold": sp_uniform(
+            config["threshold_from"], config["threshold_to"]
+        )
+    }
+    return VarianceThreshold(), hparams
+
+
+def get_features_selectors(config):
+    """
+    Build the feature selectors whose section is in the config.
+
+    Args:
+        config: The configuration of the experiment.
+
+    Returns:
+        Dict of ((step name, selector), search space) keyed by the name of
+        the selector in the experiment, the params of the search space
+        are prefixed by the step name. The pipelines without feature
+        selection are always included.
+    """
+
+    sections = config["config"]["selectors"]
+    options = {
+        "cache_bytes": config["config"].get("CACHE_MB", 512) * 2 ** 20,
+        # The first seed of a repeated experiment, every cell sets its own
+        # seed in the random_state of the steps.
+        "seed": int(np.atleast_1d(config["config"]["SEED"])[0]),
+    }
+    f_list = dict()
+    for key, (section, name, build) in SELECTORS.items():
+        if section not in sections:
+            continue
+        selector, hparams = build(sections[section], options)
+        hparams = {
+            name + "__" + param: values for param, values in hparams.items()
+        }
+        f_list[key] = (name, selector), hparams
 
     f_list["No feature selection"] = ("No_feature_selection", None), None
 
@@ -0,0 +1,171 @@
+# -*- coding: utf-8 -*-
+#
+# fit_timeout.py
+#
+
+"""
+Pipeline fits that are stopped after a timeout.
+"""
+
+__author__ = "Ahmed Albuni"
+__email__ = "ahmed.albuni@gmail.com"
+
+
+import multiprocessing
+import traceback
+from collections import namedtuple
+
+import numpy as np
+from sklearn.metrics import get_scorer
+from sklearn.pipeline import Pipeline
+
+# The fit process of this process, started on the first timed fit.
+_fit_process = None
+
+# Rows of the X array stored in a .npy file, read by the fit process.
+_Rows = namedtuple("_Rows", ["path", "rows"])
+
+
+class TimeoutPipeline(Pipeline):
+    """
+    Pipeline whose fit is stopped after fit_timeout seconds.
+
+    Python cannot interrupt a fit running in compiled code, such as the
+    libsvm solver of SVC, so the fits are run in a separate process that
+    is killed on timeout, and started again for the next fit. The process
+    is kept between the fits, so the fitted transformers cache (see
+    utils.cache) lives in it, and the time to start it is not counted in
+    the timeout. The fitted steps are sent back to the pipeline.
+
+    When X is stored in the .npy file path_X, such as the shared dataset
+    of the cells (see utils.shared_data), the fit is given the indices
+    of its rows in the file with the rows fit param, and the fit process
+    reads them from a memory map of the file instead of receiving a
+    pickled copy of the fold.
+
+    A fit that times out does not raise, the scikit-learn searches stop
+    when all the fits of a batch fail, it sets timed_out_ instead and the
+    TimeoutScorer scores the pipeline as NaN.
+
+    Args:
+        steps: The steps of the pipeline.
+        fit_timeout: Seconds after which a fit is stopped, None does not
+            stop the fits and runs them in this process.
+        path_X: The .npy file with all the rows of X, if any.
+        memory: Cache of the fitted transformers.
+        verbose: Print the time of each step fit.
+    """
+
+    def __init__(
+        self,
+        steps,
+        *,
+        fit_timeout=None,
+        path_X=None,
+        memory=None,
+        verbose=False,
+    ):
+        super().__init__(steps, memory=memory, verbose=verbose)
+        self.fit_timeout = fit_timeout
+        self.path_X = path_X
+
+    def fit(self, X, y=None, rows=None, **params):
+        self.timed_out_ = False
+        # The rows of the dataset are kept for the PredictionRecorder, see
+        # utils.oof.RowsPipeline.
+        self.rows_ = rows
+        if self.fit_timeout is None:
+            return super().fit(X, y, **params)
+        if self.path_X is not None and rows is not None:
+            X = _Rows(self.path_X, np.asarray(rows))
+        global _fit_process
+        if _fit_process is None:
+            _fit_process = _FitProcess()
+        pipeline = Pipeline(
+            self.steps, memory=self.memory, verbose=self.verbose
+        )
+        try:
+            fitted = _fit_process.fit(
+                pipeline, X, y, params, self.fit_timeout
+            )
+        except EOFError:
+            # The fit process died.
+            _fit_process.kill()
+            _fit_process = None
+            raise
+        if fitted is None:
+            _fit_process.kill()
+            _fit_process = None
+            self.timed_out_ = True
+        else:
+            self.steps = fitted.steps
+        return self
+
+
+class TimeoutScorer:
+    """
+    Scorer that gives NaN to the pipelines whose fit timed out.
+
+    Args:
+        scoring: Name of the scikit-learn scorer.
+    """
+
+    def __init__(self, scoring: str):
+        self.scoring = scoring
+        self.scorer = get_scorer(scoring)
+
+    def __call__(self, estimator, X, y):
+        if getattr(estimator, "timed_out_", False):
+            return np.nan
+        return self.scorer(estimator, X, y)
+
+
+class _FitProcess:
+    def __init__(self):
+        # A new interpreter rather than a fork, OpenMP (LightGBM) may hang
+        # in a forked process.
+        context = multiprocessing.get_context("spawn")
+        self.connection, child_connection = context.Pipe()
+        self.process = context.Process(
+            target=_serve, args=(child_connection,), daemon=True
+        )
+        self.process.start()
+        child_connection.close()
+
+    def fit(self, estimator, X, y, params, timeout):
+        # Returns the fitted estimator, or None on timeout.
+        self.connection.send((estimator, X, y, params))
+        # The timeout starts once the estimator is loaded.
+        self.connection.recv()
+        if not self.connection.poll(timeout):
+            return None
+        success, value = self.connection.recv()
+        if not success:
+            raise value
+        return value
+
+    def kill(self):
+        self.process.kill()
+        self.process.join()
+        self.connection.close()
+
+
+def _serve(connection):
+    # Fit the estimators received from the parent process.
+    while True:
+        try:
+            estimator, X, y, params = connection.recv()
+        except EOFError:
+            return
+        if isinstance(X, _Rows):
+            X = np.load(X.path, mmap_mode="r")[X.rows]
+        connection.send(None)
+        try:
+            reply = (True, estimator.fit(X, y, **params))
+        except Exception as error:
+            reply = (False, error)
+        try:
+            connection.send(reply)
+        except Exception:
+            # The error can not be pickled.
+            connection.send((False, RuntimeError(traceback.format_exc())))
@@ -8,13 +8,20 @@ Results handling utility functions for model comparison experiments.
 """
 
 import csv
+import hashlib
+import json
 import os
 import shutil
 from collections import OrderedDict
 
+import joblib
 import numpy as np
 import pandas as pd
 
+# Version of the binary cache of the features files, the caches of the
+# other versions are rebuilt.
+CACHE_VERSION = 2
+
 
 def load_target_to_ndarray(path_to_file, index_col=0, classification=True):
     """Load target vector from file.
@@ -39,6 +46,80 @@ def load_predictors_to_ndarray(path_to_file, index_col=0, regex=None):
     return np.array(df_X.loc[:, target_features].values, dtype=np.float32)
 
 
+def read_cached_Xy(path_to_file, dtype=np.float64):
+    """Memory-map X, y and the columns names of a features CSV file from
+    its binary cache. Returns None if the cache is missing or out of date,
+    the cache is valid for the same file size and modification time, or
+    for the same content hash if the file was only touched. Labels that
+    are not numbers, such as strings, are stored as their indices in the
+    classes of the metadata, and y is then a regular array of the labels.
+
+    """
+    path_cache = str(path_to_file) + ".cache"
+    path_meta = os.path.join(path_cache, "meta.json")
+    if not os.path.isfile(path_meta):
+        return None
+    with open(path_meta) as infile:
+        meta = json.load(infile)
+    if meta.get("version") != CACHE_VERSION:
+        return None
+    stat = os.stat(path_to_file)
+    if (meta["size"], meta["mtime_ns"]) != (stat.st_size, stat.st_mtime_ns):
+        if meta["size"] != stat.st_size:
+            return None
+        if meta["sha1"] != _file_hash(path_to_file):
+            return None
+        meta["mtime_ns"] = stat.st_mtime_ns
+        _write_json(path_meta, meta)
+
+    path_X = os.path.join(path_cache, f"X_{np.dtype(dtype).name}.npy")
+    if not os.path.isfile(path_X):
+        X = np.load(os.path.join(path_cache, "X_float64.npy"), mmap_mode="r")
+        _save_npy(path_X, X.astype(dtype))
+    X = np.load(path_X, mmap_mode="r")
+    y = np.load(os.path.join(path_cache, "y.npy"), mmap_mode="r")
+    if meta["classes"] is not None:
+        y = np.array(meta["classes"], dtype=object)[y]
+    return X, y, meta["columns_names"]
+
+
+def write_cached_Xy(path_to_file, X, y, columns_names):
+    """Store X, y and the columns names of a features CSV file in a binary
+    cache next to it. The metadata is written last, so an interrupted
+    write leaves no valid cache."""
+
+    path_cache = str(path_to_file) + ".cache"
+    os.makedirs(path_cache, exist_ok=True)
+    # Remove the metadata and the arrays of the previous version first,
+    # the arrays are replaced by new files since other runs may still
+    # have them mapped.
+    for file_name in os.listdir(path_cache):
+        os.remove(os.path.join(path_cache, file_name))
+    stat = os.stat(path_to_file)
+    _save_npy(
+        os.path.join(path_cache, "X_float64.npy"),
+        np.ascontiguousarray(X, dtype=np.float64),
+    )
+    y = np.asarray(y)
+    classes = None
+    if y.dtype == object:
+        # Python objects can not be memory-mapped.
+        classes, y = np.unique(y, return_inverse=True)
+        classes = classes.tolist()
+    _save_npy(os.path.join(path_cache, "y.npy"), y)
+    _write_json(
+        os.path.join(path_cache, "meta.json"),
+        {
+            "version": CACHE_VERSION,
+            "size": stat.st_size,
+            "mtime_ns": stat.st_mtime_ns,
+            "sha1": _file_hash(path_to_file),
+            "columns_names": list(columns_names),
+            "classes": classes,
+        },
+    )
+
+
 def write_final_results(path_to_file, results):
     """Write the total collection of results to disk."""
 
@@ -86,3 +167,126 @@ def write_prelim_results(path_to_file, results):
         )
         writer.writeheader()
         writer.writerow(results)
+
+
+def write_checkpoint(path_to_dir, name, checkpoint):
+    """Store the results of a finished cell. The file is written under a
+    temporary name first, so an interrupted run never leaves a partial
+    checkpoint."""
+
+    path_to_file = os.path.join(path_to_dir, name + ".json")
+    with open(path_to_file + ".tmp", "w") as outfile:
+        json.dump(checkpoint, outfile, default=_to_builtin)
+    os.replace(path_to_file + ".tmp", path_to_file)
+
+
+def read_checkpoints(path_to_dir):
+    """Read the stored results of all the finished cells."""
+
+    checkpoints = []
+    if not os.path.isdir(path_to_dir):
+        return checkpoints
+    for name in sorted(os.listdir(path_to_dir)):
+        if name.endswith(".json"):
+            with open(os.path.join(path_to_dir, name)) as infile:
+                checkpoints.append(json.load(infile))
+    return checkpoints
+
+
+def append_results_log(path_to_file, fields, records):
+    """Append records to a JSON Lines log, one line per record with the
+    given fields added. The file is flushed after each call, so the log
+    can be followed while the experiment runs."""
+
+    with open(path_to_file, "a") as outfile:
+        for record in records:
+            outfile.write(
+                json.dumps(dict(fields, **record), default=_to_builtin)
+                + "\n"
+            )
+
+
+def read_results_log(path):
+    """Read a JSON Lines log, or all the logs of a directory, into a
+    DataFrame."""
+
+    if os.path.isdir(path):
+        files = [
+            os.path.join(path, name)
+            for name in sorted(os.listdir(path))
+            if name.endswith(".jsonl")
+        ]
+    else:
+        files = [path]
+    records = []
+    for path_to_file in files:
+        with open(path_to_file) as infile:
+            # A line being written by a running experiment is skipped.
+            for line in infile:
+                if line.endswith("\n"):
+                    records.append(json.loads(line))
+    return pd.DataFrame(records)
+
+
+def write_model(path_to_dir, name, model, manifest):
+    """Store a fitted pipeline as a compressed joblib file, and its
+    manifest (the cell, the input features, the params and the score) in
+    a JSON file of the same name. Both are written under temporary names
+    first, and the manifest last, so a listed model is always complete."""
+
+    os.makedirs(path_to_dir, exist_ok=True)
+    path_to_file = os.path.join(path_to_dir, name + ".joblib")
+    joblib.dump(model, path_to_file + ".tmp", compress=3)
+    os.replace(path_to_file + ".tmp", path_to_file)
+    manifest = dict(manifest, name=name, file=name + ".joblib")
+    path_to_manifest = os.path.join(path_to_dir, name + ".json")
+    with open(path_to_manifest + ".tmp", "w") as outfile:
+        json.dump(manifest, outfile, indent=2, default=_to_builtin)
+    os.replace(path_to_manifest + ".tmp", path_to_manifest)
+
+
+def read_models_manifest(path_to_dir):
+    """Read the manifests of all the stored models of a directory, in a
+    dict keyed by the model name."""
+
+    manifests = OrderedDict()
+    for name in sorted(os.listdir(path_to_dir)):
+        if name.endswith(".json"):
+            with open(os.path.join(path_to_dir, name)) as infile:
+                manifest = json.load(infile)
+            manifests[manifest["name"]] = manifest
+    return manifests
+
+
+def read_model(path_to_dir, manifest):
+    """Load the fitted pipeline of a manifest."""
+
+    return joblib.load(os.path.join(path_to_dir, manifest["file"]))
+
+
+def _file_hash(path_to_file, chunk_size=2 ** 20):
+    sha1 = hashlib.sha1()
+    with open(path_to_file, "rb") as infile:
+        for chunk in iter(lambda: infile.read(chunk_size), b""):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+def _save_npy(path_to_file, array):
+    with open(path_to_file + ".tmp", "wb") as outfile:
+        np.save(outfile, array)
+    os.replace(path_to_file + ".tmp", path_to_file)
+
+
+def _write_json(path_to_file, obj):
+    with open(path_to_file + ".tmp", "w") as outfile:
+        json.dump(obj, outfile)
+    os.replace(path_to_file + ".tmp", path_to_file)
+
+
+def _to_builtin(obj):
+    # numpy scalars from the sampled hyper-parameters, and arrays such as
+    # the classes of a fitted model.
+    if isinstance(obj, (np.generic, np.ndarray)):
+        return obj.tolist()
+    raise TypeError(f"{type(obj).__name__} is not JSON serializable")
@@ -0,0 +1,383 @@
+# -*- coding: utf-8 -*-
+#
+# oof.py
+#
+
+"""
+Store of the out-of-fold predictions and selected features of the
+searched candidates.
+"""
+
+__author__ = "Ahmed Albuni"
+__email__ = "ahmed.albuni@gmail.com"
+
+
+import json
+import os
+import shutil
+import time
+import uuid
+
+import numpy as np
+from sklearn.metrics import get_scorer
+from sklearn.model_selection import check_cv
+from sklearn.pipeline import Pipeline
+
+from utils import ioutil, shared_data
+
+# The dataset and test folds of the last recorded cell, loaded once in
+# each process.
+_folds = dict()
+
+
+class RowsPipeline(Pipeline):
+    """
+    Pipeline that keeps the indices of the rows of the dataset it is
+    fitted on, given with the rows fit param, so the PredictionRecorder
+    knows its test fold.
+
+    Args:
+        steps: The steps of the pipeline.
+        memory: Cache of the fitted transformers.
+        verbose: Print the time of each step fit.
+    """
+
+    def fit(self, X, y=None, rows=None, **params):
+        super().fit(X, y, **params)
+        self.rows_ = rows
+        return self
+
+
+class PredictionRecorder:
+    """
+    Scorer that also records the predictions of the candidates on the
+    test folds.
+
+    The searches only return the scores, so the predictions are written
+    by the scorer in the worker that fits the candidate, one file per
+    candidate and fold, and gathered by write_predictions once the search
+    is finished. The pipelines are fitted with the indices of their
+    training rows (the rows fit param, see RowsPipeline), the test fold
+    is the fold left out of them, and the predictions are made on all its
+    samples, read from the dataset of setup_predictions, whichever rows
+    the scorer is given. The successive halving candidates are fitted on
+    subsamples of the training folds, the predictions of their last
+    evaluation are kept.
+
+    With a selector, the features it selects on the training folds and
+    their scores are also recorded, so the selected features of the best
+    candidate can be read without refitting it (see read_fold_selection).
+
+    Args:
+        scoring: Name of the scikit-learn scorer, or a scorer.
+        path: Directory of the recorded predictions of the cell.
+        params: The names of the searched params, which identify the
+            candidates.
+        predictions: Record the predictions.
+        selector: Name of the selector step whose outputs are recorded.
+    """
+
+    def __init__(
+        self, scoring, path: str, params, predictions=True, selector=None
+    ):
+        self.scoring = scoring
+        self.scorer = (
+            get_scorer(scoring) if isinstance(scoring, str) else scoring
+        )
+        self.path = path
+        self.params = list(params)
+        self.predictions = predictions
+        self.selector = selector
+
+    def __call__(self, estimator, X, y):
+        score = self.scorer(estimator, X, y)
+        # The scorer is called on the test and on the training rows, the
+        # candidate is recorded once.
+        if not (
+            getattr(estimator, "recorded_", False)
+            or getattr(estimator, "timed_out_", False)
+        ):
+            estimator.recorded_ = True
+            self._record(estimator)
+        return score
+
+    def _record(self, estimator):
+        matched = _test_fold(self.path, getattr(estimator, "rows_", None))
+        if matched is None:
+            return
+        X, index, fold = matched
+        params = estimator.get_params()
+        record = dict(
+            candidate=_candidate_key({p: params[p] for p in self.params}),
+            fold=fold,
+            time=time.time(),
+        )
+        if self.predictions:
+            if hasattr(estimator, "predict_proba"):
+                scores = estimator.predict_proba(X)[:, 1]
+            else:
+                scores = estimator.decision_function(X)
+            record.update(
+                index=index, scores=scores, labels=estimator.predict(X)
+            )
+        if self.selector is not None:
+            record.update(_selection(estimator, self.selector, X.shape[1]))
+        np.savez(os.path.join(self.path, uuid.uuid4().hex + ".npz"), **record)
+
+
+def setup_predictions(path: str, X, y, cv):
+    """
+    Create the directory of the recorded predictions of a cell, with the
+    test fold of each sample and the dataset the predictions are made
+    on, X is stored there if it is not already mapped from a file.
+
+    Args:
+        path: The directory, removed first if it exists.
+        X: Feature matrix (n samples x n features).
+        y: Ground truth vector (n samples).
+        cv: The number of cross-validation folds, or the splitter of the
+            folds.
+
+    Returns:
+        The index of the test fold of each sample.
+    """
+
+    shutil.rmtree(path, ignore_errors=True)
+    os.makedirs(path)
+    test_fold = np.full(len(y), -1, dtype=np.int32)
+    for i, (_, test_index) in enumerate(
+        check_cv(cv, y, classifier=True).split(X, y)
+    ):
+        test_fold[test_index] = i
+    path_X = shared_data.mapped_file(X)
+    if path_X is None:
+        path_X = os.path.join(path, "X.npy")
+        np.save(path_X, np.asarray(X))
+    np.savez(
+        os.path.join(path, "folds.npz"), path_X=path_X, test_fold=test_fold
+    )
+    return test_fold
+
+
+def write_predictions(
+    path: str,
+    path_to_file: str,
+    cv_results: dict,
+    best_index: int,
+    y,
+    test_fold,
+    all_candidates: bool = False,
+    **fields,
+):
+    """
+    Gather the predictions recorded during a search in a compressed array
+    file.
+
+    The file has the response y, the test_fold of each sample, the
+    scores (probability of the second class or decision function) and
+    the labels predicted by the best candidate, NaN for the samples it
+    was not evaluated on, and with all_candidates the candidate_scores
+    and candidate_labels of every candidate (n candidates x n samples),
+    with their candidate_params and candidate_test_score. The other
+    fields, such as the cell, are stored in its JSON info.
+
+    Args:
+        path: Directory of the recorded predictions.
+        path_to_file: The .npz file written.
+        cv_results: The cv_results_ of the search.
+        best_index: The index of the best candidate in cv_results.
+        y: Ground truth vector (n samples).
+        test_fold: The index of the test fold of each sample.
+        all_candidates: Store the predictions of all the candidates.
+        fields: Information about the cell.
+    """
+
+    # The candidates of the successive halving iterations are evaluated
+    # again on more data, the last evaluation is kept.
+    candidates = dict()
+    for i, params in enumerate(cv_results["params"]):
+        candidates[_candidate_key(params)] = i
+    keys = list(candidates)
+    best = keys.index(_candidate_key(cv_results["params"][best_index]))
+    if not all_candidates:
+        keys = keys[best : best + 1]
+        best = 0
+    rows = {key: row for row, key in enumerate(keys)}
+    scores = np.full((len(keys), len(y)), np.nan)
+    labels = np.full((len(keys), len(y)), np.nan)
+    times = np.full((len(keys), len(y)), -np.inf)
+    for name in sorted(os.listdir(path)):
+        if name == "folds.npz" or not name.endswith(".npz"):
+            continue
+        with np.load(os.path.join(path, name)) as record:
+            row = rows.get(str(record["candidate"]))
+            if row is None or "index" not in record.files:
+                continue
+            index = record["index"]
+            newer = times[row, index] < record["time"]
+            scores[row, index[newer]] = record["scores"][newer]
+            labels[row, index[newer]] = record["labels"][newer]
+            times[row, index[newer]] = record["time"]
+    arrays = dict(
+        y=np.asarray(y),
+        test_fold=np.asarray(test_fold),
+        scores=scores[best],
+        labels=labels[best],
+    )
+    if all_candidates:
+        arrays.update(
+            candidate_scores=scores.astype(np.float32),
+            candidate_labels=labels,
+            candidate_params=np.array(keys),
+            candidate_test_score=np.asarray(
+                cv_results["mean_test_score"]
+            )[[candidates[key] for key in keys]],
+        )
+    os.makedirs(os.path.dirname(os.path.abspath(path_to_file)), exist_ok=True)
+    np.savez_compressed(
+        path_to_file,
+        info=json.dumps(fields, default=ioutil._to_builtin),
+        **arrays,
+    )
+
+
+def read_fold_selection(path: str, params: dict):
+    """
+    Read the outputs of the selector of a candidate on the training folds,
+    recorded during a search.
+
+    Args:
+        path: Directory of the recorded predictions.
+        params: The params of the candidate.
+
+    Returns:
+        (dict): The number of folds n_folds, and for each input feature
+            the fraction of the folds where it is selected, its mean score
+            over the folds where the selector scored it, and the fraction
+            of the folds where the correlation filter removed it (None
+            without filter). The selected and scores are None without
+            selector.
+    """
+
+    candidate = _candidate_key(params)
+    # The last evaluation of the candidate on each fold.
+    latest = dict()
+    for name in os.listdir(path):
+        if name == "folds.npz" or not name.endswith(".npz"):
+            continue
+        with np.load(os.path.join(path, name)) as record:
+            if str(record["candidate"]) != candidate:
+                continue
+            fold, recorded = int(record["fold"]), float(record["time"])
+            if fold not in latest or latest[fold][0] < recorded:
+                latest[fold] = recorded, {
+                    key: record[key]
+                    for key in ("selected", "feature_scores", "removed")
+                    if key in record.files
+                }
+    records = [record for _, record in latest.values()]
+    selection = dict(
+        n_folds=len(records), selected=None, scores=None, removed=None
+    )
+    if records and "selected" in records[0]:
+        selection["selected"] = np.mean(
+            [record["selected"] for record in records], axis=0
+        )
+        scores = np.array([record["feature_scores"] for record in records])
+        scored = ~np.isnan(scores)
+        selection["scores"] = np.divide(
+            np.where(scored, scores, 0).sum(axis=0),
+            scored.sum(axis=0),
+            out=np.full(scores.shape[1], np.nan),
+            where=scored.any(axis=0),
+        )
+    if records and "removed" in records[0]:
+        selection["removed"] = np.mean(
+            [record["removed"] for record in records], axis=0
+        )
+    return selection
+
+
+def read_predictions(path: str):
+    """
+    Read the stored predictions of all the cells of a directory.
+
+    Args:
+        path: The predictions folder of the output directory of an
+            experiment.
+
+    Returns:
+        (list): One dict per cell, with the arrays of the file and the
+            fields of its info.
+    """
+
+    cells = []
+    for name in sorted(os.listdir(path)):
+        if not name.endswith(".npz"):
+            continue
+        with np.load(os.path.join(path, name)) as stored:
+            cell = {key: stored[key] for key in stored.files if key != "info"}
+            cell.update(json.loads(str(stored["info"])))
+        cells.append(cell)
+    return cells
+
+
+def _test_fold(path, rows):
+    # The samples of the test fold of a fit on the given training rows,
+    # their indices and the index of the fold, or None if the rows leave
+    # out more than one fold.
+    if rows is None:
+        return None
+    path_folds = os.path.join(path, "folds.npz")
+    cache_key = path_folds, os.path.getmtime(path_folds)
+    if cache_key not in _folds:
+        # A process scores the cells one after the other.
+        _folds.clear()
+        with np.load(path_folds) as stored:
+            _folds[cache_key] = (
+                np.load(str(stored["path_X"]), mmap_mode="r"),
+                stored["test_fold"],
+            )
+    X, test_fold = _folds[cache_key]
+    left_out = np.setdiff1d(test_fold[test_fold >= 0], test_fold[rows])
+    if len(left_out) != 1:
+        return None
+    index = np.flatnonzero(test_fold == left_out[0])
+    return X[index], index, int(left_out[0])
+
+
+def _selection(pipeline, selector, n_features):
+    # The outputs of the selector of a fitted pipeline, and of the
+    # correlation filter before it, mapped to the input features. The
+    # features that the selector did not see have no score.
+    columns = np.arange(n_features)
+    outputs = dict()
+    for name, step in pipeline.steps[:-1]:
+        if name == selector:
+            if hasattr(step, "top_features_"):
+                # ReliefF
+                support = np.zeros(len(columns), dtype=bool)
+                support[step.top_features_[: step.n_features_to_select]] = 1
+                scores = step.feature_importances_
+            else:
+                support = step.get_support()
+                scores = getattr(step, "variances_", None)
+                if scores is None:
+                    scores = step.scores_
+            outputs["selected"] = np.zeros(n_features, dtype=bool)
+            outputs["selected"][columns[support]] = True
+            outputs["feature_scores"] = np.full(n_features, np.nan)
+            outputs["feature_scores"][columns] = scores
+        elif name == "CorrelationFilter":
+            support = step.get_support()
+            outputs["removed"] = np.ones(n_features, dtype=bool)
+            outputs["removed"][columns[support]] = False
+            columns = columns[support]
+    return outputs
+
+
+def _candidate_key(params):
+    return json.dumps(
+        {name: params[name] for name in sorted(params)},
+        default=ioutil._to_builtin,
+    )
@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+#
+# relieff.py
+#
+
+"""
+skrebate's ReliefF with the distance matrix of a fold cached.
+"""
+
+__author__ = "Ahmed Albuni"
+__email__ = "ahmed.albuni@gmail.com"
+
+
+from skrebate import ReliefF
+
+
+class _ReliefF(ReliefF):
+    # Reads the distance matrix of a fold from the memory.
+
+    def _distarray_no_missing(self, xc, xd):
+        return self.memory.cache(_relieff_distance, ignore=["relieff"])(
+            self, xc, xd
+        )
+
+    def _distarray_missing(self, xc, xd, cdiffs):
+        return self.memory.cache(_relieff_distance, ignore=["relieff"])(
+            self, xc, xd, cdiffs
+        )
+
+
+def relieff_ranking(X, y, n_neighbors, memory, n_jobs):
+    """
+    Score and rank the features with ReliefF.
+
+    Args:
+        X: The training data.
+        y: The response.
+        n_neighbors: The number of neighbors used to score the features.
+        memory: The store of the distance matrices, a TransformerCache.
+        n_jobs: The number of jobs used to score the features.
+
+    Returns:
+        The feature importances, and the indices of the features ordered
+        by rank.
+    """
+
+    relieff = _ReliefF(n_neighbors=n_neighbors, n_jobs=n_jobs)
+    relieff.memory = memory
+    relieff.fit(X, y)
+    return relieff.feature_importances_, relieff.top_features_
+
+
+def _relieff_distance(relieff, xc, xd, cdiffs=None):
+    if cdiffs is None:
+        return ReliefF._distarray_no_missing(relieff, xc, xd)
+    return ReliefF._distarray_missing(relieff, xc, xd, cdiffs)
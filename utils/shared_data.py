@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+#
+# shared_data.py
+#
+
+"""
+Dataset shared between the worker processes through memory-mapped files.
+"""
+
+__author__ = "Ahmed Albuni"
+__email__ = "ahmed.albuni@gmail.com"
+
+
+import os
+
+import numpy as np
+from sklearn.model_selection import PredefinedSplit, check_cv
+
+
+class SharedDataset:
+    """
+    Handle of a dataset and its cross-validation splits stored once in
+    memory-mapped files.
+
+    Only the paths are pickled when the handle is sent to a worker
+    process, the workers map the same files instead of receiving a copy
+    of the data, and joblib passes the mapped arrays to its own workers
+    by reference.
+
+    Args:
+        path: Directory of the memory-mapped files.
+        path_X: Path to the .npy file of X, defaults to X.npy in path.
+        path_y: Path to the .npy file of y, defaults to y.npy in path.
+        classes: The labels of y if they are not numbers, such as strings,
+            y is then stored as the indices of its labels in classes.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        path_X: str = None,
+        path_y: str = None,
+        classes: list = None,
+    ):
+        self.path = path
+        self.path_X = path_X or os.path.join(path, "X.npy")
+        self.path_y = path_y or os.path.join(path, "y.npy")
+        self.classes = classes
+
+    @classmethod
+    def create(cls, path: str, X: np.ndarray, y: np.ndarray, cv=5):
+        """
+        Store the dataset and compute the cross-validation splits once.
+
+        Args:
+            path: Directory of the memory-mapped files.
+            X: Feature matrix (n samples x n features).
+            y: Ground truth vector (n samples).
+            cv: The number of cross-validation folds, the splits are the
+                same as the ones of the scikit-learn searches for a
+                classifier (stratified folds, no shuffling).
+
+        Returns:
+            (SharedDataset): The handle of the dataset.
+
+        """
+        os.makedirs(path, exist_ok=True)
+        # Arrays already mapped from a whole .npy file, such as the binary
+        # cache of the features file, are shared without a copy.
+        path_X = mapped_file(X)
+        if path_X is None:
+            path_X = os.path.join(path, "X.npy")
+            np.save(path_X, np.ascontiguousarray(X))
+        classes = None
+        path_y = mapped_file(y)
+        if path_y is None:
+            path_y = os.path.join(path, "y.npy")
+            y_stored = np.asarray(y)
+            if y_stored.dtype == object:
+                # The labels such as strings are Python objects, which can
+                # not be memory-mapped, their indices are stored instead.
+                classes, y_stored = np.unique(y_stored, return_inverse=True)
+                classes = classes.tolist()
+            np.save(path_y, y_stored)
+        # The splits are stored as the index of the test fold of each
+        # sample.
+        test_fold = np.full(len(y), -1, dtype=np.int32)
+        splitter = check_cv(cv, y, classifier=True)
+        for i, (_, test_index) in enumerate(splitter.split(X, y)):
+            test_fold[test_index] = i
+        np.save(os.path.join(path, "test_fold.npy"), test_fold)
+        return cls(path, path_X, path_y, classes)
+
+    def load(self):
+        """
+        Map the dataset in the memory of the process.
+
+        Returns:
+            (tuple): The read-only X and y arrays, and the splitter of the
+                cross-validation folds.
+
+        """
+        X = np.load(self.path_X, mmap_mode="r")
+        y = np.load(self.path_y, mmap_mode="r")
+        if self.classes is not None:
+            y = np.array(self.classes, dtype=object)[y]
+        test_fold = np.load(os.path.join(self.path, "test_fold.npy"))
+        return X, y, PredefinedSplit(test_fold)
+
+
+def mapped_file(array):
+    """
+    Returns the path of the .npy file mapped by an array, or None if the
+    array is not a memory map of a whole .npy file.
+    """
+
+    if not isinstance(array, np.memmap) or array.filename is None:
+        return None
+    if not str(array.filename).endswith(".npy"):
+        return None
+    mapped = np.load(array.filename, mmap_mode="r")
+    if (
+        mapped.shape != array.shape
+        or mapped.dtype != array.dtype
+        or mapped.strides != array.strides
+        or mapped.offset != array.offset
+    ):
+        return None
+    return str(array.filename)
@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+#
+# warm_start.py
+#
+
+"""
+Pipeline fits that continue from the fit of a neighbouring candidate.
+"""
+
+__author__ = "Ahmed Albuni"
+__email__ = "ahmed.albuni@gmail.com"
+
+
+from collections import OrderedDict
+
+import joblib
+from sklearn.pipeline import Pipeline
+
+# The classifiers that can be warm started, and the param along which the
+# candidates are ordered.
+WARM_START_PARAMS = {
+    "LogisticRegression": "C",
+    "ExtraTreesClassifier": "n_estimators",
+    "LGBMClassifier": "n_estimators",
+}
+
+# The previous fits live in the memory of each process, keyed by the
+# training data and the params of the final step except the path param.
+_paths = OrderedDict()
+
+
+class WarmStartPipeline(Pipeline):
+    """
+    Pipeline whose final step is fitted from the solution of the previous
+    candidate along its warm start param.
+
+    The candidates of a search that only differ in the warm start param
+    of the classifier (see WARM_START_PARAMS) form a path. The last fit of
+    each path on each fold is kept in the memory of the process, and the
+    next fit on the same transformed fold starts from it:
+    LogisticRegression starts the solver from the previous coefficients,
+    the classifier converges to the same solution within its tolerance,
+    and ExtraTreesClassifier and LGBMClassifier keep the previous trees
+    and only fit the additional ones, which gives the same model as a
+    cold fit. The other classifiers, and the fits without a previous
+    solution, are fitted from scratch.
+
+    Args:
+        steps: The steps of the pipeline.
+        max_paths: The number of previous fits kept in memory.
+        memory: Cache of the fitted transformers.
+        verbose: Print the time of each step fit.
+    """
+
+    def __init__(self, steps, *, max_paths=32, memory=None, verbose=False):
+        super().__init__(steps, memory=memory, verbose=verbose)
+        self.max_paths = max_paths
+
+    def fit(self, X, y=None, rows=None, **params):
+        # The rows of the dataset are kept for the PredictionRecorder, see
+        # utils.oof.RowsPipeline.
+        self.rows_ = rows
+        estimator = self.steps[-1][1]
+        param = WARM_START_PARAMS.get(type(estimator).__name__)
+        if param is None or params:
+            return super().fit(X, y, **params)
+        transformers = Pipeline(self.steps[:-1], memory=self.memory)
+        Xt = transformers.fit_transform(X, y)
+        self.steps[:-1] = transformers.steps
+        estimator_params = estimator.get_params(deep=False)
+        value = estimator_params.pop(param)
+        key = joblib.hash(
+            (Xt, y, type(estimator).__name__, param, estimator_params)
+        )
+        previous = _paths.pop(key, None)
+        if previous is not None and _can_continue(
+            param, getattr(previous, param), value
+        ):
+            _warm_fit(estimator, previous, Xt, y)
+        else:
+            estimator.fit(Xt, y)
+        _paths[key] = estimator
+        while len(_paths) > self.max_paths:
+            _paths.popitem(last=False)
+        return self
+
+
+def _can_continue(param, previous_value, value):
+    # Trees can only be added, the coefficients can start from any value
+    # of C.
+    if param == "n_estimators":
+        return previous_value < value
+    return True
+
+
+def _warm_fit(estimator, previous, X, y):
+    name = type(estimator).__name__
+    if name == "LogisticRegression":
+        estimator.coef_ = previous.coef_.copy()
+        estimator.intercept_ = previous.intercept_.copy()
+        estimator.set_params(warm_start=True)
+        try:
+            estimator.fit(X, y)
+        finally:
+            estimator.set_params(warm_start=False)
+    elif name == "ExtraTreesClassifier":
+        # The random state of the forest is drawn again for the previous
+        # trees, so the new trees are the same as in a cold fit.
+        estimator.estimators_ = list(previous.estimators_)
+        estimator.set_params(warm_start=True)
+        try:
+            estimator.fit(X, y)
+        finally:
+            estimator.set_params(warm_start=False)
+    elif name == "LGBMClassifier":
+        n_estimators = estimator.n_estimators
+        estimator.set_params(
+            n_estimators=n_estimators - previous.n_estimators
+        )
+        try:
+            estimator.fit(X, y, init_model=previous.booster_)
+        finally:
+            estimator.set_params(n_estimators=n_estimators)
+
+
+def clear_paths():
+    """Remove the previous fits of this process."""
+
+    _paths.clear()
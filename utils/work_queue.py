@@ -0,0 +1,203 @@
+# -*- coding: utf-8 -*-
+#
+# work_queue.py
+#
+
+"""
+Queue of the experiment cells on a file system shared between nodes.
+"""
+
+__author__ = "Ahmed Albuni"
+__email__ = "ahmed.albuni@gmail.com"
+
+
+import os
+import pickle
+import shutil
+import time
+import uuid
+
+from utils import ioutil
+
+# Sub-directories of the queue.
+JOBS = "jobs"
+LEASES = "leases"
+RESULTS = "results"
+FAILED = "failed"
+# Marker file written by the coordinator once all the cells are finished.
+STOP = "STOP"
+
+
+class WorkQueue:
+    """
+    Work queue stored in a directory, such as an NFS mount, that is
+    shared by the coordinator and the workers.
+
+    Every job is a pickled file in the jobs directory. A worker leases a
+    job by renaming it to the leases directory, the rename is atomic on
+    local and NFS file systems, so only one worker gets each job. The
+    worker writes a new random heartbeat next to the lease when it takes
+    it and while the job runs. The leases whose heartbeat has not changed
+    for lease_timeout seconds, because their worker died, are moved back
+    to the jobs directory. The time is measured by the clock of the
+    process that looks at the leases, from the first time it saw the
+    heartbeat, so neither the file times nor the clocks of the other
+    nodes are used. Results are written as JSON files, a job run twice
+    writes the same file.
+
+    Args:
+        path: Directory of the queue, it should have the same path on all
+            the nodes.
+        lease_timeout: Seconds after which a lease that is not renewed
+            expires.
+        poll_interval: Seconds between two looks at the queue.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        lease_timeout: float = 300.0,
+        poll_interval: float = 1.0,
+    ):
+        self.path = os.path.abspath(path)
+        self.lease_timeout = lease_timeout
+        self.poll_interval = poll_interval
+        # The last heartbeat seen of each lease, and when it was seen.
+        self._heartbeats = dict()
+
+    def reset(self):
+        """Remove the jobs and results of a previous experiment."""
+
+        if os.path.isdir(self.path):
+            shutil.rmtree(self.path)
+        for name in (JOBS, LEASES, RESULTS, FAILED):
+            os.makedirs(os.path.join(self.path, name))
+
+    def put(self, name: str, job):
+        path_to_file = os.path.join(self.path, JOBS, name + ".pkl")
+        with open(path_to_file + ".tmp", "wb") as outfile:
+            pickle.dump(job, outfile)
+        # The job becomes visible to the workers once it is complete.
+        os.replace(path_to_file + ".tmp", path_to_file)
+
+    def lease(self):
+        """Returns the name and the job of the next free job, or None if
+        there are none."""
+
+        for file_name in sorted(self._list(JOBS)):
+            if not file_name.endswith(".pkl"):
+                continue
+            path_lease = os.path.join(self.path, LEASES, file_name)
+            try:
+                os.rename(
+                    os.path.join(self.path, JOBS, file_name), path_lease
+                )
+            except FileNotFoundError:
+                # Leased by another worker.
+                continue
+            name = file_name[: -len(".pkl")]
+            self.renew(name)
+            with open(path_lease, "rb") as infile:
+                return name, pickle.load(infile)
+        return None
+
+    def renew(self, name: str):
+        """Write a new heartbeat of the lease of a job."""
+
+        path_heartbeat = self._heartbeat_file(name)
+        with open(path_heartbeat + ".tmp", "w") as outfile:
+            outfile.write(uuid.uuid4().hex)
+        os.replace(path_heartbeat + ".tmp", path_heartbeat)
+
+    def complete(self, name: str, result: dict):
+        path_results = os.path.join(self.path, RESULTS)
+        ioutil.write_checkpoint(path_results, name, result)
+        self._remove(os.path.join(self.path, LEASES, name + ".pkl"))
+        self._remove(self._heartbeat_file(name))
+
+    def fail(self, name: str, error: str):
+        with open(os.path.join(self.path, FAILED, name + ".txt"), "w") as f:
+            f.write(error)
+        self._remove(os.path.join(self.path, LEASES, name + ".pkl"))
+        self._remove(self._heartbeat_file(name))
+
+    def requeue_expired(self):
+        """Move the expired leases back to the jobs."""
+
+        now = time.monotonic()
+        names = [
+            file_name[: -len(".pkl")]
+            for file_name in self._list(LEASES)
+            if file_name.endswith(".pkl")
+        ]
+        for name in names:
+            heartbeat = self._read_heartbeat(name)
+            seen = self._heartbeats.get(name)
+            if seen is None or seen[0] != heartbeat:
+                self._heartbeats[name] = (heartbeat, now)
+                continue
+            if now - seen[1] <= self.lease_timeout:
+                continue
+            del self._heartbeats[name]
+            # The heartbeat is removed first, so the next lease of the job
+            # does not start with this one.
+            self._remove(self._heartbeat_file(name))
+            try:
+                os.rename(
+                    os.path.join(self.path, LEASES, name + ".pkl"),
+                    os.path.join(self.path, JOBS, name + ".pkl"),
+                )
+            except FileNotFoundError:
+                # Completed or requeued by another process.
+                continue
+        # Forget the leases that are gone.
+        for name in set(self._heartbeats) - set(names):
+            del self._heartbeats[name]
+
+    def results(self):
+        return ioutil.read_checkpoints(os.path.join(self.path, RESULTS))
+
+    def failures(self):
+        """Returns the name and the error of the failed jobs."""
+
+        failures = dict()
+        for file_name in self._list(FAILED):
+            with open(os.path.join(self.path, FAILED, file_name)) as infile:
+                failures[file_name[: -len(".txt")]] = infile.read()
+        return failures
+
+    def stop(self):
+        """Tell the workers to exit, and remove the jobs and results."""
+
+        os.makedirs(self.path, exist_ok=True)
+        with open(os.path.join(self.path, STOP), "w"):
+            pass
+        for name in os.listdir(self.path):
+            if os.path.isdir(os.path.join(self.path, name)):
+                shutil.rmtree(os.path.join(self.path, name))
+
+    def stopped(self):
+        return os.path.isfile(os.path.join(self.path, STOP))
+
+    def _list(self, name):
+        try:
+            return os.listdir(os.path.join(self.path, name))
+        except FileNotFoundError:
+            return []
+
+    def _heartbeat_file(self, name):
+        return os.path.join(self.path, LEASES, name + ".heartbeat")
+
+    def _read_heartbeat(self, name):
+        try:
+            with open(self._heartbeat_file(name)) as infile:
+                return infile.read()
+        except FileNotFoundError:
+            return None
+
+    @staticmethod
+    def _remove(path_to_file):
+        try:
+            os.remove(path_to_file)
+        except FileNotFoundError:
+            pass